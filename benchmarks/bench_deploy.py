@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: deploy_file benchmark
+
+Compares the line by line copy with per line flush that deploy_file used
+to do against the current chunked implementation.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from datetime import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+from sachannelupdate.base import deploy_file  # noqa
+
+
+def legacy_deploy_file(source, dest):
+    """The line by line deploy_file implementation"""
+    date = datetime.utcnow().strftime('%Y-%m-%d')
+    shandle = open(source)
+    with open(dest, 'w') as handle:
+        for line in shandle:
+            if line == '# Updated: %date%\n':
+                newline = '# Updated: %s\n' % date
+            else:
+                newline = line
+            handle.write(newline)
+            handle.flush()
+    shandle.close()
+
+
+def make_rules(filename, lines, marker):
+    """Write a generated rule file"""
+    with open(filename, 'w') as handle:
+        if marker:
+            handle.write('# Updated: %date%\n')
+        for num in xrange(lines):
+            if num % 2:
+                handle.write(
+                    'body     BW_RULE_%d    /example%d\\.com/i\n' % (num, num))
+            else:
+                handle.write(
+                    'uri      BW_URI_%d     /spam%d\\.example\\.net/\n'
+                    % (num, num))
+
+
+def timed(func, source, dest, rounds):
+    """Return the best wall time of rounds runs"""
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        func(source, dest)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    """Main function"""
+    parser = OptionParser()
+    parser.add_option(
+        '-l', '--lines',
+        help='lines per rule file',
+        dest='lines',
+        type='int',
+        default=200000)
+    parser.add_option(
+        '-r', '--rounds',
+        help='number of rounds, the best is reported',
+        dest='rounds',
+        type='int',
+        default=3)
+    options, _ = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for marker in (True, False):
+            source = os.path.join(tmpdir, 'source.cf')
+            dest = os.path.join(tmpdir, 'dest.cf')
+            make_rules(source, options.lines, marker)
+            lines = options.lines + int(marker)
+            print("%d lines, %s date marker" % (
+                lines, 'with' if marker else 'without'))
+            for name, func in (('line by line', legacy_deploy_file),
+                               ('chunked', deploy_file)):
+                elapsed = timed(func, source, dest, options.rounds)
+                print("  %-14s %8.3fs %12.0f lines/sec" % (
+                    name, elapsed, lines / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: package benchmark
+
+Compares the single threaded tarfile gzip path with the GzipWriter
+thread pool path for wall time and archive size.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tarfile
+import tempfile
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+from bench_deploy import make_rules  # noqa
+from sachannelupdate.base import package  # noqa
+
+
+def timed(dest, tardir, level, workers, rounds):
+    """Return the best wall time and the archive size"""
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        package(dest, tardir, 1, level=level, workers=workers)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    path = os.path.join(tardir, '1.tar.gz')
+    tar = tarfile.open(path)
+    tar.getmembers()
+    tar.close()
+    return best, os.path.getsize(path)
+
+
+def main():
+    """Main function"""
+    parser = OptionParser()
+    parser.add_option(
+        '-f', '--files',
+        help='number of rule files',
+        dest='files',
+        type='int',
+        default=40)
+    parser.add_option(
+        '-l', '--lines',
+        help='lines per rule file',
+        dest='lines',
+        type='int',
+        default=20000)
+    parser.add_option(
+        '-L', '--levels',
+        help='comma separated compression levels',
+        dest='levels',
+        default='6,9')
+    parser.add_option(
+        '-w', '--workers',
+        help='comma separated worker counts',
+        dest='workers',
+        default='2,4,8,16')
+    parser.add_option(
+        '-r', '--rounds',
+        help='number of rounds, the best is reported',
+        dest='rounds',
+        type='int',
+        default=3)
+    options, _ = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    dest = os.path.join(tmpdir, 'deploy')
+    os.mkdir(dest)
+    try:
+        for num in xrange(options.files):
+            make_rules(
+                os.path.join(dest, '%02d_rules.cf' % num),
+                options.lines, num % 2)
+        total = sum([
+            os.path.getsize(os.path.join(dest, name))
+            for name in os.listdir(dest)])
+        print("%d files, %d bytes, %d cpus" % (
+            options.files, total, os.sysconf('SC_NPROCESSORS_ONLN')))
+        for level in [int(val) for val in options.levels.split(',')]:
+            print("level %d" % level)
+            runs = [('tarfile w:gz', 1)] + [
+                ('%d workers' % int(val), int(val))
+                for val in options.workers.split(',')]
+            for name, workers in runs:
+                elapsed, size = timed(
+                    dest, tmpdir, level, workers, options.rounds)
+                print("  %-14s %8.3fs %12d bytes %8.1f MB/s" % (
+                    name, elapsed, size, total / elapsed / 1048576))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
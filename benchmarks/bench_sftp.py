@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: SFTP transfer benchmark
+
+Uploads an archive to a local SFTP stand-in behind a latency injecting
+proxy, comparing stop and wait writes with the pipelined transfers of
+transports.put_file.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+from paramiko import SFTPClient  # noqa
+from sftpserver import SFTPStandIn  # noqa
+from sachannelupdate.transports import make_transport, put_file  # noqa
+
+
+def connect(config, port):
+    """Open an SFTP session to the stand-in"""
+    transport = make_transport(config, '127.0.0.1', port)
+    transport.start_client()
+    transport.auth_password('bench', 'bench')
+    return SFTPClient.from_transport(transport), transport
+
+
+def stop_and_wait(sftp, local_file, remote_file):
+    """Write one request at a time, waiting for each acknowledgement"""
+    start = time.time()
+    with open(local_file, 'rb') as handle:
+        rhandle = sftp.open(remote_file, 'w')
+        try:
+            buf = handle.read(32768)
+            while buf:
+                rhandle.write(buf)
+                buf = handle.read(32768)
+        finally:
+            rhandle.close()
+    return time.time() - start
+
+
+def pipelined(sftp, local_file, remote_file):
+    """transports.put_file"""
+    return put_file(
+        sftp, local_file, remote_file, '%s.part' % remote_file).elapsed
+
+
+def main():
+    """Main function"""
+    parser = OptionParser()
+    parser.add_option(
+        '-s', '--size',
+        help='archive size in MB',
+        dest='size',
+        type='float',
+        default=4)
+    parser.add_option(
+        '-t', '--rtt',
+        help='round trip time in milliseconds',
+        dest='rtt',
+        type='float',
+        default=40)
+    options, _ = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    local_file = os.path.join(tmpdir, '1.tar.gz')
+    root = os.path.join(tmpdir, 'remote')
+    os.mkdir(root)
+    with open(local_file, 'wb') as handle:
+        handle.write(os.urandom(int(options.size * 1048576)))
+    size = os.path.getsize(local_file)
+    server = SFTPStandIn(root, options.rtt / 1000.0, window_size=8388608)
+    runs = [
+        ('stop and wait', {}, stop_and_wait),
+        ('pipelined', {}, pipelined),
+        ('pipelined 8MB window', {'ssh_window_size': '8388608'}, pipelined),
+        ('pipelined compressed', {'ssh_compression': 'yes'}, pipelined),
+    ]
+    print("%.1f MB archive, %.0f ms rtt" % (size / 1048576.0, options.rtt))
+    try:
+        for name, config, func in runs:
+            sftp, transport = connect(config, server.port)
+            try:
+                elapsed = func(sftp, local_file, '/1.tar.gz')
+            finally:
+                transport.close()
+            print("  %-22s %8.2fs %10.0f KB/sec" % (
+                name, elapsed, size / elapsed / 1024))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: stage benchmark suite
+
+Generates a synthetic rule tree and times each stage of a publish on
+its own: rule discovery, deployment, packaging, hashing, signing, the
+upload to a local SFTP stand-in and the DNS update against a local DNS
+stand-in. Results can be saved as a JSON baseline and later runs
+compared against it, stages slower than the threshold are flagged as
+regressions and the exit status is 1.
+
+Signing only runs when a gpg home and key are given.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+
+from optparse import OptionParser
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+from paramiko import RSAKey  # noqa
+from bench_deploy import make_rules  # noqa
+from dnsserver import DNSStandIn  # noqa
+from sftpserver import SFTPStandIn  # noqa
+from sachannelupdate.base import get_cf_files, process, package, \
+    hash_file, sign, upload, update_dns  # noqa
+from sachannelupdate.manifest import Manifest  # noqa
+from sachannelupdate.transports import POOL  # noqa
+
+DOMAIN = 'sa.example.com.'
+DNS_KEY = 'YmVuY2htYXJrIGtleSBmb3IgdGhlIHN0YW5kLWlu'
+FILES_PER_DIR = 50
+
+
+def make_tree(root, files, lines, markers):
+    """Generate a rule tree of files rule files
+
+    The files are spread over subdirectories, each of which also holds
+    a file that is not a rule file. A markers share of the files carry
+    the %date% marker.
+    """
+    marked = int(round(files * markers))
+    for num in xrange(files):
+        dirname = os.path.join(root, 'dir%03d' % (num // FILES_PER_DIR))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+            with open(os.path.join(dirname, 'README'), 'w') as handle:
+                handle.write('not a rule file\n')
+        make_rules(
+            os.path.join(dirname, '%04d_rules.cf' % num), lines,
+            num < marked)
+
+
+def reset_dir(dirname):
+    """Empty a directory"""
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname)
+
+
+@contextmanager
+def quiet():
+    """Silence the progress messages the stages print to stdout"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timed(setup, func, rounds):
+    """Return the best wall time of rounds runs, setup is not timed"""
+    best = None
+    for _ in xrange(rounds):
+        args = setup()
+        with quiet():
+            start = time.time()
+            func(*args)
+            elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_ssh_config(sshdir, port, host_key):
+    """Write a client key and a known_hosts entry for the stand-in"""
+    os.makedirs(sshdir)
+    RSAKey.generate(2048).write_private_key_file(
+        os.path.join(sshdir, 'id_rsa'))
+    with open(os.path.join(sshdir, 'known_hosts'), 'w') as handle:
+        handle.write('[127.0.0.1]:%d %s %s\n' % (
+            port, host_key.get_name(), host_key.get_base64()))
+
+
+class Stages(object):
+    """The stages of a publish run against a synthetic tree"""
+    def __init__(self, tmpdir, options):
+        """Init"""
+        self.options = options
+        self.rules = os.path.join(tmpdir, 'rules')
+        self.dest = os.path.join(tmpdir, 'deploy')
+        self.tardir = os.path.join(tmpdir, 'archives')
+        self.remote = os.path.join(tmpdir, 'remote')
+        self.archive = os.path.join(self.tardir, 'bench.tar.gz')
+        self.manifest = Manifest()
+        for dirname in (self.dest, self.tardir, self.remote):
+            os.makedirs(dirname)
+        make_tree(
+            self.rules, options.files, options.lines, options.markers)
+        self.sftp = SFTPStandIn(self.remote, options.rtt)
+        self.dns = DNSStandIn(DOMAIN, DNS_KEY)
+        make_ssh_config(
+            os.path.join(tmpdir, 'ssh'), self.sftp.port, self.sftp.host_key)
+        self.config = dict(
+            home_dir=tmpdir,
+            ssh_config_dir=os.path.join(tmpdir, 'ssh'),
+            ssh_agent='no',
+            remote_username='bench',
+            remote_location='sftp://127.0.0.1:%d/' % self.sftp.port,
+            domain_name=DOMAIN,
+            domain_key=DNS_KEY,
+            domain_ip='127.0.0.1',
+            dns_port=str(self.dns.port),
+            gpg_dir=options.gpg_dir or '',
+            gpg_keyid=options.gpg_keyid or '',
+            gpg_passphrase=options.gpg_passphrase or '')
+
+    def rulefiles(self):
+        """Return a list of the rule files"""
+        return list(get_cf_files(self.rules))
+
+    def setup_discover(self):
+        """Arguments for the discovery stage"""
+        return (self.rules,)
+
+    @staticmethod
+    def run_discover(path):
+        """Walk the rule tree"""
+        for _ in get_cf_files(path):
+            pass
+
+    def setup_process(self):
+        """Arguments for a deploy into an empty directory"""
+        reset_dir(self.dest)
+        self.manifest = Manifest()
+        return self.dest, self.rulefiles(), self.manifest
+
+    def setup_process_unchanged(self):
+        """Arguments for a deploy where nothing changed"""
+        return self.dest, self.rulefiles(), self.manifest
+
+    def setup_package(self):
+        """Arguments for packaging the deployed rules"""
+        return self.dest, self.tardir, 'bench'
+
+    def setup_archive(self):
+        """Arguments for the stages that work on the archive"""
+        return (self.archive,)
+
+    def setup_sign(self):
+        """Arguments for signing the archive"""
+        return self.config, self.archive
+
+    def setup_upload(self):
+        """Arguments for an upload to an empty remote over a new link"""
+        reset_dir(self.remote)
+        POOL.closeall()
+        signature = '%s.asc' % self.archive
+        if not os.path.exists(signature):
+            with open(signature, 'w') as handle:
+                handle.write('unsigned benchmark archive\n')
+        return self.config, self.config['remote_location'], self.archive
+
+    def setup_update_dns(self):
+        """Arguments for the DNS update"""
+        return self.config, '1', ['3.3.2', '3.4.1', '4.0.0']
+
+    def run_upload(self, config, remote, archive):
+        """Upload, failing loudly"""
+        if not upload(config, remote, archive):
+            raise RuntimeError("Upload to the SFTP stand-in failed")
+
+    def run(self):
+        """Time the stages, returns a dict of seconds per stage"""
+        stages = [
+            ('get_cf_files', self.setup_discover, self.run_discover),
+            ('process', self.setup_process, process),
+            ('process_unchanged', self.setup_process_unchanged, process),
+            ('package', self.setup_package, package),
+            ('hash_file', self.setup_archive, hash_file),
+            ('sign', self.setup_sign, sign),
+            ('upload', self.setup_upload, self.run_upload),
+            ('update_dns', self.setup_update_dns, update_dns)]
+        results = {}
+        for name, setup, func in stages:
+            if name == 'sign' and not self.options.gpg_keyid:
+                print("  %-18s  skipped, no --gpg-keyid" % name)
+                continue
+            results[name] = timed(setup, func, self.options.rounds)
+            print("  %-18s %8.3fs" % (name, results[name]))
+        POOL.closeall()
+        return results
+
+
+def get_params(options):
+    """Return the parameters that make runs comparable"""
+    return dict(
+        files=options.files, lines=options.lines, markers=options.markers,
+        rtt=options.rtt)
+
+
+def compare(baseline, current, threshold, min_delta):
+    """Compare stage timings, returns the names of regressed stages
+
+    A stage regresses when it is more than threshold slower relative to
+    the baseline and at least min_delta seconds slower, so that noise
+    on very fast stages is not flagged.
+    """
+    regressions = []
+    print("%-18s %10s %10s %8s" % ('stage', 'baseline', 'current', 'change'))
+    for name in sorted(current):
+        if name not in baseline:
+            print("%-18s %10s %9.3fs" % (name, '-', current[name]))
+            continue
+        before, after = baseline[name], current[name]
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if after > before * (1 + threshold) and after - before >= min_delta:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-18s %9.3fs %9.3fs %+7.1f%%%s" % (
+            name, before, after, change * 100, flag))
+    return regressions
+
+
+def main():
+    """Main function"""
+    parser = OptionParser()
+    parser.add_option(
+        '-f', '--files', help='number of rule files', dest='files',
+        type='int', default=200)
+    parser.add_option(
+        '-l', '--lines', help='lines per rule file', dest='lines',
+        type='int', default=500)
+    parser.add_option(
+        '-m', '--markers', help='share of files with a %date% marker',
+        dest='markers', type='float', default=0.5)
+    parser.add_option(
+        '-r', '--rounds', help='number of rounds, the best is reported',
+        dest='rounds', type='int', default=3)
+    parser.add_option(
+        '--rtt', help='simulated SFTP round trip time in seconds',
+        dest='rtt', type='float', default=0.0)
+    parser.add_option(
+        '--gpg-dir', help='gpg home directory', dest='gpg_dir')
+    parser.add_option(
+        '--gpg-keyid', help='gpg key to sign with', dest='gpg_keyid')
+    parser.add_option(
+        '--gpg-passphrase', help='passphrase of the gpg key',
+        dest='gpg_passphrase')
+    parser.add_option(
+        '-s', '--save', help='save the results as a JSON baseline',
+        dest='save')
+    parser.add_option(
+        '-c', '--compare', help='compare the results to a JSON baseline',
+        dest='compare')
+    parser.add_option(
+        '-t', '--threshold', help='relative slowdown that is a regression',
+        dest='threshold', type='float', default=0.2)
+    parser.add_option(
+        '--min-delta', help='smallest slowdown in seconds that is flagged',
+        dest='min_delta', type='float', default=0.005)
+    options, _ = parser.parse_args()
+    params = get_params(options)
+    print("%(files)d files, %(lines)d lines, %(markers).0f%% with markers, "
+          "rtt %(rtt).3fs" % dict(params, markers=options.markers * 100))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = Stages(tmpdir, options).run()
+    finally:
+        shutil.rmtree(tmpdir)
+    if options.save:
+        with open(options.save, 'w') as handle:
+            json.dump(dict(
+                params=params, python=platform.python_version(),
+                created=int(time.time()), stages=results),
+                handle, indent=2, separators=(',', ': '), sort_keys=True)
+            handle.write('\n')
+        print("Saved baseline to %s" % options.save)
+    if options.compare:
+        with open(options.compare) as handle:
+            baseline = json.load(handle)
+        if baseline.get('params') != params:
+            print("Warning: the baseline was made with %s" %
+                  baseline.get('params'), file=sys.stderr)
+        regressions = compare(
+            baseline['stages'], results, options.threshold,
+            options.min_delta)
+        if regressions:
+            print("Regressions: %s" % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: startup benchmark
+
+Times fresh interpreters importing the package, running updatesachannel
+when no rule changed and running it with --delete. None of these should
+load the gpg, DNS or SSH libraries, the modules that do get loaded are
+reported. With --max-ms the exit status is 1 when the best import time
+is over the limit.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from bench_deploy import make_rules  # noqa
+
+HEAVY = ('paramiko', 'dns', 'gnupg', 'cryptography', 'ctypes')
+CONFIG = """[settings]
+home_dir = %s
+domain_key = YmVuY2htYXJr
+remote_location = sftp://127.0.0.1/srv/www/saupdate
+gpg_keyid = 0aasas1
+"""
+DEPLOY = """
+from sachannelupdate.base import get_cf_files, process
+from sachannelupdate.manifest import Manifest
+manifest = Manifest('%(home)s/db/manifest')
+process('%(home)s/deploy', get_cf_files('%(home)s/rules'), manifest)
+manifest.save()
+"""
+LOADED = """
+import sys
+%s
+sys.stderr.write(' '.join(set(
+    [name.split('.')[0] for name in sys.modules if name])))
+"""
+
+
+def run(args, env):
+    """Run a fresh interpreter, returns (seconds, heavy modules loaded)"""
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, '-W', 'ignore'] + args, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    elapsed = time.time() - start
+    if proc.returncode:
+        raise RuntimeError(stderr)
+    loaded = set(stderr.split())
+    return elapsed, sorted([name for name in HEAVY if name in loaded])
+
+
+def timed(args, env, rounds):
+    """Return the best wall time of rounds runs and the heavy modules"""
+    best = heavy = None
+    for _ in xrange(rounds):
+        elapsed, heavy = run(args, env)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, heavy
+
+
+def cli_code(*args):
+    """Code that runs the cli and reports the modules it loaded"""
+    return LOADED % (
+        "sys.argv = %r\nfrom sachannelupdate.cli import main\nmain()" % (
+            ['updatesachannel'] + list(args)))
+
+
+def main():
+    """Main function"""
+    parser = OptionParser()
+    parser.add_option(
+        '-f', '--files', help='number of rule files', dest='files',
+        type='int', default=20)
+    parser.add_option(
+        '-r', '--rounds', help='number of rounds, the best is reported',
+        dest='rounds', type='int', default=10)
+    parser.add_option(
+        '--max-ms', help='fail when importing takes longer than this',
+        dest='max_ms', type='float')
+    options, _ = parser.parse_args()
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    home = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(home, 'rules'))
+        os.makedirs(os.path.join(home, 'deploy'))
+        for num in xrange(options.files):
+            make_rules(os.path.join(
+                home, 'rules', '%04d_rules.cf' % num), 100, num % 2)
+        config = os.path.join(home, 'sa.ini')
+        with open(config, 'w') as handle:
+            handle.write(CONFIG % home)
+        run(['-c', DEPLOY % dict(home=home)], env)
+        results = []
+        for name, code in (
+                ('interpreter', LOADED % ''),
+                ('import', LOADED % 'import sachannelupdate.cli'),
+                ('unchanged run', cli_code('-c', config)),
+                ('delete run', cli_code('-c', config, '-d'))):
+            elapsed, heavy = timed(['-c', code], env, options.rounds)
+            results.append((name, elapsed))
+            print("  %-14s %8.1fms  %s" % (
+                name, elapsed * 1000,
+                'loads %s' % ', '.join(heavy) if heavy else ''))
+    finally:
+        shutil.rmtree(home)
+    if options.max_ms is not None:
+        import_ms = dict(results)['import'] * 1000
+        if import_ms > options.max_ms:
+            print("Importing took %.1fms, over the %.1fms limit" % (
+                import_ms, options.max_ms))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
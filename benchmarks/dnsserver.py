@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: local DNS server stand-in for benchmarks
+
+Accepts TSIG signed UPDATE messages over TCP, verifies them with the
+keyring and answers NOERROR without storing anything.
+"""
+import socket
+import struct
+import threading
+
+from dns import message, opcode, rcode, tsigkeyring
+
+
+def recv_exactly(sock, size):
+    """Read size bytes, returns an empty string on EOF"""
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return ''
+        data += chunk
+    return data
+
+
+class DNSStandIn(object):
+    """Local DNS server answering UPDATE messages for domain"""
+    def __init__(self, domain, dns_key):
+        """Init"""
+        self.keyring = tsigkeyring.from_text({domain: dns_key})
+        self.updates = 0
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        """Accept connections"""
+        while True:
+            conn = self.sock.accept()[0]
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _serve(self, conn):
+        """Answer the messages on a connection"""
+        try:
+            while True:
+                header = recv_exactly(conn, 2)
+                if not header:
+                    return
+                wire = recv_exactly(conn, struct.unpack('!H', header)[0])
+                if not wire:
+                    return
+                request = message.from_wire(wire, keyring=self.keyring)
+                response = message.make_response(request)
+                if request.opcode() == opcode.UPDATE:
+                    self.updates += 1
+                else:
+                    response.set_rcode(rcode.REFUSED)
+                wire = response.to_wire()
+                conn.sendall(struct.pack('!H', len(wire)) + wire)
+        except Exception:  # pylint: disable=broad-except
+            return
+        finally:
+            conn.close()
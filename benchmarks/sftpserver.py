@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: local SFTP server stand-in for benchmarks
+
+A paramiko SFTP server that serves a local directory and accepts any
+credentials, plus a TCP proxy that delays traffic to simulate a high
+latency link.
+"""
+import os
+import time
+import socket
+import threading
+
+from Queue import Queue
+
+from paramiko import ServerInterface, SFTPServerInterface, SFTPServer, \
+    SFTPAttributes, SFTPHandle, SFTP_OK, SFTP_FAILURE, RSAKey, Transport, \
+    AUTH_SUCCESSFUL, OPEN_SUCCEEDED
+
+
+class StubServer(ServerInterface):
+    """SSH server that accepts everyone"""
+    def check_auth_password(self, username, password):
+        """Accept any password"""
+        return AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        """Accept any key"""
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        """Allow sessions"""
+        return OPEN_SUCCEEDED
+
+    def get_allowed_auths(self, username):
+        """Supported auth methods"""
+        return 'password,publickey'
+
+
+class StubSFTPHandle(SFTPHandle):
+    """Handle on a local file"""
+    def stat(self):
+        """Stat the open file"""
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class StubSFTPServer(SFTPServerInterface):
+    """SFTP server rooted at a local directory"""
+    ROOT = None
+
+    def __init__(self, server, *args, **kwargs):
+        """Init"""
+        super(StubSFTPServer, self).__init__(server, *args, **kwargs)
+
+    def _realpath(self, path):
+        """Map a remote path into the root"""
+        return os.path.join(self.ROOT, self.canonicalize(path).lstrip('/'))
+
+    def stat(self, path):
+        """Stat a file"""
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        """Open a file"""
+        path = self._realpath(path)
+        try:
+            fdesc = os.open(path, flags, 0644)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        if flags & os.O_WRONLY:
+            mode = 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        else:
+            mode = 'rb'
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fdesc, mode)
+        return handle
+
+    def remove(self, path):
+        """Remove a file"""
+        try:
+            os.remove(self._realpath(path))
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        """Rename refusing to overwrite, like SFTPv3"""
+        newpath = self._realpath(newpath)
+        if os.path.exists(newpath):
+            return SFTP_FAILURE
+        os.rename(self._realpath(oldpath), newpath)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        """Overwriting rename"""
+        os.rename(self._realpath(oldpath), self._realpath(newpath))
+        return SFTP_OK
+
+    def list_folder(self, path):
+        """List a directory"""
+        path = self._realpath(path)
+        return [
+            SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+            for name in os.listdir(path)]
+
+
+class DelayProxy(object):
+    """TCP proxy that delays data by delay seconds in each direction"""
+    def __init__(self, target, delay):
+        """Init"""
+        self.target = target
+        self.delay = delay
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        """Accept connections"""
+        while True:
+            client = self.sock.accept()[0]
+            server = socket.create_connection(self.target)
+            for src, dst in ((client, server), (server, client)):
+                queue = Queue()
+                for target, args in ((self._recv, (src, queue)),
+                                     (self._send, (dst, queue))):
+                    thread = threading.Thread(target=target, args=args)
+                    thread.setDaemon(True)
+                    thread.start()
+
+    def _recv(self, sock, queue):
+        """Read and timestamp data"""
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                data = ''
+            queue.put((time.time() + self.delay, data))
+            if not data:
+                return
+
+    @staticmethod
+    def _send(sock, queue):
+        """Forward data once it is due"""
+        while True:
+            due, data = queue.get()
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            if not data:
+                try:
+                    sock.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+                return
+            try:
+                sock.sendall(data)
+            except socket.error:
+                return
+
+
+class SFTPStandIn(object):
+    """Local SFTP server serving root, optionally behind a DelayProxy
+
+    rtt is the simulated round trip time in seconds.
+    """
+    def __init__(self, root, rtt=0.0, window_size=None):
+        """Init"""
+        StubSFTPServer.ROOT = root
+        self.host_key = RSAKey.generate(2048)
+        self.window_size = window_size
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+        if rtt > 0:
+            self.proxy = DelayProxy(('127.0.0.1', self.port), rtt / 2.0)
+            self.port = self.proxy.port
+
+    def _accept(self):
+        """Serve connections"""
+        while True:
+            conn = self.sock.accept()[0]
+            kwargs = {}
+            if self.window_size:
+                kwargs['default_window_size'] = self.window_size
+            transport = Transport(conn, **kwargs)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler(
+                'sftp', SFTPServer, StubSFTPServer)
+            transport.start_server(server=StubServer())
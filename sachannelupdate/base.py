@@ -20,23 +20,44 @@ sachannelupdate: Utility for pushing updates to Spamassassin update channels
 Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
 """
 import os
+import re
+import time
+import socket
+import shutil
 import tarfile
 import datetime
 
-from Queue import Queue
 from hashlib import sha1
+from functools import partial
 from datetime import datetime
-
-from gnupg import GPG
-from dns.exception import DNSException
-from dns import tsig, query, tsigkeyring, update
-
-from sachannelupdate.utils import info
+from threading import Lock
+
+from sachannelupdate.utils import info, error, get_int, get_bool, \
+    parallel_map, parallel_imap, LazyModule
+from sachannelupdate.compress import GzipWriter
+from sachannelupdate.discovery import RuleFilter, iter_files, get_rule_filter
+from sachannelupdate.manifest import Manifest, file_digest
+from sachannelupdate.metrics import Metrics, export_metrics
+from sachannelupdate.snapshot import Snapshot, snapshot_key
+from sachannelupdate.locking import run_lock
+from sachannelupdate.signing import SignStream, get_signer, get_keyids, \
+    sign_digest, write_signatures
 from sachannelupdate.exceptions import SaChannelUpdateConfigError \
-    as CfgError, SaChannelUpdateDNSError, SaChannelUpdateError
-from sachannelupdate.transports import get_sftp_conn, get_remote_path
+    as CfgError, SaChannelUpdateDNSError, SaChannelUpdateError, \
+    SaChannelUpdateDeployError, SaChannelUpdateLockError
+
+# only loaded by the stages that use them
+tsig = LazyModule('dns.tsig')
+query = LazyModule('dns.query')
+rcode = LazyModule('dns.rcode')
+update = LazyModule('dns.update')
+tsigkeyring = LazyModule('dns.tsigkeyring')
+dns_exception = LazyModule('dns.exception')
+transports = LazyModule('sachannelupdate.transports')
 
 BLOCKSIZE = 65536
+CHUNKSIZE = 1048576
+DATE_MARKER = re.compile(r'^# Updated: %date%$', re.M)
 HASHTMPL = """%s  %s\n"""
 
 
@@ -46,110 +67,415 @@ def create_file(name, content):
         writefile.write(content)
 
 
+def replace_file(name, content):
+    """Write a file atomically, a crash leaves the old or the new content
+
+    The data is synced before the rename so the new name never points
+    at an empty file after a power loss.
+    """
+    tmpname = '%s.tmp' % name
+    with open(tmpname, 'w') as writefile:
+        writefile.write(content)
+        writefile.flush()
+        os.fsync(writefile.fileno())
+    os.rename(tmpname, name)
+
+
+def mark_pending(pendingfile):
+    """Record that deploy holds changes that are not published yet"""
+    dirname = os.path.dirname(pendingfile)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    create_file(pendingfile, '')
+
+
+def clear_pending(pendingfile):
+    """Record that the content of deploy has been published"""
+    if os.path.exists(pendingfile):
+        os.unlink(pendingfile)
+
+
 def getfiles(qfiles, dirname, names):
     """Get rule files in a directory"""
     for name in names:
         fullname = os.path.join(dirname, name)
         if os.path.isfile(fullname) and \
-            fullname.endswith('.cf') or \
-                fullname.endswith('.post'):
+                (fullname.endswith('.cf') or fullname.endswith('.post')):
             qfiles.put(fullname)
 
 
+def update_marker(data, date):
+    """Rewrite the update date marker lines in a block of complete lines"""
+    if '%date%' not in data:
+        return data
+    return DATE_MARKER.sub('# Updated: %s' % date, data)
+
+
 def deploy_file(source, dest):
-    """Deploy a file"""
+    """Deploy a file, returns the number of bytes written"""
     date = datetime.utcnow().strftime('%Y-%m-%d')
+    size = 0
     shandle = open(source)
-    with open(dest, 'w') as handle:
-        for line in shandle:
-            if line == '# Updated: %date%\n':
-                newline = '# Updated: %s\n' % date
-            else:
-                newline = line
-            handle.write(newline)
-            handle.flush()
-    shandle.close()
+    try:
+        with open(dest, 'w') as handle:
+            pending = ''
+            chunk = shandle.read(CHUNKSIZE)
+            while chunk:
+                # only rewrite complete lines, carry the rest over
+                chunk = pending + chunk
+                end = chunk.rfind('\n') + 1
+                pending = chunk[end:]
+                if end:
+                    data = update_marker(chunk[:end], date)
+                    handle.write(data)
+                    size += len(data)
+                chunk = shandle.read(CHUNKSIZE)
+            if pending:
+                handle.write(pending)
+                size += len(pending)
+    finally:
+        shandle.close()
+    return size
+
+
+class TeeWriter(object):
+    """File like object that copies writes to digests and other streams"""
+    def __init__(self, handle, digests=(), streams=()):
+        """Init"""
+        self.handle = handle
+        self.digests = digests
+        self.streams = streams
+        self.size = 0
+
+    def write(self, data):
+        """Write data to the file, digests and streams"""
+        self.handle.write(data)
+        for digest in self.digests:
+            digest.update(data)
+        for stream in self.streams:
+            stream.write(data)
+        self.size += len(data)
+
+    def tell(self):
+        """Return the number of bytes written"""
+        return self.size
+
+    def flush(self):
+        """Flush the underlying file"""
+        self.handle.flush()
+
+    def close(self):
+        """Closing is left to the owner of the file"""
+        pass
+
 
+def normalize_tarinfo(tarinfo):
+    """Strip the host specific metadata from a tar member"""
+    tarinfo.mtime = 0
+    tarinfo.mode = 0644
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo
 
-def package(dest, tardir, p_version):
+
+def package(dest, tardir, p_version, fileobj=None, level=9, workers=1,
+            reproducible=False):
     """Package files"""
-    os.chdir(dest)
     p_filename = '%s.tar.gz' % p_version
     p_path = os.path.join(tardir, p_filename)
-    tar = tarfile.open(p_path, mode='w:gz')
-    for cf_file in os.listdir('.'):
-        if os.path.isfile(cf_file):
-            tar.add(cf_file)
-    tar.close()
+    gzfile = handle = None
+    try:
+        if workers > 1 or reproducible:
+            handle = fileobj
+            if handle is None:
+                handle = open(p_path, 'wb')
+            mtime = None
+            if reproducible:
+                mtime = 0
+            gzfile = GzipWriter(handle, level, workers, mtime=mtime)
+            tar = tarfile.open(p_path, mode='w|', fileobj=gzfile)
+        else:
+            tar = tarfile.open(
+                p_path, mode='w:gz', fileobj=fileobj, compresslevel=level)
+        for cf_file in sorted(os.listdir(dest)):
+            cf_path = os.path.join(dest, cf_file)
+            if not os.path.isfile(cf_path):
+                continue
+            if reproducible:
+                tarinfo = normalize_tarinfo(tar.gettarinfo(cf_path, cf_file))
+                with open(cf_path, 'rb') as cf_handle:
+                    tar.addfile(tarinfo, cf_handle)
+            else:
+                tar.add(cf_path, cf_file)
+        tar.close()
+        if gzfile is not None:
+            gzfile.close()
+    finally:
+        # a no-op after close(), stops the threads on errors
+        if gzfile is not None:
+            gzfile.abort()
+        if handle is not None and fileobj is None:
+            handle.close()
 
 
-def process(dest, rulefiles):
-    """process rules"""
-    deploy = False
-    while not rulefiles.empty():
-        rulefile = rulefiles.get()
-        base = os.path.basename(rulefile)
-        dest = os.path.join(dest, base)
-        if os.path.exists(dest):
-            # check if older
-            oldtime = os.stat(rulefile).st_mtime
-            newtime = os.stat(dest).st_mtime
-            if oldtime > newtime:
-                deploy = True
-                deploy_file(rulefile, dest)
+def archive_key(dest, keyid):
+    """Return the content address of the archive built from dest"""
+    hasher = sha1()
+    hasher.update('%s\n' % keyid)
+    for cf_file in sorted(os.listdir(dest)):
+        cf_path = os.path.join(dest, cf_file)
+        if os.path.isfile(cf_path):
+            hasher.update('%s %s\n' % (file_digest(cf_path), cf_file))
+    return hasher.hexdigest()
+
+
+def link_file(source, dest):
+    """Hard link source to dest, copying if links are not possible"""
+    if os.path.exists(dest):
+        os.unlink(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)
+
+
+def read_hash(tar_filename):
+    """Return the digest recorded in the sha1 file of an archive"""
+    with open('%s.sha1' % tar_filename) as handle:
+        return handle.read().split()[0]
+
+
+def build_archive(config, dest, tardir, version):
+    """Package, hash and sign, reading the archive bytes only once
+
+    The compressed tar stream is written to disk, the sha1 digest and
+    gpg as it is produced. In reproducible mode archives are also kept
+    in archives/store under the digest of their content, an unchanged
+    rule set then reuses the stored archive and signature. Reproducible
+    archives are signed after they are built so that signatures cached
+    by archive digest can be reused. Every key in gpg_keyid signs the
+    archive. Returns the archive path.
+    """
+    level = get_int(config, 'compress_level', 9)
+    workers = get_int(config, 'compress_workers', 1)
+    reproducible = get_bool(config, 'reproducible', False)
+    keyids = get_keyids(config)
+    if level < 0 or level > 9:
+        raise CfgError("The compress_level option must be between 0 and 9")
+    if not keyids:
+        raise CfgError("The gpg_keyid option is required")
+    path = os.path.join(tardir, '%s.tar.gz' % version)
+    # the archive files may be links into the store, never write through
+    for part in (path, '%s.sha1' % path, '%s.asc' % path):
+        if os.path.exists(part):
+            os.unlink(part)
+    stored = None
+    signers = []
+    if reproducible:
+        stored = os.path.join(
+            tardir, 'store',
+            '%s.tar.gz' % archive_key(dest, ' '.join(keyids)))
+        if os.path.exists('%s.sha1' % stored) and \
+                os.path.exists('%s.asc' % stored):
+            info("Reusing archive %s" % stored)
+            link_file(stored, path)
+            link_file('%s.asc' % stored, '%s.asc' % path)
+            write_hash(path, read_hash(stored))
+            return path
+    else:
+        signers = [SignStream(get_signer(config, keyid), path)
+                   for keyid in keyids]
+    hasher = sha1()
+    try:
+        with open(path, 'wb') as handle:
+            package(
+                dest, tardir, version, TeeWriter(handle, [hasher], signers),
+                level, workers, reproducible)
+        digest = hasher.hexdigest()
+        if signers:
+            write_signatures(path, [signer.close() for signer in signers])
         else:
-            deploy = True
-            deploy_file(rulefile, dest)
+            reused = sign_digest(config, path, digest)
+            if reused:
+                info("Reused %d cached signature(s) for %s" % (reused, path))
+    finally:
+        for signer in signers:
+            signer.abort()
+    write_hash(path, digest)
+    if stored is not None:
+        if not os.path.isdir(os.path.dirname(stored)):
+            os.makedirs(os.path.dirname(stored))
+        link_file(path, stored)
+        link_file('%s.asc' % path, '%s.asc' % stored)
+        write_hash(stored, digest)
+    return path
+
+
+def deploy_rule(dest, manifest, rulefile):
+    """Deploy a rule file if it changed
+
+    Returns a (changed, bytes written, error) tuple.
+    """
+    destfile = os.path.join(dest, os.path.basename(rulefile))
+    try:
+        if manifest.check(rulefile) or not os.path.exists(destfile):
+            return True, deploy_file(rulefile, destfile), None
+    except (IOError, OSError) as msg:
+        # deploy may hold a partial copy, make the next run deploy it
+        manifest.invalidate(rulefile)
+        return False, 0, '%s: %s' % (rulefile, msg)
+    return False, 0, None
+
+
+def process(dest, rulefiles, manifest=None, workers=1, stats=None):
+    """process rules
+
+    rulefiles is an iterable of rule file paths, it is consumed as the
+    files are deployed. Returns True if deploy changed, the bytes
+    deployed are added to stats['bytes'] when stats is given.
+    """
+    if manifest is None:
+        manifest = Manifest()
+    deploy = False
+    errors = []
+    for changed, written, msg in parallel_imap(
+            partial(deploy_rule, dest, manifest), rulefiles, workers):
+        deploy = deploy or changed
+        if stats is not None:
+            stats['bytes'] = stats.get('bytes', 0) + written
+        if msg is not None:
+            errors.append(msg)
+    if errors:
+        raise SaChannelUpdateDeployError(errors, deploy)
+    live = set([os.path.basename(path) for path in manifest.seen])
+    for rulefile in manifest.removed():
+        deploy = True
+        manifest.forget(rulefile)
+        destfile = os.path.join(dest, os.path.basename(rulefile))
+        if os.path.basename(rulefile) not in live and \
+                os.path.exists(destfile):
+            os.unlink(destfile)
     return deploy
 
 
 def get_counter(counterfile):
-    """Get the counter value"""
+    """Get the next version number
+
+    The counter is only written once the version has been published.
+    """
     try:
         version_num = open(counterfile).read()
         version_num = int(version_num) + 1
     except (ValueError, IOError):
         version_num = 1
-        create_file(counterfile, "%d" % version_num)
     except BaseException as msg:
         raise SaChannelUpdateError(msg)
     return version_num
 
 
-def update_dns(config, record, sa_version):
-    "Update the DNS record"
-    try:
-        domain = config.get('domain_name', 'sa.baruwa.com.')
-        dns_key = config.get('domain_key')
-        dns_ip = config.get('domain_ip', '127.0.0.1')
-        keyring = tsigkeyring.from_text({domain: dns_key})
-        transaction = update.Update(
-            domain,
-            keyring=keyring,
-            keyalgorithm=tsig.HMAC_SHA512)
-        txtrecord = '%s.%s' % (sa_version, domain)
+def get_sa_versions(config):
+    """Get the list of SpamAssassin versions the channel is published for"""
+    value = config.get('spamassassin_version') or '1.4.3'
+    versions = []
+    for version in value.replace(',', ' ').split():
+        if version not in versions:
+            versions.append(version)
+    return versions
+
+
+KEYRINGS = {}
+KEYRINGS_LOCK = Lock()
+
+
+def get_keyring(domain, dns_key):
+    """Get the parsed TSIG keyring, built once per key"""
+    with KEYRINGS_LOCK:
+        if (domain, dns_key) not in KEYRINGS:
+            KEYRINGS[(domain, dns_key)] = tsigkeyring.from_text(
+                {domain: dns_key})
+        return KEYRINGS[(domain, dns_key)]
+
+
+def get_dns_servers(config):
+    """Get the list of DNS servers to update"""
+    value = config.get('domain_ip') or '127.0.0.1'
+    return value.replace(',', ' ').split()
+
+
+def make_update(config, record, txtrecords):
+    """Build a signed UPDATE replacing the TXT records"""
+    domain = config.get('domain_name', 'sa.baruwa.com.')
+    transaction = update.Update(
+        domain,
+        keyring=get_keyring(domain, config.get('domain_key')),
+        keyalgorithm=tsig.HMAC_SHA512)
+    for txtrecord in txtrecords:
         transaction.replace(txtrecord, 120, 'txt', record)
-        query.tcp(transaction, dns_ip)
-        return True
-    except DNSException, msg:
-        raise SaChannelUpdateDNSError(msg)
+    return transaction
+
+
+def send_update(config, record, txtrecords, timeout, server):
+    """Send the update to one server, returns (rcode or error, seconds)
+
+    Each server gets its own message as signing records the request MAC
+    on the message.
+    """
+    port = get_int(config, 'dns_port', 53)
+    start = time.time()
+    try:
+        response = query.tcp(
+            make_update(config, record, txtrecords), server,
+            timeout=timeout, port=port)
+        result = response.rcode()
+    except (dns_exception.DNSException, socket.error, EOFError) as msg:
+        result = msg
+    return result, time.time() - start
+
+
+def update_dns(config, record, sa_versions):
+    """Update the DNS records of one or more SpamAssassin versions
+
+    All the TXT records are replaced in a single signed UPDATE message,
+    which each server applies atomically. The servers in domain_ip are
+    updated concurrently. Returns a dict mapping each record name to
+    whether every server updated it.
+    """
+    if isinstance(sa_versions, basestring):
+        sa_versions = [sa_versions]
+    domain = config.get('domain_name', 'sa.baruwa.com.')
+    txtrecords = ['%s.%s' % (sa_version, domain)
+                  for sa_version in sa_versions]
+    servers = get_dns_servers(config)
+    timeout = get_int(config, 'dns_timeout', 10)
+    results = parallel_map(
+        partial(send_update, config, record, txtrecords, timeout),
+        servers, len(servers))
+    failed = []
+    for server, (result, elapsed) in zip(servers, results):
+        if isinstance(result, Exception):
+            status = str(result) or result.__class__.__name__
+            failed.append(result)
+        else:
+            status = rcode.to_text(result)
+        info("DNS update via %s: %s in %.3fs" % (server, status, elapsed))
+        if result != rcode.NOERROR:
+            error("DNS update of %s on %s failed: %s" %
+                  (', '.join(txtrecords), server, status))
+    if len(failed) == len(servers):
+        raise SaChannelUpdateDNSError(failed[0])
+    updated = all([result == rcode.NOERROR for result, _ in results])
+    return dict([(txtrecord, updated) for txtrecord in txtrecords])
 
 
 def sign(config, s_filename):
     """sign the package"""
-    gpg_home = config.get('gpg_dir', '/var/lib/sachannelupdate/gnupg')
-    gpg_pass = config.get('gpg_passphrase')
-    gpg_keyid = config.get('gpg_keyid')
-    gpg = GPG(gnupghome=gpg_home)
-    try:
-        plaintext = open(s_filename, 'rb')
-        signature = gpg.sign_file(
-            plaintext, keyid=gpg_keyid, passphrase=gpg_pass, detach=True)
-        with open('%s.asc' % s_filename, 'wb') as handle:
-            handle.write(str(signature))
-    finally:
-        if 'plaintext' in locals():
-            plaintext.close()
+    get_signer(config).sign_file(s_filename)
+
+
+def write_hash(tar_filename, hexdigest):
+    """Write the sha1 file for an archive"""
+    data = HASHTMPL % (hexdigest, os.path.basename(tar_filename))
+    create_file('%s.sha1' % tar_filename, data)
 
 
 def hash_file(tar_filename):
@@ -160,103 +486,232 @@ def hash_file(tar_filename):
         while len(buf) > 0:
             hasher.update(buf)
             buf = afile.read(BLOCKSIZE)
-    data = HASHTMPL % (hasher.hexdigest(), os.path.basename(tar_filename))
-    create_file('%s.sha1' % tar_filename, data)
+    write_hash(tar_filename, hasher.hexdigest())
 
 
 def upload(config, remote_loc, u_filename):
-    """Upload the files"""
-    rcode = False
+    """Upload the files
+
+    Artifacts already on the remote are skipped. The archive is written
+    to a partial file named after its digest, so an interrupted upload
+    resumes where it stopped, and is renamed into place when complete.
+    The sha1 file goes last and marks the set as complete.
+    """
+    result = False
     try:
-        sftp, transport = get_sftp_conn(config)
-        remote_dir = get_remote_path(remote_loc)
-        for part in ['sha1', 'asc']:
-            local_file = '%s.%s' % (u_filename, part)
-            remote_file = os.path.join(remote_dir, local_file)
-            sftp.put(local_file, remote_file)
-        sftp.put(remote_dir, os.path.join(remote_dir, u_filename))
-        rcode = True
-    except BaseException:
-        pass
-    finally:
-        if 'transport' in locals():
-            transport.close()
-    return rcode
+        remote_dir = transports.get_remote_path(remote_loc)
+        remote_tar = os.path.join(remote_dir, os.path.basename(u_filename))
+        digest = read_hash(u_filename)
+        blocksize = get_int(
+            config, 'sftp_block_size', transports.BLOCKSIZE)
+        with transports.sftp_session(config, remote_loc) as sftp:
+            if not (transports.same_size(sftp, u_filename, remote_tar) and
+                    transports.same_file(sftp, '%s.sha1' % u_filename,
+                                         '%s.sha1' % remote_tar)):
+                transfer = transports.put_file(
+                    sftp, u_filename, remote_tar,
+                    '%s.%s.part' % (remote_tar, digest), resume=True,
+                    blocksize=blocksize)
+                info("Sent %s" % transfer)
+            for part in ['asc', 'sha1']:
+                local_file = '%s.%s' % (u_filename, part)
+                remote_file = '%s.%s' % (remote_tar, part)
+                if not transports.same_file(sftp, local_file, remote_file):
+                    transports.put_file(
+                        sftp, local_file, remote_file,
+                        '%s.part' % remote_file)
+        result = True
+    except BaseException as msg:
+        error("Upload to %s failed: %s" % (remote_loc, msg))
+    return result
+
+
+def get_remote_locations(config):
+    """Get the list of remote locations"""
+    value = config.get('remote_location') or ''
+    return value.replace(',', ' ').split()
+
 
+def upload_mirrors(config, u_filename):
+    """Upload the files to all the mirrors concurrently
 
-def queue_files(dirpath, queue):
-    """Add files in a directory to a queue"""
-    for root, _, files in os.walk(os.path.abspath(dirpath)):
-        if not files:
-            continue
-        for filename in files:
-            queue.put(os.path.join(root, filename))
+    Returns a dict mapping each remote location to the upload result.
+    """
+    remotes = get_remote_locations(config)
+    workers = get_int(config, 'upload_workers', len(remotes))
+    results = parallel_map(
+        lambda remote: upload(config, remote, u_filename), remotes, workers)
+    for remote, result in zip(remotes, results):
+        if result:
+            info("Uploaded %s to %s" % (u_filename, remote))
+    return dict(zip(remotes, results))
 
 
-def get_cf_files(path, queue):
-    """Get rule files in a directory and put them in a queue"""
-    for root, _, files in os.walk(os.path.abspath(path)):
-        if not files:
-            continue
-        for filename in files:
-            fullname = os.path.join(root, filename)
-            if os.path.isfile(fullname) and fullname.endswith('.cf') or \
-                    fullname.endswith('.post'):
-                queue.put(fullname)
+def get_quorum(config):
+    """Get the number of mirror uploads needed to update the DNS"""
+    mirrors = len(get_remote_locations(config))
+    quorum = get_int(config, 'upload_quorum', mirrors)
+    if quorum < 1 or quorum > mirrors:
+        raise CfgError(
+            "The upload_quorum option must be between 1 and %d" % mirrors)
+    return quorum
 
 
-def cleanup(dest, tardir, counterfile):
+def get_cf_files(path, rule_filter=None):
+    """Lazily yield the rule files below a directory
+
+    Without a rule_filter the *.cf and *.post files are used and hidden
+    files and directories are skipped.
+    """
+    if rule_filter is None:
+        rule_filter = RuleFilter()
+    return iter_files(path, rule_filter)
+
+
+def cleanup(dest, tardir, counterfile, manifestfile=None,
+            snapshotfile=None, pendingfile=None):
     """Remove existing rules"""
-    thefiles = Queue()
-    # dest directory files
-    queue_files(dest, thefiles)
-    # tar directory files
-    queue_files(tardir, thefiles)
-    while not thefiles.empty():
-        d_file = thefiles.get()
-        info("Deleting file: %s" % d_file)
-        os.unlink(d_file)
+    for dirname in (dest, tardir):
+        for d_file in iter_files(dirname):
+            info("Deleting file: %s" % d_file)
+            os.unlink(d_file)
     if os.path.exists(counterfile):
         info("Deleting the counter file %s" % counterfile)
         os.unlink(counterfile)
+    if manifestfile and os.path.exists(manifestfile):
+        info("Deleting the manifest file %s" % manifestfile)
+        os.unlink(manifestfile)
+    if snapshotfile and os.path.exists(snapshotfile):
+        info("Deleting the snapshot file %s" % snapshotfile)
+        os.unlink(snapshotfile)
+    if pendingfile and os.path.exists(pendingfile):
+        info("Deleting the pending file %s" % pendingfile)
+        os.unlink(pendingfile)
 
 
 def check_required(config):
     """Validate the input"""
     if config.get('domain_key') is None:
         raise CfgError("The domain_key option is required")
-    if config.get('remote_loc') is None:
+    if not get_remote_locations(config):
         raise CfgError("The remote_location option is required")
     if config.get('gpg_keyid') is None:
         raise CfgError("The gpg_keyid option is required")
 
 
-def entry(config, delete_files=None):
-    """Main function"""
+def entry(config, delete_files=None, rulefiles=None, lock_wait=None):
+    """Main function
+
+    rulefiles is an index of the rule files to use instead of walking
+    the rules directory. Returns a dict with the status of the run,
+    one of deleted, unchanged, published, failed or locked, and the
+    version. The duration, bytes and file counts of each stage are
+    written to metrics_log and metrics_textfile when they are set.
+
+    A run holds home_dir/db/lock, an overlapping run returns locked
+    unless lock_wait, which defaults to the lock_wait option, makes it
+    queue behind the current one.
+    """
+    home_dir = config.get('home_dir', '/var/lib/sachannelupdate')
+    if lock_wait is None:
+        lock_wait = get_bool(config, 'lock_wait', False)
+    try:
+        with run_lock(os.path.join(home_dir, 'db', 'lock'), lock_wait):
+            metrics = Metrics(config.get('channel'))
+            result = dict(status='failed', version=None)
+            try:
+                result = publish(config, metrics, delete_files, rulefiles)
+                return result
+            finally:
+                metrics.finish(result['status'], result['version'])
+                export_metrics(config, metrics)
+    except SaChannelUpdateLockError as msg:
+        info(msg)
+        return dict(status='locked', version=None)
+
+
+def publish(config, metrics, delete_files=None, rulefiles=None):
+    """Run the pipeline, recording each stage in metrics"""
     home_dir = config.get('home_dir', '/var/lib/sachannelupdate')
-    dns_ver = config.get('spamassassin_version', '1.4.3')
-    remote_loc = config.get('remote_location')
+    dns_vers = get_sa_versions(config)
+    workers = get_int(config, 'deploy_workers', 1)
     rule_dir = os.path.join(home_dir, 'rules')
     dest = os.path.join(home_dir, 'deploy')
     tardir = os.path.join(home_dir, 'archives')
     counterfile = os.path.join(home_dir, 'db', 'counters')
+    manifestfile = os.path.join(home_dir, 'db', 'manifest')
+    snapshotfile = os.path.join(home_dir, 'db', 'snapshot')
+    pendingfile = os.path.join(home_dir, 'db', 'pending')
 
     check_required(config)
+    quorum = get_quorum(config)
 
     if delete_files:
-        cleanup(dest, tardir, counterfile)
-        return
-
-    cffiles = Queue()
-    get_cf_files(rule_dir, cffiles)
-
-    if process(dest, cffiles):
-        version = get_counter(counterfile)
-        filename = '%s.tar.gz' % version
-        path = os.path.join(tardir, filename)
-        package(dest, tardir, version)
-        sign(config, path)
-        hash_file(path)
-        if upload(config, remote_loc, path):
-            if update_dns(config, str(version), dns_ver):
-                create_file(counterfile, "%d" % version)
+        with metrics.stage('cleanup'):
+            cleanup(dest, tardir, counterfile, manifestfile, snapshotfile,
+                    pendingfile)
+        return dict(status='deleted', version=None)
+
+    # the manifest records what is in deploy, pending is set while that
+    # differs from the last published version
+    pending = os.path.exists(pendingfile)
+    snapshot = None
+    if rulefiles is None:
+        rule_filter = get_rule_filter(config)
+        if get_bool(config, 'rules_snapshot', False):
+            with metrics.stage('snapshot') as stage:
+                snapshot = Snapshot(
+                    snapshotfile, snapshot_key(rule_dir, rule_filter))
+                stage['files'] = len(snapshot.dirs)
+                unchanged = snapshot.unchanged(dest)
+            if unchanged and not pending:
+                return dict(status='unchanged', version=None)
+            rulefiles = snapshot.iter_files(rule_dir, rule_filter)
+        else:
+            rulefiles = get_cf_files(rule_dir, rule_filter)
+
+    manifest = Manifest(manifestfile)
+    # discovery is lazy, its time is part of the process stage
+    with metrics.stage('process') as stage:
+        try:
+            changed = process(dest, rulefiles, manifest, workers, stage)
+        except SaChannelUpdateDeployError as msg:
+            # the files that did deploy still have to be published
+            if msg.changed:
+                mark_pending(pendingfile)
+            manifest.save()
+            raise
+        stage['files'] = len(manifest.seen)
+    if changed:
+        mark_pending(pendingfile)
+    manifest.save()
+    if not changed and not pending:
+        if snapshot is not None:
+            snapshot.save(dest)
+        return dict(status='unchanged', version=None)
+    version = get_counter(counterfile)
+    with metrics.stage('build') as stage:
+        path = build_archive(config, dest, tardir, version)
+        stage['bytes'] = os.path.getsize(path)
+        stage['files'] = len(manifest.seen)
+    with metrics.stage('upload') as stage:
+        results = upload_mirrors(config, path)
+        uploaded = len([result for result in results.values() if result])
+        stage['bytes'] = os.path.getsize(path) * uploaded
+        stage['files'] = uploaded
+        stage['ok'] = uploaded >= quorum
+    if uploaded < quorum:
+        error("Uploaded to %d of %d mirrors, a quorum of %d is needed" %
+              (uploaded, len(results), quorum))
+        return dict(status='failed', version=version)
+    with metrics.stage('dns') as stage:
+        updated = update_dns(config, str(version), dns_vers)
+        stage['files'] = len(updated)
+        stage['ok'] = all(updated.values())
+    if stage['ok']:
+        replace_file(counterfile, "%d" % version)
+        clear_pending(pendingfile)
+        if snapshot is not None:
+            snapshot.save(dest)
+        return dict(status='published', version=version)
+    return dict(status='failed', version=version)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Publish several channels from one process
+"""
+import os
+import time
+import posixpath
+
+from urlparse import urlparse
+from functools import partial
+from threading import Thread
+
+from sachannelupdate.base import entry, get_remote_locations
+from sachannelupdate.utils import info, error, get_int, parallel_map, \
+    LazyModule
+from sachannelupdate.exceptions import SaChannelUpdateConfigError
+
+CHANNEL_PREFIX = 'channel:'
+
+# inotify is only set up in watch mode
+watcher = LazyModule('sachannelupdate.watch')
+
+
+def get_section(config, section):
+    """Return the options of a ConfigParser section as a dict"""
+    # pylint: disable=protected-access
+    options = dict(config._sections[section])
+    options.pop('__name__', None)
+    return options
+
+
+def get_channels(config):
+    """Get the channels in a ConfigParser as (name, settings) pairs
+
+    [settings] holds the defaults of every [channel:NAME] section. A
+    channel keeps its files in <home_dir>/<NAME> unless it sets its own
+    home_dir, likewise a metrics_textfile from [settings] gets the name
+    added. Without channel sections [settings] is the only channel,
+    named None.
+    """
+    settings = {}
+    if config.has_section('settings'):
+        settings = get_section(config, 'settings')
+    channels = []
+    for section in config.sections():
+        if not section.startswith(CHANNEL_PREFIX):
+            continue
+        name = section[len(CHANNEL_PREFIX):].strip()
+        channel = dict(settings)
+        channel['channel'] = name
+        channel['home_dir'] = os.path.join(
+            settings.get('home_dir', '/var/lib/sachannelupdate'), name)
+        if settings.get('metrics_textfile'):
+            root, ext = os.path.splitext(settings['metrics_textfile'])
+            channel['metrics_textfile'] = '%s-%s%s' % (root, name, ext)
+        channel.update(get_section(config, section))
+        channels.append((name, channel))
+    check_channels(channels)
+    if not channels:
+        if not config.has_section('settings'):
+            raise SaChannelUpdateConfigError(
+                "No [settings] or [channel:NAME] sections are configured")
+        channels.append((None, settings))
+    return channels
+
+
+def remote_key(remote):
+    """Return the host, port and path a remote location uploads to"""
+    parts = urlparse(remote)
+    return ((parts.hostname or '').lower(), parts.port or 22,
+            posixpath.normpath(parts.path or '/'))
+
+
+def check_channels(channels):
+    """Reject channels that would publish over each other
+
+    Every channel counts its versions from 1, two channels uploading to
+    the same mirror path or updating the same DNS records would
+    overwrite each other's archives and TXT records.
+    """
+    domains = {}
+    remotes = {}
+    for name, config in channels:
+        domain = config.get('domain_name', 'sa.baruwa.com.')
+        domain = domain.lower().rstrip('.')
+        if domain in domains:
+            raise SaChannelUpdateConfigError(
+                "Channels %s and %s both use the domain_name %s" %
+                (domains[domain], name, domain))
+        domains[domain] = name
+        for remote in get_remote_locations(config):
+            key = remote_key(remote)
+            if key in remotes and remotes[key] != name:
+                raise SaChannelUpdateConfigError(
+                    "Channels %s and %s both upload to %s" %
+                    (remotes[key], name, remote))
+            remotes[key] = name
+
+
+def run_channel(delete_files, channel):
+    """Run the pipeline for one channel, returns (name, result)"""
+    name, config = channel
+    try:
+        return name, entry(config, delete_files)
+    except Exception as msg:  # pylint: disable=broad-except
+        if name is None:
+            error(msg)
+        else:
+            error("Channel %s: %s" % (name, msg))
+        return name, dict(status='failed', version=None, error=str(msg))
+
+
+def run_channels(channels, delete_files=None, workers=1):
+    """Run the channels on a thread pool, returns a dict of results
+
+    The channels share the SFTP connection pool, the gpg signers and the
+    DNS keyrings, which are kept per process.
+    """
+    results = dict(parallel_map(
+        partial(run_channel, delete_files), channels, workers))
+    for name, _ in channels:
+        if name is not None:
+            result = results[name]
+            info("Channel %s: %s%s" % (
+                name, result['status'],
+                '' if result['version'] is None
+                else ' version %d' % result['version']))
+    return results
+
+
+def watch_channel(channel):
+    """Watch one channel, logging the failure that stops it"""
+    name, config = channel
+    try:
+        watcher.watch(config)
+    except Exception as msg:  # pylint: disable=broad-except
+        error("Channel %s: %s" % (name, msg))
+
+
+def watch_channels(channels):
+    """Watch every channel, each in its own thread"""
+    if len(channels) == 1:
+        watcher.watch(channels[0][1])
+        return
+    threads = []
+    for channel in channels:
+        thread = Thread(target=watch_channel, args=(channel,))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    # poll rather than join so that signals are still delivered
+    while [thread for thread in threads if thread.is_alive()]:
+        time.sleep(1)
+
+
+def get_channel_workers(config, channels):
+    """Get the number of channels to run at once"""
+    settings = {}
+    if config.has_section('settings'):
+        settings = get_section(config, 'settings')
+    return get_int(settings, 'channel_workers', len(channels))
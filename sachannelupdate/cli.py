@@ -23,7 +23,19 @@ import os
 from optparse import OptionParser
 from ConfigParser import ConfigParser
 
-from sachannelupdate import entry, error, SaChannelUpdateConfigError
+from sachannelupdate import error, SaChannelUpdateConfigError
+from sachannelupdate.channels import get_channels, get_channel_workers, \
+    get_section, run_channels, watch_channels
+from sachannelupdate.profiling import run_profiled
+
+
+def get_db_dir(config):
+    """Get the db directory of the top level home_dir"""
+    settings = {}
+    if config.has_section('settings'):
+        settings = get_section(config, 'settings')
+    return os.path.join(
+        settings.get('home_dir', '/var/lib/sachannelupdate'), 'db')
 
 
 def main():
@@ -41,6 +53,24 @@ def main():
         dest='cleanup',
         action="store_true",
         default=False,)
+    parser.add_option(
+        '-w', '--watch',
+        help='Keep running and publish whenever the rules change',
+        dest='watch',
+        action="store_true",
+        default=False,)
+    parser.add_option(
+        '--profile',
+        help='Profile the run, writes a pstats dump to home_dir/db',
+        dest='profile',
+        action="store_true",
+        default=False,)
+    parser.add_option(
+        '--trace-memory',
+        help='Report the top allocation sites to home_dir/db',
+        dest='trace_memory',
+        action="store_true",
+        default=False,)
     options, _ = parser.parse_args()
     if not os.path.isfile(options.filename):
         raise SaChannelUpdateConfigError(
@@ -49,7 +79,21 @@ def main():
     config = ConfigParser()
     config.read(options.filename)
     try:
-        # pylint: disable=protected-access
-        entry(config._sections['settings'], options.cleanup)
+        channels = get_channels(config)
+        if options.watch and not options.cleanup:
+            func, args = watch_channels, (channels,)
+        else:
+            # cProfile only sees the calling thread, profiled runs
+            # publish the channels one after the other
+            workers = 1
+            if not options.profile:
+                workers = get_channel_workers(config, channels)
+            func, args = run_channels, (channels, options.cleanup, workers)
+        if options.profile or options.trace_memory:
+            run_profiled(
+                func, args, get_db_dir(config), options.profile,
+                options.trace_memory)
+        else:
+            func(*args)
     except BaseException as msg:
         error(msg)
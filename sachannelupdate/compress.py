@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Parallel gzip compression
+"""
+import zlib
+import time
+import struct
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+BLOCKSIZE = 131072
+GZIP_MAGIC = '\037\213'
+
+
+def compress_block(data, level, last):
+    """Compress a block to raw deflate data
+
+    Blocks other than the last end with a sync flush so that the
+    independently compressed blocks join into a single deflate stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def gzip_header(level, mtime):
+    """Return a gzip member header"""
+    if level == 9:
+        xfl = 2
+    elif level == 1:
+        xfl = 4
+    else:
+        xfl = 0
+    return GZIP_MAGIC + struct.pack(
+        '<BBIBB', 8, 0, int(mtime) & 0xffffffff, xfl, 255)
+
+
+class GzipWriter(object):
+    """Write only gzip file object that compresses blocks on a thread pool
+
+    zlib releases the GIL while compressing, so the blocks compress in
+    parallel much like pigz. The output is a single gzip member that any
+    gzip reader can consume. With workers <= 1 the data is compressed
+    in order with one compressor.
+    """
+    def __init__(self, fileobj, level=9, workers=1, blocksize=BLOCKSIZE,
+                 mtime=None):
+        """Init"""
+        self.fileobj = fileobj
+        self.level = level
+        self.workers = workers
+        self.blocksize = blocksize
+        self.crc = zlib.crc32('') & 0xffffffff
+        self.size = 0
+        self.buf = []
+        self.buflen = 0
+        self.pending = deque()
+        self.closed = False
+        self.pool = None
+        self.compressor = None
+        if mtime is None:
+            mtime = time.time()
+        self.fileobj.write(gzip_header(level, mtime))
+        # the pool is only started once the header is out, a failed
+        # header write leaves no threads behind
+        if workers > 1:
+            self.pool = ThreadPool(workers)
+        else:
+            self.compressor = zlib.compressobj(
+                level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def _drain(self, wait=False):
+        """Write out compressed blocks in order"""
+        while self.pending and (
+                wait or self.pending[0].ready() or
+                len(self.pending) > self.workers * 2):
+            self.fileobj.write(self.pending.popleft().get())
+
+    def _submit(self, data, last=False):
+        """Queue a block for compression"""
+        self.pending.append(self.pool.apply_async(
+            compress_block, (data, self.level, last)))
+        self._drain()
+
+    def write(self, data):
+        """Compress data"""
+        if not data:
+            return
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        if self.pool is None:
+            self.fileobj.write(self.compressor.compress(data))
+            return
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.blocksize:
+            data = ''.join(self.buf)
+            end = len(data) - len(data) % self.blocksize
+            for offset in xrange(0, end, self.blocksize):
+                self._submit(data[offset:offset + self.blocksize])
+            self.buf = [data[end:]]
+            self.buflen = len(data) - end
+
+    def tell(self):
+        """Return the number of uncompressed bytes written"""
+        return self.size
+
+    def flush(self):
+        """Flushing would break up the blocks, it is a no-op"""
+        pass
+
+    def abort(self):
+        """Stop the compression threads without finishing the member
+
+        Does nothing once the writer is closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.pending.clear()
+
+    def close(self):
+        """Finish the gzip member, the underlying file is not closed"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.pool is None:
+            self.fileobj.write(self.compressor.flush(zlib.Z_FINISH))
+        else:
+            try:
+                self._submit(''.join(self.buf), True)
+                self._drain(True)
+            finally:
+                self.pool.close()
+                self.pool.join()
+        self.fileobj.write(
+            struct.pack('<II', self.crc, self.size & 0xffffffff))
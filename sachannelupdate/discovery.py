@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Rule discovery
+"""
+import os
+import stat
+
+from fnmatch import fnmatch
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+RULE_PATTERNS = ('*.cf', '*.post')
+IGNORE_PATTERNS = ('.*',)
+
+
+def matches(name, relpath, patterns):
+    """Check if a file matches any of the glob patterns
+
+    Patterns with a / match the path relative to the top directory, the
+    others match the name.
+    """
+    for pattern in patterns:
+        if fnmatch(relpath if '/' in pattern else name, pattern):
+            return True
+    return False
+
+
+class RuleFilter(object):
+    """Include and exclude globs, excluded directories are pruned"""
+    def __init__(self, include=RULE_PATTERNS, exclude=IGNORE_PATTERNS):
+        """Init"""
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+
+    def include_dir(self, name, relpath):
+        """Check if a directory should be walked"""
+        return not matches(name, relpath, self.exclude)
+
+    def include_file(self, name, relpath):
+        """Check if a file should be used"""
+        return matches(name, relpath, self.include) and \
+            not matches(name, relpath, self.exclude)
+
+
+ALL_FILES = RuleFilter(('*',), ())
+
+
+def get_patterns(config, option, default):
+    """Get a list of glob patterns from the config"""
+    value = config.get(option)
+    if value is None:
+        return default
+    return tuple(value.replace(',', ' ').split())
+
+
+def get_rule_filter(config):
+    """Get the filter for the files in the rules directory"""
+    return RuleFilter(
+        get_patterns(config, 'rules_include', RULE_PATTERNS),
+        get_patterns(config, 'rules_exclude', IGNORE_PATTERNS))
+
+
+def list_dir(path):
+    """Yield (name, is_dir, is_file) for the entries of a directory
+
+    Symlinks to files count as files, symlinks to directories are not
+    followed. scandir gets the file types from the directory listing,
+    without it each entry is stat'ed once.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_file = not is_dir and entry.is_file()
+            except OSError:
+                continue
+            yield entry.name, is_dir, is_file
+        return
+    for name in os.listdir(path):
+        fullname = os.path.join(path, name)
+        try:
+            mode = os.lstat(fullname).st_mode
+            is_dir = stat.S_ISDIR(mode)
+            if stat.S_ISLNK(mode):
+                mode = os.stat(fullname).st_mode
+            is_file = stat.S_ISREG(mode)
+        except OSError:
+            continue
+        yield name, is_dir, is_file
+
+
+def read_dir(root, relroot, rule_filter=ALL_FILES):
+    """Return the names of the subdirectories and files in a directory
+    accepted by rule_filter, relroot is its path below the top"""
+    subdirs = []
+    files = []
+    for name, is_dir, is_file in list_dir(root):
+        relpath = '%s/%s' % (relroot, name) if relroot else name
+        if is_dir:
+            if rule_filter.include_dir(name, relpath):
+                subdirs.append(name)
+        elif is_file and rule_filter.include_file(name, relpath):
+            files.append(name)
+    return subdirs, files
+
+
+def iter_files(path, rule_filter=ALL_FILES):
+    """Yield the paths of the files below path accepted by rule_filter
+
+    The tree is walked top down without recursion, only the directories
+    still to be listed are held in memory, so the memory used does not
+    grow with the number of files. Directories that cannot be listed are
+    skipped like os.walk does.
+    """
+    pending = [('', os.path.abspath(path))]
+    while pending:
+        relroot, root = pending.pop()
+        subdirs = []
+        try:
+            for name, is_dir, is_file in list_dir(root):
+                relpath = '%s/%s' % (relroot, name) if relroot else name
+                if is_dir:
+                    if rule_filter.include_dir(name, relpath):
+                        subdirs.append((relpath, os.path.join(root, name)))
+                elif is_file and rule_filter.include_file(name, relpath):
+                    yield os.path.join(root, name)
+        except OSError:
+            continue
+        pending.extend(reversed(subdirs))
@@ -32,6 +32,20 @@ class SaChannelUpdateConfigError(SaChannelUpdateError):
     pass
 
 
+class SaChannelUpdateDeployError(SaChannelUpdateError):
+    """Deployment Exceptions
+
+    changed is set when other files were deployed before the failures.
+    """
+    def __init__(self, errors, changed=False):
+        """Init"""
+        self.errors = errors
+        self.changed = changed
+        message = "Failed to deploy %d file(s): %s" % (
+            len(errors), '; '.join(errors))
+        super(SaChannelUpdateDeployError, self).__init__(message)
+
+
 class SaChannelUpdateDNSError(SaChannelUpdateError):
     """DNS Exceptions"""
     pass
@@ -40,3 +54,8 @@ class SaChannelUpdateDNSError(SaChannelUpdateError):
 class SaChannelUpdateTransportError(SaChannelUpdateError):
     """Transport Exceptions"""
     pass
+
+
+class SaChannelUpdateLockError(SaChannelUpdateError):
+    """Run lock Exceptions"""
+    pass
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Run lock
+"""
+import os
+import errno
+import fcntl
+
+from contextlib import contextmanager
+
+from sachannelupdate.exceptions import SaChannelUpdateLockError
+
+
+@contextmanager
+def run_lock(lockfile, wait=False):
+    """Hold an exclusive lock on lockfile for the duration of a run
+
+    The lock is an flock on an open file, the kernel drops it when the
+    process exits so a crashed run never leaves a stale lock behind.
+    Raises SaChannelUpdateLockError if another run holds the lock and
+    wait is False, otherwise blocks until it is released.
+    """
+    dirname = os.path.dirname(lockfile)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as msg:
+            if msg.errno != errno.EEXIST:
+                raise
+    handle = open(lockfile, 'a')
+    try:
+        flags = fcntl.LOCK_EX
+        if not wait:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(handle.fileno(), flags)
+        except IOError as msg:
+            if msg.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise SaChannelUpdateLockError(
+                "Another run holds the lock %s" % lockfile)
+        yield
+    finally:
+        handle.close()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Rule file manifest
+"""
+import os
+import json
+
+from hashlib import sha1
+from threading import Lock
+
+BLOCKSIZE = 65536
+
+
+def file_digest(filename):
+    """Return the sha1 hex digest of a file"""
+    hasher = sha1()
+    with open(filename, 'rb') as handle:
+        buf = handle.read(BLOCKSIZE)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = handle.read(BLOCKSIZE)
+    return hasher.hexdigest()
+
+
+class Manifest(object):
+    """Persistent record of the size, mtime and digest of rule files
+
+    Entries map a rule file path to [size, mtime, digest]. A file is only
+    read and hashed when its size or mtime differ from the recorded ones.
+    A manifest without a filename lives in memory only.
+    """
+    def __init__(self, filename=None):
+        """Init"""
+        self.filename = filename
+        self.entries = {}
+        self.seen = set()
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        """Load the manifest from disk"""
+        self.entries = {}
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename) as handle:
+                entries = json.load(handle)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        """Write the manifest to disk"""
+        if self.filename is None:
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with self.lock:
+            data = json.dumps(self.entries, sort_keys=True)
+        # a crash mid write must not leave a truncated manifest behind
+        tmpname = '%s.tmp' % self.filename
+        with open(tmpname, 'w') as handle:
+            handle.write(data)
+        os.rename(tmpname, self.filename)
+
+    def check(self, path):
+        """Record path as seen, return True if its content changed"""
+        fstat = os.stat(path)
+        with self.lock:
+            self.seen.add(path)
+            entry = self.entries.get(path)
+        if entry is not None and entry[0] == fstat.st_size and \
+                entry[1] == fstat.st_mtime:
+            return False
+        digest = file_digest(path)
+        with self.lock:
+            self.entries[path] = [fstat.st_size, fstat.st_mtime, digest]
+        return entry is None or entry[2] != digest
+
+    def removed(self):
+        """Return the recorded paths that were not seen in this run"""
+        with self.lock:
+            return sorted(
+                [path for path in self.entries if path not in self.seen])
+
+    def invalidate(self, path):
+        """Make the next check of path report it as changed"""
+        with self.lock:
+            self.entries[path] = [None, None, None]
+
+    def forget(self, path):
+        """Drop a path from the manifest"""
+        with self.lock:
+            self.entries.pop(path, None)
+            self.seen.discard(path)
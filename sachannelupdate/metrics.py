@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Publish metrics
+"""
+import os
+import json
+import time
+
+from threading import Lock
+from contextlib import contextmanager
+
+from sachannelupdate.utils import error
+
+PREFIX = 'sachannelupdate'
+STATUSES = ('deleted', 'unchanged', 'published', 'failed')
+LOG_LOCK = Lock()
+
+
+class Metrics(object):
+    """Duration, bytes and file counts of the stages of a run"""
+    def __init__(self, channel=None):
+        """Init"""
+        self.channel = channel
+        self.started = time.time()
+        self.seconds = 0.0
+        self.stages = []
+        self.status = None
+        self.version = None
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage, yields a dict to record bytes and files in
+
+        The stage is ok unless it raises or the caller sets ok.
+        """
+        record = dict(name=name, seconds=0.0, bytes=0, files=0, ok=None)
+        self.stages.append(record)
+        start = time.time()
+        try:
+            yield record
+        except BaseException:
+            record['ok'] = False
+            raise
+        finally:
+            record['seconds'] = time.time() - start
+        if record['ok'] is None:
+            record['ok'] = True
+
+    def finish(self, status, version=None):
+        """Record the outcome of the run"""
+        self.status = status
+        self.version = version
+        self.seconds = time.time() - self.started
+
+    def to_dict(self):
+        """Return the metrics as a dict"""
+        return dict(
+            timestamp=self.started, channel=self.channel,
+            status=self.status, version=self.version,
+            seconds=self.seconds, stages=self.stages)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text format"""
+        lines = []
+        for metric, key, fmt, text in (
+                ('stage_duration_seconds', 'seconds', '%.6f',
+                 'Time spent in each stage of the last run.'),
+                ('stage_bytes', 'bytes', '%d',
+                 'Bytes handled by each stage of the last run.'),
+                ('stage_files', 'files', '%d',
+                 'Files handled by each stage of the last run.'),
+                ('stage_ok', 'ok', '%d',
+                 'Whether each stage of the last run succeeded.')):
+            add_metric(lines, metric, text, [
+                (labels(channel=self.channel, stage=record['name']),
+                 fmt % record[key]) for record in self.stages])
+        add_metric(
+            lines, 'run_duration_seconds', 'Duration of the last run.',
+            [(labels(channel=self.channel), '%.6f' % self.seconds)])
+        add_metric(
+            lines, 'run_timestamp_seconds', 'Start time of the last run.',
+            [(labels(channel=self.channel), '%.3f' % self.started)])
+        add_metric(
+            lines, 'run_status', 'Outcome of the last run.',
+            [(labels(channel=self.channel, status=status),
+              '%d' % (status == self.status)) for status in STATUSES])
+        if self.version is not None:
+            add_metric(
+                lines, 'version', 'Version built by the last run.',
+                [(labels(channel=self.channel), '%d' % self.version)])
+        return ''.join(['%s\n' % line for line in lines])
+
+
+def labels(**kwargs):
+    """Format Prometheus labels, skipping those that are None"""
+    pairs = []
+    for name in sorted(kwargs):
+        if kwargs[name] is None:
+            continue
+        value = str(kwargs[name]).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def add_metric(lines, metric, text, samples):
+    """Add a gauge and its samples to lines"""
+    if not samples:
+        return
+    name = '%s_%s' % (PREFIX, metric)
+    lines.append('# HELP %s %s' % (name, text))
+    lines.append('# TYPE %s gauge' % name)
+    for sample_labels, value in samples:
+        lines.append('%s%s %s' % (name, sample_labels, value))
+
+
+def write_log(filename, metrics):
+    """Append the metrics to a JSON lines file"""
+    data = json.dumps(metrics.to_dict(), sort_keys=True)
+    with LOG_LOCK:
+        with open(filename, 'a') as handle:
+            handle.write('%s\n' % data)
+
+
+def write_textfile(filename, metrics):
+    """Atomically write the metrics for the textfile collector"""
+    tmpname = '%s.tmp' % filename
+    with open(tmpname, 'w') as handle:
+        handle.write(metrics.to_prometheus())
+    os.rename(tmpname, filename)
+
+
+def export_metrics(config, metrics):
+    """Write the metrics to metrics_log and metrics_textfile
+
+    Failing to write metrics is logged and never fails the run.
+    """
+    for option, writer in (('metrics_log', write_log),
+                           ('metrics_textfile', write_textfile)):
+        filename = config.get(option)
+        if not filename:
+            continue
+        try:
+            writer(filename, metrics)
+        except (IOError, OSError) as msg:
+            error("Writing metrics to %s failed: %s" % (filename, msg))
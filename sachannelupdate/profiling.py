@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Profiling
+"""
+import os
+import time
+import pstats
+import cProfile
+
+from sachannelupdate.utils import error
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 needs the pytracemalloc patched interpreter
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TOP_N = 20
+
+
+def report_name(dirname, kind, ext):
+    """Return a report file name unique to this run"""
+    return os.path.join(dirname, '%s-%s-%d.%s' % (
+        kind, time.strftime('%Y%m%d%H%M%S'), os.getpid(), ext))
+
+
+def max_rss():
+    """Return the peak resident set size in kilobytes, None if unknown"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def top_functions(stats, limit):
+    """Return the limit functions with the most cumulative time"""
+    # pylint: disable=no-member
+    rows = sorted(
+        stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return ['%9.3fs %9.3fs %s:%d(%s)' % (
+        row[3], row[2], func[0], func[1], func[2])
+        for func, row in rows[:limit]]
+
+
+def report_profile(profiler, dirname, limit):
+    """Dump the pstats data and summarise the slowest functions"""
+    path = report_name(dirname, 'profile', 'pstats')
+    profiler.dump_stats(path)
+    stats = pstats.Stats(path)
+    error("Profile written to %s, %d calls in %.3fs" % (
+        path, stats.total_calls, stats.total_tt))  # pylint: disable=no-member
+    error("%10s %10s %s" % ('cumulative', 'own', 'function'))
+    for line in top_functions(stats, limit):
+        error(line)
+
+
+def report_memory(dirname, limit, rss_before):
+    """Write and summarise the top allocation sites
+
+    Without tracemalloc only the peak resident set size is reported.
+    """
+    path = report_name(dirname, 'memory', 'txt')
+    lines = []
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        lines.append('traced memory: %d bytes, peak %d bytes' % (
+            current, peak))
+        lines.extend([
+            str(stat) for stat in snapshot.statistics('lineno')[:limit]])
+    else:
+        lines.append('tracemalloc is not available, allocation sites '
+                     'are not traced')
+    rss = max_rss()
+    if rss is not None:
+        lines.append('max rss: %d kB, %d kB at start' % (rss, rss_before))
+    with open(path, 'w') as handle:
+        handle.write(''.join(['%s\n' % line for line in lines]))
+    error("Memory report written to %s" % path)
+    for line in lines[:limit + 2]:
+        error(line)
+
+
+def run_profiled(func, args, dirname, profile=False, trace_memory=False,
+                 limit=TOP_N):
+    """Call func(*args) under cProfile and or tracemalloc
+
+    The reports are written to dirname and summarised on stderr, also
+    when func raises. cProfile only sees the calling thread, the work
+    done on upload and DNS worker threads shows up as time spent
+    waiting on them.
+    """
+    profiler = None
+    rss_before = max_rss()
+    if trace_memory and tracemalloc is not None:
+        tracemalloc.start()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            if profiler is not None:
+                report_profile(profiler, dirname, limit)
+            if trace_memory:
+                report_memory(dirname, limit, rss_before)
+        except (IOError, OSError) as msg:
+            error("Writing the profiling reports failed: %s" % msg)
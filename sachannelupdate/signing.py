@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Signing
+"""
+import os
+import re
+import fcntl
+
+from threading import Thread, Lock
+
+from sachannelupdate.utils import parallel_map, LazyModule
+from sachannelupdate.exceptions import SaChannelUpdateError
+
+gnupg = LazyModule('gnupg')
+
+KEYID_CHARS = re.compile(r'[^0-9A-Za-z]')
+
+
+class Signer(object):
+    """Signs files with a gpg key
+
+    A signer is created once per process by get_signer and shared by
+    every signature made in the process, so the keyring is only opened
+    once and gpg-agent keeps the unlocked key cached between signatures.
+    """
+    def __init__(self, gpg_home, keyid, passphrase=None):
+        """Init"""
+        self.gpg = gnupg.GPG(gnupghome=gpg_home)
+        self.keyid = keyid
+        self.passphrase = passphrase
+
+    def sign(self, fileobj):
+        """Return the detached signature of the data read from fileobj"""
+        signature = self.gpg.sign_file(
+            fileobj, keyid=self.keyid, passphrase=self.passphrase,
+            detach=True)
+        if not str(signature):
+            raise SaChannelUpdateError(
+                "gpg failed: %s" % getattr(signature, 'status', None))
+        return signature
+
+    def sign_file(self, s_filename):
+        """Write the detached signature of a file to <s_filename>.asc"""
+        try:
+            with open(s_filename, 'rb') as handle:
+                signature = self.sign(handle)
+        except (IOError, OSError, ValueError) as msg:
+            raise SaChannelUpdateError(
+                "Signing %s failed: %s" % (s_filename, msg))
+        write_signatures(s_filename, [str(signature)])
+
+
+SIGNERS = {}
+SIGNERS_LOCK = Lock()
+
+
+def get_keyids(config):
+    """Get the list of signing keys
+
+    Several keys can be listed while rolling over to a new key.
+    """
+    value = config.get('gpg_keyid') or ''
+    keyids = []
+    for keyid in value.replace(',', ' ').split():
+        if keyid not in keyids:
+            keyids.append(keyid)
+    return keyids
+
+
+def get_signer(config, keyid=None):
+    """Get the signer for a key, created once per process
+
+    keyid defaults to the first configured key.
+    """
+    gpg_home = config.get('gpg_dir', '/var/lib/sachannelupdate/gnupg')
+    gpg_pass = config.get('gpg_passphrase')
+    if keyid is None:
+        keyids = get_keyids(config)
+        keyid = keyids[0] if keyids else None
+    key = (gpg_home, keyid, gpg_pass)
+    with SIGNERS_LOCK:
+        if key not in SIGNERS:
+            SIGNERS[key] = Signer(gpg_home, keyid, gpg_pass)
+        return SIGNERS[key]
+
+
+class SignatureCache(object):
+    """Detached signatures stored by archive digest and key id"""
+    def __init__(self, dirname):
+        """Init"""
+        self.dirname = dirname
+
+    def _path(self, digest, keyid):
+        """Return the cache file of a signature"""
+        return os.path.join(
+            self.dirname, '%s.%s.asc' % (digest, KEYID_CHARS.sub('', keyid)))
+
+    def get(self, digest, keyid):
+        """Return the cached signature, None if there is none"""
+        try:
+            with open(self._path(digest, keyid), 'rb') as handle:
+                return handle.read() or None
+        except IOError:
+            return None
+
+    def put(self, digest, keyid, signature):
+        """Store a signature"""
+        path = self._path(digest, keyid)
+        tmpname = '%s.tmp' % path
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+            with open(tmpname, 'wb') as handle:
+                handle.write(signature)
+            os.rename(tmpname, path)
+        except (IOError, OSError):
+            pass
+
+
+def get_signature_cache(config):
+    """Get the signature cache kept in home_dir/db"""
+    return SignatureCache(os.path.join(
+        config.get('home_dir', '/var/lib/sachannelupdate'),
+        'db', 'signatures'))
+
+
+def write_signatures(s_filename, signatures):
+    """Write the detached signatures to <s_filename>.asc
+
+    With several keys the armored signatures are concatenated, gpg
+    verifies each of them.
+    """
+    with open('%s.asc' % s_filename, 'wb') as handle:
+        handle.write(''.join(signatures))
+
+
+def sign_digest(config, s_filename, digest, cache=None):
+    """Sign s_filename with every configured key and write the .asc
+
+    Signatures of the same digest and key are taken from the cache, the
+    missing ones are made in parallel.
+    """
+    keyids = get_keyids(config)
+    if cache is None:
+        cache = get_signature_cache(config)
+    signatures = dict([(keyid, cache.get(digest, keyid))
+                       for keyid in keyids])
+    missing = [keyid for keyid in keyids if signatures[keyid] is None]
+
+    def make_signature(keyid):
+        "Sign with one key"
+        with open(s_filename, 'rb') as handle:
+            return str(get_signer(config, keyid).sign(handle))
+
+    try:
+        made = parallel_map(make_signature, missing, len(missing))
+    except (IOError, OSError, ValueError) as msg:
+        raise SaChannelUpdateError(
+            "Signing %s failed: %s" % (s_filename, msg))
+    for keyid, signature in zip(missing, made):
+        cache.put(digest, keyid, signature)
+        signatures[keyid] = signature
+    write_signatures(s_filename, [signatures[keyid] for keyid in keyids])
+    return len(keyids) - len(missing)
+
+
+class SignStream(object):
+    """Feed data to gpg as it is written, the detached signature is
+    returned when the stream is closed"""
+    def __init__(self, signer, s_filename):
+        """Init"""
+        self.s_filename = s_filename
+        self.signature = None
+        self.failure = None
+        self.signer = signer
+        rfd, wfd = os.pipe()
+        # gpg must not inherit the write end or it never sees EOF
+        for pfd in (rfd, wfd):
+            fcntl.fcntl(
+                pfd, fcntl.F_SETFD,
+                fcntl.fcntl(pfd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.reader = os.fdopen(rfd, 'rb')
+        self.writer = os.fdopen(wfd, 'wb')
+        self.thread = Thread(target=self._sign)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _sign(self):
+        """Run gpg over the read end of the pipe"""
+        try:
+            self.signature = self.signer.sign(self.reader)
+        except BaseException as msg:
+            self.failure = msg
+        finally:
+            self.reader.close()
+
+    def write(self, data):
+        """Send data to gpg"""
+        self.writer.write(data)
+
+    def abort(self):
+        """Stop signing without writing a signature"""
+        if not self.writer.closed:
+            self.writer.close()
+        self.thread.join()
+
+    def close(self):
+        """Finish signing and return the signature"""
+        self.abort()
+        if self.failure is not None or self.signature is None:
+            raise SaChannelUpdateError(
+                "Signing %s failed: %s" % (self.s_filename, self.failure))
+        return str(self.signature)
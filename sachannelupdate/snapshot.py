@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Rule tree snapshot
+"""
+import os
+import json
+import time
+
+from sachannelupdate.discovery import read_dir
+
+# directories modified this recently are listed again on the next run,
+# a change in the same timestamp tick would otherwise go unnoticed
+RACY_SECONDS = 2
+
+
+def dir_stamp(path):
+    """Return the [mtime, inode] of a directory"""
+    dstat = os.stat(path)
+    return [dstat.st_mtime, dstat.st_ino]
+
+
+class Snapshot(object):
+    """Directory level snapshot of a rules tree
+
+    Records the mtime and inode of every directory below the rules
+    directory along with the rule files and subdirectories it held, and
+    the stamp of the deploy directory. Adding, removing or renaming a
+    file changes the mtime of its directory, so when no directory
+    changed neither did the set of rule files. Rewriting a file in place
+    does not touch the directory, rule files must be replaced by rename
+    for a snapshot to notice them. The per file stats are kept in the
+    manifest.
+    """
+    def __init__(self, filename, key):
+        """Init"""
+        self.filename = filename
+        self.key = key
+        self.dirs = {}
+        self.deploy = None
+        self.fresh = {}
+        self.load()
+
+    def load(self):
+        """Load the snapshot, one taken with another key is ignored"""
+        self.dirs = {}
+        self.deploy = None
+        try:
+            with open(self.filename) as handle:
+                data = json.load(handle)
+            if data['key'] == self.key:
+                self.dirs = data['dirs']
+                self.deploy = data['deploy']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def unchanged(self, dest):
+        """Check if the rules and the deploy directory are unchanged
+
+        Costs one stat per directory.
+        """
+        if not self.dirs:
+            return False
+        try:
+            if dir_stamp(dest) != self.deploy:
+                return False
+            for path, entry in self.dirs.iteritems():
+                if entry[0] is None or dir_stamp(path) != entry[:2]:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def iter_files(self, path, rule_filter):
+        """Yield the rule files below path
+
+        Directories that did not change since the snapshot are not
+        listed again. The new snapshot is kept until save().
+        """
+        self.fresh = {}
+        pending = [('', os.path.abspath(path))]
+        while pending:
+            relroot, root = pending.pop()
+            try:
+                stamp = dir_stamp(root)
+                entry = self.dirs.get(root)
+                if entry is not None and entry[0] is not None and \
+                        entry[:2] == stamp:
+                    subdirs, files = entry[2], entry[3]
+                else:
+                    subdirs, files = read_dir(root, relroot, rule_filter)
+            except OSError:
+                continue
+            if time.time() - stamp[0] < RACY_SECONDS:
+                stamp[0] = None
+            self.fresh[root] = stamp + [subdirs, files]
+            for name in files:
+                yield os.path.join(root, name)
+            pending.extend(reversed([
+                ('%s/%s' % (relroot, name) if relroot else name,
+                 os.path.join(root, name)) for name in subdirs]))
+
+    def save(self, dest):
+        """Write the snapshot taken by iter_files() to disk"""
+        self.dirs = self.fresh
+        self.deploy = dir_stamp(dest)
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmpname = '%s.tmp' % self.filename
+        with open(tmpname, 'w') as handle:
+            json.dump(dict(key=self.key, deploy=self.deploy, dirs=self.dirs),
+                      handle)
+        os.rename(tmpname, self.filename)
+
+
+def snapshot_key(rule_dir, rule_filter):
+    """Return what a snapshot depends on besides the tree"""
+    return [os.path.abspath(rule_dir), list(rule_filter.include),
+            list(rule_filter.exclude)]
@@ -19,41 +19,184 @@
 sachannelupdate: Transports
 """
 import os
+import json
+import time
+import atexit
 
-from Queue import Queue
+from threading import Lock
+from contextlib import contextmanager
 from pwd import getpwnam
 from getpass import getuser
 from urlparse import urlparse
 
-from paramiko.util import load_host_keys
-from paramiko import Transport, SFTPClient, PKey, PasswordRequiredException, \
-    SSHException
+from paramiko.hostkeys import HostKeys
+from paramiko.common import DEFAULT_WINDOW_SIZE, DEFAULT_MAX_PACKET_SIZE
+from paramiko import Transport, SFTPClient, Agent, RSAKey, DSSKey, \
+    PasswordRequiredException, AuthenticationException, SSHException
 
+try:
+    from paramiko import ECDSAKey
+except ImportError:
+    ECDSAKey = None
+
+try:
+    from paramiko import Ed25519Key
+except ImportError:
+    Ed25519Key = None
+
+from sachannelupdate.utils import get_int, get_bool
 from sachannelupdate.exceptions import SaChannelUpdateTransportError
 
+BLOCKSIZE = 262144
+
+
+# key file suffixes in order of preference
+KEY_TYPES = (
+    ('_ed25519', Ed25519Key),
+    ('_ecdsa', ECDSAKey),
+    ('_rsa', RSAKey),
+    ('_dsa', DSSKey),
+)
+
+
+def key_rank(filename):
+    """Return the preference of a key file, None if it is not a key"""
+    for rank, (suffix, keyclass) in enumerate(KEY_TYPES):
+        if keyclass is not None and filename.endswith(suffix):
+            return rank
+    return None
+
 
 def get_key_files(kfiles, dirname, names):
     """Return key files"""
     for name in names:
         fullname = os.path.join(dirname, name)
-        if os.path.isfile(fullname) and \
-            fullname.endswith('_rsa') or \
-                fullname.endswith('_dsa'):
+        if key_rank(name) is not None and os.path.isfile(fullname):
             kfiles.put(fullname)
 
 
 def get_ssh_keys(sshdir):
-    """Get SSH keys"""
-    keys = Queue()
-    for root, _, files in os.walk(os.path.abspath(sshdir)):
-        if not files:
-            continue
-        for filename in files:
-            fullname = os.path.join(root, filename)
-            if (os.path.isfile(fullname) and fullname.endswith('_rsa') or
-                    fullname.endswith('_dsa')):
-                keys.put(fullname)
-    return keys
+    """Get the private key files in the ssh dir, preferred types first"""
+    sshdir = os.path.abspath(sshdir)
+    keys = []
+    if not os.path.isdir(sshdir):
+        return keys
+    for name in os.listdir(sshdir):
+        rank = key_rank(name)
+        fullname = os.path.join(sshdir, name)
+        if rank is not None and os.path.isfile(fullname):
+            keys.append((rank, fullname))
+    return [fullname for _, fullname in sorted(keys)]
+
+
+def load_private_key(filename):
+    """Load a private key file, None if it can not be used
+
+    Keys protected by a passphrase are skipped, they can be used
+    through ssh-agent.
+    """
+    keyclasses = [
+        keyclass for _, keyclass in KEY_TYPES if keyclass is not None]
+    rank = key_rank(os.path.basename(filename))
+    if rank is not None:
+        # try the class the file name suggests first
+        keyclasses.remove(KEY_TYPES[rank][1])
+        keyclasses.insert(0, KEY_TYPES[rank][1])
+    for keyclass in keyclasses:
+        try:
+            return keyclass.from_private_key_file(filename)
+        except PasswordRequiredException:
+            return None
+        except (SSHException, IOError, ValueError):
+            pass
+    return None
+
+
+def get_agent_keys(config):
+    """Get the keys held by ssh-agent, returns (agent, keys)"""
+    if not get_bool(config, 'ssh_agent', True):
+        return None, ()
+    try:
+        agent = Agent()
+        return agent, agent.get_keys()
+    except SSHException:
+        return None, ()
+
+
+class KeyCache(object):
+    """Record of the key that last authenticated to each host"""
+    def __init__(self, filename):
+        """Init"""
+        self.filename = filename
+        self.lock = Lock()
+
+    def _load(self):
+        """Read the cache"""
+        try:
+            with open(self.filename) as handle:
+                entries = json.load(handle)
+            if isinstance(entries, dict):
+                return entries
+        except (IOError, ValueError):
+            pass
+        return {}
+
+    def get(self, host):
+        """Return the key identifier that last worked for host"""
+        with self.lock:
+            return self._load().get(host)
+
+    def set(self, host, ident):
+        """Record the key identifier that worked for host"""
+        with self.lock:
+            entries = self._load()
+            if entries.get(host) == ident:
+                return
+            entries[host] = ident
+            tmpname = '%s.tmp' % self.filename
+            try:
+                dirname = os.path.dirname(self.filename)
+                if dirname and not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                with open(tmpname, 'w') as handle:
+                    json.dump(entries, handle, sort_keys=True)
+                os.rename(tmpname, self.filename)
+            except (IOError, OSError):
+                pass
+
+
+KEY_CACHES = {}
+KEY_CACHES_LOCK = Lock()
+
+
+def get_key_cache(config):
+    """Get the key cache kept in home_dir/db"""
+    filename = os.path.join(
+        config.get('home_dir', '/var/lib/sachannelupdate'), 'db', 'sshkeys')
+    with KEY_CACHES_LOCK:
+        if filename not in KEY_CACHES:
+            KEY_CACHES[filename] = KeyCache(filename)
+        return KEY_CACHES[filename]
+
+
+def get_auth_keys(config, sshdir, last_good=None):
+    """Return (identifier, key loader) pairs to authenticate with
+
+    Agent keys come before key files, the key that last worked for the
+    host comes first of all. Key files are only loaded when tried.
+    """
+    agent, agent_keys = get_agent_keys(config)
+    candidates = []
+    for key in agent_keys:
+        ident = 'agent:%s' % key.get_fingerprint().encode('hex')
+        candidates.append((ident, lambda key=key: key))
+    if sshdir:
+        for filename in get_ssh_keys(sshdir):
+            candidates.append(
+                (filename, lambda filename=filename: load_private_key(
+                    filename)))
+    candidates.sort(key=lambda candidate: candidate[0] != last_good)
+    return agent, candidates
 
 
 def get_remote_path(remote_location):
@@ -85,25 +228,75 @@ def get_local_user(username):
     return luser
 
 
-def get_host_keys(hostname, sshdir):
-    """get host key"""
-    hostkey = None
+class KnownHosts(object):
+    """Index of a known_hosts file, reparsed only when the file changes
 
-    try:
-        host_keys = load_host_keys(os.path.join(sshdir, 'known_hosts'))
-    except IOError:
-        host_keys = {}
+    Lookups handle hashed host names and [host]:port entries. Results are
+    memoised, so hashed entries are only hashed once per host name for
+    as long as the file is unchanged.
+    """
+    def __init__(self, filename):
+        """Init"""
+        self.filename = filename
+        self.lock = Lock()
+        self.stamp = None
+        self.hostkeys = HostKeys()
+        self.lookups = {}
+
+    def _refresh(self):
+        """Reload the file if it changed"""
+        try:
+            fstat = os.stat(self.filename)
+            stamp = (fstat.st_mtime, fstat.st_size, fstat.st_ino)
+        except OSError:
+            stamp = None
+        if stamp == self.stamp:
+            return
+        hostkeys = HostKeys()
+        if stamp is not None:
+            try:
+                hostkeys.load(self.filename)
+            except (IOError, SSHException):
+                pass
+        self.stamp = stamp
+        self.hostkeys = hostkeys
+        self.lookups = {}
 
-    if hostname in host_keys:
-        hostkeytype = host_keys[hostname].keys()[0]
-        hostkey = host_keys[hostname][hostkeytype]
+    def lookup(self, hostname, port=22):
+        """Return a dict of key type to key for a host"""
+        if port != 22:
+            hostname = '[%s]:%d' % (hostname, port)
+        with self.lock:
+            self._refresh()
+            if hostname not in self.lookups:
+                keys = self.hostkeys.lookup(hostname)
+                self.lookups[hostname] = dict(keys.items()) if keys else {}
+            return self.lookups[hostname]
 
-    return hostkey
 
+KNOWN_HOSTS = {}
+KNOWN_HOSTS_LOCK = Lock()
 
-def get_sftp_conn(config):
-    """Make a SFTP connection, returns sftp client and connection objects"""
-    remote = config.get('remote_location')
+
+def get_known_hosts(filename):
+    """Get the shared index of a known_hosts file"""
+    with KNOWN_HOSTS_LOCK:
+        if filename not in KNOWN_HOSTS:
+            KNOWN_HOSTS[filename] = KnownHosts(filename)
+        return KNOWN_HOSTS[filename]
+
+
+def get_host_keys(hostname, sshdir, port=22):
+    """Get the known host keys of a host as a dict keyed by key type,
+    None if the host is unknown"""
+    if not sshdir:
+        return None
+    known_hosts = get_known_hosts(os.path.join(sshdir, 'known_hosts'))
+    return known_hosts.lookup(hostname, port) or None
+
+
+def parse_remote(config, remote):
+    """Get the hostname, port and username for a remote location"""
     parts = urlparse(remote)
 
     if ':' in parts.netloc:
@@ -114,28 +307,345 @@ def get_sftp_conn(config):
     port = int(port)
 
     username = config.get('remote_username') or getuser()
+    return hostname, port, username
+
+
+def make_transport(config, hostname, port):
+    """Create a transport with the configured window, packet size and
+    compression"""
+    transport = Transport(
+        (hostname, port),
+        default_window_size=get_int(
+            config, 'ssh_window_size', DEFAULT_WINDOW_SIZE),
+        default_max_packet_size=get_int(
+            config, 'ssh_packet_size', DEFAULT_MAX_PACKET_SIZE))
+    transport.use_compression(get_bool(config, 'ssh_compression', False))
+    return transport
+
+
+def host_key_name(keytype):
+    """Map a host key algorithm to the key type in known_hosts"""
+    if keytype.startswith('rsa-sha2-'):
+        return 'ssh-rsa'
+    return keytype
+
+
+def prefer_host_keys(transport, hostkeys):
+    """Negotiate a host key algorithm we hold a known key for"""
+    if not hostkeys:
+        return
+    options = transport.get_security_options()
+    options.key_types = sorted(
+        options.key_types,
+        key=lambda keytype: host_key_name(keytype) not in hostkeys)
+
+
+def check_host_key(transport, hostkeys, strict=True):
+    """Verify the server key against the known host keys
+
+    Unknown hosts are rejected unless strict is False.
+    """
+    key = transport.get_remote_server_key()
+    if not hostkeys:
+        if strict:
+            raise SSHException("Server host key is not in known_hosts")
+        return
+    known = hostkeys.get(key.get_name())
+    if known is None or str(known) != str(key):
+        raise SSHException("Bad host key from server")
+
+
+def open_transport(config, hostname, port, hostkeys):
+    """Connect to the server and verify its host key"""
+    transport = make_transport(config, hostname, port)
+    try:
+        prefer_host_keys(transport, hostkeys)
+        transport.start_client()
+        check_host_key(
+            transport, hostkeys,
+            get_bool(config, 'ssh_strict_host_keys', True))
+    except BaseException:
+        transport.close()
+        raise
+    return transport
+
+
+def authenticate(transport, username, candidates):
+    """Try the candidate keys in turn, returns the identifier that worked
+
+    A key that fails with an SSHException, such as an agent key that
+    cannot sign, is skipped. If it took the transport down with it the
+    exception is raised, the keys not tried yet are left in candidates
+    when it is an iterator.
+    """
+    for ident, loader in candidates:
+        key = loader()
+        if key is None:
+            continue
+        try:
+            transport.auth_publickey(username, key)
+        except AuthenticationException:
+            continue
+        except SSHException:
+            if transport.is_active():
+                continue
+            raise
+        if transport.is_authenticated():
+            return ident
+    return None
+
+
+def get_sftp_conn(config, remote=None):
+    """Make a SFTP connection, returns sftp client and connection objects"""
+    if remote is None:
+        remote = config.get('remote_location')
+    hostname, port, username = parse_remote(config, remote)
     luser = get_local_user(username)
     sshdir = get_ssh_dir(config, luser)
-    hostkey = get_host_keys(hostname, sshdir)
+    hostkeys = get_host_keys(hostname, sshdir, port)
+    cache = get_key_cache(config)
+    host = '%s@%s:%d' % (username, hostname, port)
 
+    transport = agent = None
     try:
-        sftp = None
-        keys = get_ssh_keys(sshdir)
-        transport = Transport((hostname, port))
-        while not keys.empty():
+        agent, candidates = get_auth_keys(config, sshdir, cache.get(host))
+        candidates = iter(candidates)
+        while True:
+            transport = open_transport(config, hostname, port, hostkeys)
             try:
-                key = PKey.from_private_key_file(keys.get())
-                transport.connect(
-                    hostkey=hostkey,
-                    username=username,
-                    password=None,
-                    pkey=key)
-                sftp = SFTPClient.from_transport(transport)
+                ident = authenticate(transport, username, candidates)
                 break
-            except (PasswordRequiredException, SSHException):
-                pass
-        if sftp is None:
+            except SSHException:
+                # try the remaining keys on a new connection
+                transport.close()
+                transport = None
+        if ident is None:
             raise SaChannelUpdateTransportError("SFTP connection failed")
+        cache.set(host, ident)
+        sftp = SFTPClient.from_transport(transport)
         return sftp, transport
     except BaseException as msg:
+        if transport is not None:
+            transport.close()
         raise SaChannelUpdateTransportError(msg)
+    finally:
+        if agent is not None:
+            agent.close()
+
+
+def remote_stat(sftp, path):
+    """Get the attributes of a remote file, None if it does not exist"""
+    try:
+        return sftp.stat(path)
+    except IOError:
+        return None
+
+
+def same_size(sftp, local_file, remote_file):
+    """Check if a remote file has the same size as a local file"""
+    rstat = remote_stat(sftp, remote_file)
+    return rstat is not None and \
+        rstat.st_size == os.path.getsize(local_file)
+
+
+def same_file(sftp, local_file, remote_file):
+    """Check if a small remote file has the same content as a local file"""
+    if not same_size(sftp, local_file, remote_file):
+        return False
+    rhandle = sftp.open(remote_file, 'rb')
+    try:
+        remote_data = rhandle.read()
+    finally:
+        rhandle.close()
+    with open(local_file, 'rb') as handle:
+        return handle.read() == remote_data
+
+
+def rename_into_place(sftp, source, dest):
+    """Atomically rename a remote file over dest"""
+    try:
+        sftp.posix_rename(source, dest)
+    except (IOError, AttributeError):
+        # the server or paramiko lacks posix-rename, plain SFTP rename
+        # refuses to overwrite
+        if remote_stat(sftp, dest) is not None:
+            sftp.remove(dest)
+        sftp.rename(source, dest)
+
+
+class Transfer(object):
+    """Statistics of a file transfer"""
+    def __init__(self, remote_file, size, offset=0):
+        """Init"""
+        self.remote_file = remote_file
+        self.size = size
+        self.offset = offset
+        self.sent = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """Bytes per second"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.sent / self.elapsed
+
+    def __str__(self):
+        """Summary"""
+        msg = "%s: %d bytes in %.2fs (%.0f bytes/sec)" % (
+            self.remote_file, self.sent, self.elapsed, self.rate)
+        if self.offset:
+            msg += ", resumed at %d" % self.offset
+        return msg
+
+
+def put_file(sftp, local_file, remote_file, partial, resume=False,
+             blocksize=BLOCKSIZE):
+    """Upload a file to partial then rename it to remote_file
+
+    With resume, an existing partial file is continued from its size.
+    Only resume when the partial file name identifies the content.
+    Writes are pipelined, so many write requests are in flight instead
+    of waiting a round trip for each one. Returns a Transfer.
+    """
+    size = os.path.getsize(local_file)
+    offset = 0
+    if resume:
+        pstat = remote_stat(sftp, partial)
+        if pstat is not None and pstat.st_size <= size:
+            offset = pstat.st_size
+    transfer = Transfer(remote_file, size, offset)
+    start = time.time()
+    with open(local_file, 'rb') as handle:
+        if offset:
+            handle.seek(offset)
+            rhandle = sftp.open(partial, 'r+')
+            rhandle.seek(offset)
+        else:
+            rhandle = sftp.open(partial, 'w')
+        try:
+            rhandle.set_pipelined(True)
+            buf = handle.read(blocksize)
+            while len(buf) > 0:
+                rhandle.write(buf)
+                transfer.sent += len(buf)
+                buf = handle.read(blocksize)
+        finally:
+            # waits for the outstanding write requests
+            rhandle.close()
+    if sftp.stat(partial).st_size != size:
+        raise SaChannelUpdateTransportError(
+            "Upload of %s is incomplete" % remote_file)
+    rename_into_place(sftp, partial, remote_file)
+    transfer.elapsed = time.time() - start
+    return transfer
+
+
+class SFTPPool(object):
+    """Pool of SFTP connections keyed by (host, port, user)
+
+    Connections are returned to the pool after use and reused by later
+    operations on the same host. Idle connections are evicted after
+    ssh_idle_timeout seconds, and a connection that has been idle for
+    longer than ssh_keepalive seconds is probed before it is reused.
+    """
+    def __init__(self):
+        """Init"""
+        self.lock = Lock()
+        self.idle = {}
+
+    def evict(self, max_idle):
+        """Close connections idle for longer than max_idle seconds"""
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key, conns in self.idle.items():
+                live = [conn for conn in conns if now - conn[2] <= max_idle]
+                expired.extend(
+                    [conn for conn in conns if now - conn[2] > max_idle])
+                if live:
+                    self.idle[key] = live
+                else:
+                    del self.idle[key]
+        for sftp, transport, _ in expired:
+            close_conn(sftp, transport)
+
+    def acquire(self, config, remote):
+        """Get a healthy connection, returns (key, sftp, transport)"""
+        key = parse_remote(config, remote)
+        keepalive = get_int(config, 'ssh_keepalive', 30)
+        self.evict(get_int(config, 'ssh_idle_timeout', 300))
+        while True:
+            with self.lock:
+                conns = self.idle.get(key)
+                if not conns:
+                    break
+                sftp, transport, last_used = conns.pop()
+            probe = time.time() - last_used > keepalive
+            if is_healthy(sftp, transport, probe):
+                return key, sftp, transport
+            close_conn(sftp, transport)
+        sftp, transport = get_sftp_conn(config, remote)
+        if keepalive > 0:
+            transport.set_keepalive(keepalive)
+        return key, sftp, transport
+
+    def release(self, key, sftp, transport):
+        """Return a connection to the pool"""
+        with self.lock:
+            self.idle.setdefault(key, []).append(
+                (sftp, transport, time.time()))
+
+    @contextmanager
+    def session(self, config, remote):
+        """Context manager that yields a pooled SFTP client"""
+        key, sftp, transport = self.acquire(config, remote)
+        try:
+            yield sftp
+        except BaseException:
+            close_conn(sftp, transport)
+            raise
+        self.release(key, sftp, transport)
+
+    def closeall(self):
+        """Close all idle connections"""
+        with self.lock:
+            conns = []
+            for key in self.idle.keys():
+                conns.extend(self.idle.pop(key))
+        for sftp, transport, _ in conns:
+            close_conn(sftp, transport)
+
+
+def is_healthy(sftp, transport, probe=False):
+    """Check that a pooled connection is still usable"""
+    if not transport.is_active() or not transport.is_authenticated():
+        return False
+    if probe:
+        try:
+            sftp.normalize('.')
+        except (IOError, SSHException, EOFError):
+            return False
+    return True
+
+
+def close_conn(sftp, transport):
+    """Close a connection, ignoring errors"""
+    for conn in (sftp, transport):
+        try:
+            conn.close()
+        except BaseException:
+            pass
+
+
+POOL = SFTPPool()
+atexit.register(POOL.closeall)
+
+
+def sftp_session(config, remote):
+    """Get a pooled SFTP client for a remote location
+
+    with sftp_session(config, remote) as sftp:
+        sftp.put(local, remote_path)
+    """
+    return POOL.session(config, remote)
@@ -20,6 +20,29 @@ from __future__ import print_function
 
 import sys
 
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from sachannelupdate.exceptions import SaChannelUpdateConfigError
+
+
+class LazyModule(object):
+    """A module that is only imported when one of its attributes is used
+
+    Keeps the gpg, DNS and SSH libraries from loading on runs that never
+    reach the stages that need them.
+    """
+    def __init__(self, name):
+        """Init"""
+        self._name = name
+
+    def __getattr__(self, attr):
+        """Import the module and get the attribute from it"""
+        # __import__ holds the import lock, so a thread never sees a
+        # module another thread is still importing
+        __import__(self._name)
+        return getattr(sys.modules[self._name], attr)
+
 
 def error(msg):
     """print to stderr"""
@@ -29,3 +52,75 @@ def error(msg):
 def info(msg):
     """print to stdout"""
     print(msg, file=sys.stdout)
+
+
+def get_int(config, option, default):
+    """Get an integer option from the config"""
+    value = config.get(option)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise SaChannelUpdateConfigError(
+            "The %s option must be an integer" % option)
+
+
+def get_bool(config, option, default):
+    """Get a boolean option from the config"""
+    value = config.get(option)
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    value = str(value).lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    if value in ('0', 'no', 'false', 'off'):
+        return False
+    raise SaChannelUpdateConfigError(
+        "The %s option must be a boolean" % option)
+
+
+def parallel_imap(func, items, workers):
+    """Lazily apply func to items in order, using a thread pool when
+    workers > 1
+
+    At most 2 * workers items are read ahead of the results consumed,
+    ThreadPool.imap would read the whole of items into its task queue.
+    Queued items are dropped when func raises or the caller stops.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(workers)
+    pending = deque()
+    finished = False
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def parallel_map(func, items, workers):
+    """Apply func to items, using a thread pool when workers > 1"""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
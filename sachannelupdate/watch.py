@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# sachannelupdate - Utility for pushing updates to Spamassassin update channels
+# Copyright (C) 2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sachannelupdate: Watch the rules directory with inotify
+"""
+import os
+import time
+import errno
+import ctypes
+import select
+import struct
+
+from ctypes.util import find_library
+
+from sachannelupdate.base import entry
+from sachannelupdate.discovery import RuleFilter, get_rule_filter
+from sachannelupdate.utils import info, error, get_int
+from sachannelupdate.exceptions import SaChannelUpdateError
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+DIR_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+try:
+    LIBC = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+    LIBC.inotify_init1
+except (OSError, AttributeError):
+    LIBC = None
+
+
+class Inotify(object):
+    """Minimal inotify binding"""
+    def __init__(self):
+        """Init"""
+        if LIBC is None:
+            raise SaChannelUpdateError("inotify is not available")
+        self.fd = LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        """Watch path, returns the watch descriptor"""
+        wd = LIBC.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop a watch"""
+        LIBC.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events
+
+        Returns a list of (wd, mask, cookie, name) tuples.
+        """
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        """Close the inotify instance"""
+        os.close(self.fd)
+
+
+class RuleWatcher(object):
+    """In memory index of the rule files below a directory, kept up to
+    date from inotify events"""
+    def __init__(self, rule_dir, inotify=None, rule_filter=None):
+        """Init"""
+        self.rule_dir = os.path.abspath(rule_dir)
+        self.inotify = inotify or Inotify()
+        self.rule_filter = rule_filter or RuleFilter()
+        self.dirs = {}
+        self.files = set()
+        self.scan(self.rule_dir)
+
+    def scan(self, path):
+        """Watch path and the directories below it, indexing rule files
+
+        Returns True if rule files were found.
+        """
+        found = False
+        for root, dirnames, filenames in os.walk(path):
+            try:
+                self.dirs[self.inotify.add_watch(root, DIR_MASK)] = root
+            except OSError:
+                # removed before it could be watched
+                continue
+            dirnames[:] = [
+                name for name in dirnames if self.rule_filter.include_dir(
+                    name, self.relpath(os.path.join(root, name)))]
+            for filename in filenames:
+                filename = os.path.join(root, filename)
+                if self.is_rule_file(filename):
+                    self.files.add(filename)
+                    found = True
+        return found
+
+    def relpath(self, path):
+        """Return a path relative to the rules directory"""
+        return os.path.relpath(path, self.rule_dir).replace(os.sep, '/')
+
+    def is_rule_file(self, path):
+        """Check if a file is a rule file the filter accepts"""
+        return self.rule_filter.include_file(
+            os.path.basename(path), self.relpath(path))
+
+    def rescan(self):
+        """Rebuild the index and watches from scratch"""
+        for wd in self.dirs:
+            self.inotify.rm_watch(wd)
+        self.dirs = {}
+        self.files = set()
+        self.scan(self.rule_dir)
+
+    def forget(self, path):
+        """Drop a directory that went away from the index
+
+        Returns True if it held rule files.
+        """
+        prefix = path + os.sep
+        for wd, root in self.dirs.items():
+            if root == path or root.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.dirs[wd]
+        removed = [name for name in self.files if name.startswith(prefix)]
+        self.files.difference_update(removed)
+        return len(removed) > 0
+
+    def handle(self, event):
+        """Apply an event to the index, returns True if rules changed"""
+        wd, mask, _, name = event
+        if mask & IN_Q_OVERFLOW:
+            # events were lost
+            self.rescan()
+            return True
+        root = self.dirs.get(wd)
+        if root is None:
+            return False
+        if mask & IN_IGNORED:
+            del self.dirs[wd]
+            return False
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF) or not name:
+            # the parent directory reports the removal
+            return False
+        path = os.path.join(root, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if not self.rule_filter.include_dir(name, self.relpath(path)):
+                    return False
+                return self.scan(path)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                return self.forget(path)
+            return False
+        if not self.is_rule_file(path):
+            return False
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.files.discard(path)
+        else:
+            self.files.add(path)
+        return True
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for the rules to change
+
+        Returns True if they changed.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            changed = False
+            for event in self.inotify.read(remaining):
+                changed = self.handle(event) or changed
+            if changed:
+                return True
+
+    def close(self):
+        """Stop watching"""
+        self.inotify.close()
+
+
+def publish(config, watcher):
+    """Run the pipeline over the indexed rule files
+
+    Returns False if the run failed and should be retried.
+    """
+    try:
+        result = entry(
+            config, rulefiles=sorted(watcher.files), lock_wait=True)
+    except Exception as msg:  # pylint: disable=broad-except
+        error(msg)
+        return False
+    return result['status'] not in ('failed', 'locked')
+
+
+def watch(config):
+    """Publish whenever the rules change
+
+    Changes are debounced, publishing waits until the rules have not
+    changed for watch_debounce seconds so a burst of changes is
+    published once. A failed run is retried after watch_retry seconds,
+    doubling up to watch_retry_max while it keeps failing, or as soon
+    as the rules change again.
+    """
+    home_dir = config.get('home_dir', '/var/lib/sachannelupdate')
+    debounce = get_int(config, 'watch_debounce', 2)
+    retry_min = get_int(config, 'watch_retry', 30)
+    retry_max = get_int(config, 'watch_retry_max', 600)
+    watcher = RuleWatcher(
+        os.path.join(home_dir, 'rules'), rule_filter=get_rule_filter(config))
+    info("Watching %s" % watcher.rule_dir)
+    retry = None
+    try:
+        while True:
+            if publish(config, watcher):
+                retry = None
+            else:
+                retry = min(retry * 2, retry_max) if retry else retry_min
+                info("Retrying %s in %d seconds" % (
+                    watcher.rule_dir, retry))
+            if watcher.wait(retry):
+                while watcher.wait(debounce):
+                    pass
+    finally:
+        watcher.close()
@@ -1,9 +1,13 @@
 import os
 import sys
+import shutil
 import tarfile
+import tempfile
+import threading
 
 from Queue import Queue
-# from datetime import datetime
+from hashlib import sha1
+from datetime import datetime
 
 import mock
 try:
@@ -13,13 +17,21 @@ except ImportError:
         raise
     import unittest as unittest2
 
-from dns.exception import DNSException
+from dns import rcode
+from dns.exception import DNSException, Timeout as DNSTimeout
 
+from sachannelupdate.discovery import RuleFilter
 from sachannelupdate.exceptions import SaChannelUpdateError, \
-    SaChannelUpdateConfigError as CfgError
+    SaChannelUpdateConfigError as CfgError, SaChannelUpdateDeployError, \
+    SaChannelUpdateLockError
 from sachannelupdate.base import getfiles, create_file, deploy_file, package, \
-    process, get_counter, update_dns, sign, hash_file, HASHTMPL, upload, \
-    queue_files, cleanup, check_required, get_cf_files, entry
+    process, get_counter, update_dns, get_sa_versions, get_keyring, \
+    get_dns_servers, sign, hash_file, \
+    HASHTMPL, upload, \
+    cleanup, check_required, get_cf_files, entry, deploy_rule, \
+    update_marker, TeeWriter, build_archive, write_hash, \
+    archive_key, link_file, read_hash, upload_mirrors, get_remote_locations, \
+    get_quorum, replace_file
 
 
 R_FILES = ('70_baruwa.cf', '70_baruwa_dmarc.cf')
@@ -29,28 +41,25 @@ A_PATH = '/var/lib/sarulesupdate/archives'
 CF_FILES = ('70_baruwa.cf', '70_baruwa.post', '70_baruwa.cf.orig')
 
 
-def stat_side_effects(*args):
-    if args[0] == '/srv/www/saupdate/rule.cf':
-        return mock.Mock(st_mtime=1)
-    if args[0] == '/var/lib/saupdate/rule.cf':
-        return mock.Mock(st_mtime=2)
-
-
-def queue_files_side_effects(*args):
+def iter_files_side_effects(*args):
     if args[0] == A_PATH:
-        return [
-            (args[0], (), A_FILES)
-        ]
+        return ('%s/%s' % (A_PATH, name) for name in A_FILES)
     elif args[0] == R_PATH:
-        return [
-            (args[0], (), R_FILES)
-        ]
+        return ('%s/%s' % (R_PATH, name) for name in R_FILES)
     else:
         raise ValueError(args[0])
 
 
 class BaseTestCase(unittest2.TestCase):
 
+    def setUp(self):
+        patcher = mock.patch('sachannelupdate.base.run_lock')
+        self.mock_run_lock = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('sachannelupdate.base.mark_pending')
+        self.mock_mark_pending = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @mock.patch('sachannelupdate.base.os.path.isfile')
     def test_get_files(self, mock_isfile):
         mock_isfile.return_value = True
@@ -73,71 +82,452 @@ class BaseTestCase(unittest2.TestCase):
     def test_deploy_file(self, mock_open):
         source = '/tmp/rule1.cf'
         dest = '/srv/www/saupdate/rule1.cf'
-        # mock_shandle = mock.Mock(spec=file)
-        # mock_handle = mock.Mock(spec=file)
-        # mock_shandle.__iter__.return_value = [
-        #     '# Updated: %date%\n',
-        #     ''
-        # ]
-        #
-        # def mock_side_e(*args):
-        #     "inline"
-        #     if args[0] == source:
-        #         return mock_shandle
-        #     elif args[0] == dest:
-        #         return mock_handle
-        #     else:
-        #         raise ValueError(args[0])
-        # mock_open.side_effect = mock_side_e
-        deploy_file(source, dest)
+        mock_open.return_value.read.side_effect = [
+            '# Updated: %date%\nscore ', 'RULE 1.0\n', '']
+        size = deploy_file(source, dest)
         expected_calls = [mock.call(source), mock.call(dest, 'w')]
         self.assertEqual(expected_calls, mock_open.call_args_list)
+        handle = mock_open.return_value.__enter__.return_value
+        date = datetime.utcnow().strftime('%Y-%m-%d')
+        self.assertEqual(size, len('# Updated: %s\nscore RULE 1.0\n' % date))
+        self.assertEqual(handle.write.call_args_list, [
+            mock.call('# Updated: %s\n' % date),
+            mock.call('score RULE 1.0\n')])
+        mock_open.return_value.close.assert_called_once_with()
+
+    @mock.patch('sachannelupdate.base.CHUNKSIZE', 7)
+    def test_deploy_file_chunks(self):
+        tmpdir = tempfile.mkdtemp()
+        source = os.path.join(tmpdir, 'source.cf')
+        dest = os.path.join(tmpdir, 'dest.cf')
+        lines = [
+            '# Updated: %date%\n',
+            'score RULE 1.0\n',
+            '# Updated: %date%\n',
+            '# Updated: %date%\n',
+            ' # Updated: %date%\n',
+            '# Updated: %date%']
+        try:
+            with open(source, 'w') as handle:
+                handle.write(''.join(lines))
+            deploy_file(source, dest)
+            with open(dest) as handle:
+                deployed = handle.read()
+        finally:
+            shutil.rmtree(tmpdir)
+        date = datetime.utcnow().strftime('%Y-%m-%d')
+        expected = [
+            line.replace('%date%', date)
+            if line == '# Updated: %date%\n' else line
+            for line in lines]
+        self.assertEqual(deployed, ''.join(expected))
+
+    def test_update_marker(self):
+        data = 'score RULE 1.0\n'
+        self.assertTrue(update_marker(data, '2015-01-01') is data)
+        self.assertEqual(
+            update_marker('# Updated: %date%\n', '2015-01-01'),
+            '# Updated: 2015-01-01\n')
 
     @mock.patch('sachannelupdate.base.os.path.isfile')
     @mock.patch('sachannelupdate.base.os.listdir')
     @mock.patch('sachannelupdate.base.tarfile', spec=tarfile)
-    @mock.patch('sachannelupdate.base.os.chdir')
-    def test_package(
-            self, mock_chdir, mock_tarfile, mock_listdir, mock_isfile):
+    def test_package(self, mock_tarfile, mock_listdir, mock_isfile):
         tardir = '/srv/www/saupdate'
         dest = '/var/lib/saupdate'
         p_version = '10'
         mock_listdir.return_value = ['rule.cf']
         tarfile = os.path.join(tardir, '%s.tar.gz' % p_version)
         package(dest, tardir, p_version)
-        mock_chdir.assert_called_once_with(dest)
-        mock_tarfile.open.assert_called_once_with(tarfile, mode='w:gz')
-        mock_listdir.assert_called_once_with('.')
-        mock_tarfile.open.return_value.add.assert_called_once_with('rule.cf')
+        mock_tarfile.open.assert_called_once_with(
+            tarfile, mode='w:gz', fileobj=None, compresslevel=9)
+        mock_listdir.assert_called_once_with(dest)
+        mock_tarfile.open.return_value.add.assert_called_once_with(
+            '/var/lib/saupdate/rule.cf', 'rule.cf')
         mock_tarfile.open.return_value.close.assert_called_once_with()
 
+    def test_package_reproducible(self):
+        tmpdir = tempfile.mkdtemp()
+        dest = os.path.join(tmpdir, 'deploy')
+        os.mkdir(dest)
+        for name in ('b.cf', 'a.cf', 'c.post'):
+            with open(os.path.join(dest, name), 'w') as handle:
+                handle.write('score RULE 1.0\n')
+        try:
+            package(dest, tmpdir, 1, reproducible=True)
+            for name in os.listdir(dest):
+                os.utime(os.path.join(dest, name), (1000, 1000))
+                os.chmod(os.path.join(dest, name), 0600)
+            package(dest, tmpdir, 2, reproducible=True)
+            with open(os.path.join(tmpdir, '1.tar.gz'), 'rb') as handle:
+                first = handle.read()
+            with open(os.path.join(tmpdir, '2.tar.gz'), 'rb') as handle:
+                second = handle.read()
+            tar = tarfile.open(os.path.join(tmpdir, '1.tar.gz'))
+            members = tar.getmembers()
+            tar.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(first, second)
+        self.assertEqual(
+            [member.name for member in members], ['a.cf', 'b.cf', 'c.post'])
+        for member in members:
+            self.assertEqual(
+                (member.mtime, member.uid, member.gid, member.mode),
+                (0, 0, 0, 0644))
+
+    def test_tee_writer(self):
+        handle = mock.Mock()
+        digest = mock.Mock()
+        stream = mock.Mock()
+        tee = TeeWriter(handle, [digest], [stream])
+        tee.write('xxx')
+        tee.write('yy')
+        self.assertEqual(tee.tell(), 5)
+        handle.write.assert_called_with('yy')
+        digest.update.assert_called_with('yy')
+        stream.write.assert_called_with('yy')
+        tee.flush()
+        handle.flush.assert_called_once_with()
+        tee.close()
+        self.assertFalse(handle.close.called)
+
+    @mock.patch('sachannelupdate.base.get_signer')
+    @mock.patch('sachannelupdate.base.write_hash')
+    @mock.patch('sachannelupdate.base.package')
+    @mock.patch('sachannelupdate.base.SignStream')
+    def test_build_archive(
+            self, mock_signer, mock_package, mock_write_hash,
+            mock_get_signer):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, '10.tar.gz')
+
+        def package(dest, tardir, version, fileobj, level, workers, repro):
+            "inline"
+            self.assertEqual((level, workers, repro), (9, 1, False))
+            fileobj.write('archive bytes')
+        mock_package.side_effect = package
+        mock_signer.return_value.close.return_value = 'signature'
+        config = dict(gpg_keyid='01213')
+        try:
+            self.assertEqual(build_archive(config, R_PATH, tmpdir, 10), path)
+            with open(path) as handle:
+                self.assertEqual(handle.read(), 'archive bytes')
+            with open('%s.asc' % path) as handle:
+                self.assertEqual(handle.read(), 'signature')
+        finally:
+            shutil.rmtree(tmpdir)
+        mock_get_signer.assert_called_once_with(config, '01213')
+        mock_signer.assert_called_once_with(
+            mock_get_signer.return_value, path)
+        mock_signer.return_value.write.assert_called_once_with(
+            'archive bytes')
+        mock_signer.return_value.close.assert_called_once_with()
+        mock_write_hash.assert_called_once_with(
+            path, sha1('archive bytes').hexdigest())
+
+    @mock.patch('sachannelupdate.base.get_signer')
+    @mock.patch('sachannelupdate.base.package')
+    @mock.patch('sachannelupdate.base.SignStream')
+    def test_build_archive_keys(
+            self, mock_signer, mock_package, mock_get_signer):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, '10.tar.gz')
+
+        def make_signer(signer, path):
+            "inline"
+            stream = mock.Mock()
+            stream.close.return_value = 'signature %d\n' % (
+                mock_signer.call_count)
+            return stream
+        mock_signer.side_effect = make_signer
+        config = dict(gpg_keyid='01213, 04567')
+        try:
+            build_archive(config, R_PATH, tmpdir, 10)
+            with open('%s.asc' % path) as handle:
+                self.assertEqual(
+                    handle.read(), 'signature 1\nsignature 2\n')
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(
+            mock_get_signer.call_args_list,
+            [mock.call(config, '01213'), mock.call(config, '04567')])
+        with self.assertRaises(CfgError):
+            build_archive({}, R_PATH, tmpdir, 10)
+
+    @mock.patch('sachannelupdate.base.SignStream')
+    def test_build_archive_bad_level(self, mock_signer):
+        with self.assertRaises(CfgError):
+            build_archive(dict(compress_level='11'), R_PATH, A_PATH, 10)
+        self.assertFalse(mock_signer.called)
+
+    @mock.patch('sachannelupdate.base.get_signer')
+    @mock.patch('sachannelupdate.base.write_hash')
+    @mock.patch('sachannelupdate.base.package')
+    @mock.patch('sachannelupdate.base.SignStream')
+    def test_build_archive_error(
+            self, mock_signer, mock_package, mock_write_hash,
+            mock_get_signer):
+        tmpdir = tempfile.mkdtemp()
+        mock_package.side_effect = IOError('disk full')
+        try:
+            with self.assertRaises(IOError):
+                build_archive(dict(gpg_keyid='01213'), R_PATH, tmpdir, 10)
+        finally:
+            shutil.rmtree(tmpdir)
+        mock_signer.return_value.abort.assert_called_once_with()
+        self.assertFalse(mock_signer.return_value.close.called)
+        self.assertFalse(mock_write_hash.called)
+
+    def test_package_parallel(self):
+        tmpdir = tempfile.mkdtemp()
+        dest = os.path.join(tmpdir, 'deploy')
+        os.mkdir(dest)
+        for num in range(4):
+            with open(os.path.join(dest, 'rule%d.cf' % num), 'w') as handle:
+                handle.write('score RULE_%d 1.0\n' % num * 5000)
+        try:
+            package(dest, tmpdir, 10, level=6, workers=4)
+            tar = tarfile.open(os.path.join(tmpdir, '10.tar.gz'))
+            names = sorted(tar.getnames())
+            content = tar.extractfile('rule2.cf').read()
+            tar.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(names, ['rule%d.cf' % num for num in range(4)])
+        self.assertEqual(content, 'score RULE_2 1.0\n' * 5000)
+
+    def test_package_parallel_error(self):
+        tmpdir = tempfile.mkdtemp()
+        dest = os.path.join(tmpdir, 'deploy')
+        os.mkdir(dest)
+        create_file(os.path.join(dest, 'rule.cf'), 'score RULE 1.0\n')
+        before = threading.active_count()
+        try:
+            for _ in range(3):
+                with mock.patch('sachannelupdate.base.tarfile.TarFile.add')\
+                        as mock_add:
+                    mock_add.side_effect = OSError('No such file')
+                    with self.assertRaises(OSError):
+                        package(dest, tmpdir, 10, workers=4)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_archive_key(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'rule.cf'), 'w') as handle:
+                handle.write('score RULE 1.0\n')
+            key = archive_key(tmpdir, 'A')
+            os.utime(os.path.join(tmpdir, 'rule.cf'), (1000, 1000))
+            self.assertEqual(archive_key(tmpdir, 'A'), key)
+            self.assertNotEqual(archive_key(tmpdir, 'B'), key)
+            with open(os.path.join(tmpdir, 'rule.cf'), 'a') as handle:
+                handle.write('score RULE2 1.0\n')
+            self.assertNotEqual(archive_key(tmpdir, 'A'), key)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_link_file(self):
+        tmpdir = tempfile.mkdtemp()
+        source = os.path.join(tmpdir, 'source')
+        dest = os.path.join(tmpdir, 'dest')
+        try:
+            create_file(source, 'xxx')
+            create_file(dest, 'old')
+            link_file(source, dest)
+            self.assertEqual(os.stat(source).st_ino, os.stat(dest).st_ino)
+            with mock.patch('sachannelupdate.base.os.link') as mock_link:
+                mock_link.side_effect = OSError('cross-device link')
+                link_file(source, dest)
+            self.assertNotEqual(
+                os.stat(source).st_ino, os.stat(dest).st_ino)
+            self.assertEqual(open(dest).read(), 'xxx')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch('sachannelupdate.signing.get_signer')
+    @mock.patch('sachannelupdate.base.SignStream')
+    def test_build_archive_store(self, mock_signer, mock_get_signer):
+        tmpdir = tempfile.mkdtemp()
+        dest = os.path.join(tmpdir, 'deploy')
+        os.mkdir(dest)
+        create_file(os.path.join(dest, 'rule.cf'), 'score RULE 1.0\n')
+        config = dict(reproducible='yes', gpg_keyid='01213', home_dir=tmpdir)
+        signed = []
+
+        def get_signer(config, keyid):
+            "inline"
+            signer = mock.Mock()
+            signer.sign.side_effect = lambda handle: signed.append(
+                keyid) or 'signature %s\n' % keyid
+            return signer
+        mock_get_signer.side_effect = get_signer
+        try:
+            first = build_archive(config, dest, tmpdir, 1)
+            self.assertEqual(signed, ['01213'])
+            key = archive_key(dest, '01213')
+            stored = os.path.join(tmpdir, 'store', '%s.tar.gz' % key)
+            self.assertEqual(read_hash(stored), read_hash(first))
+            second = build_archive(config, dest, tmpdir, 2)
+            self.assertEqual(signed, ['01213'])
+            self.assertEqual(
+                open(first, 'rb').read(), open(second, 'rb').read())
+            self.assertEqual(
+                open('%s.asc' % second).read(), 'signature 01213\n')
+            self.assertEqual(
+                open('%s.sha1' % second).read(),
+                HASHTMPL % (read_hash(first), '2.tar.gz'))
+            # rebuilding an existing version must not write into the store
+            create_file(os.path.join(dest, 'rule2.cf'), 'score R2 1.0\n')
+            build_archive(config, dest, tmpdir, 2)
+            self.assertEqual(signed, ['01213', '01213'])
+            self.assertEqual(
+                open(first, 'rb').read(), open(stored, 'rb').read())
+            # rolling over to a new key only signs with the new key
+            config['gpg_keyid'] = '01213 04567'
+            third = build_archive(config, dest, tmpdir, 3)
+            self.assertEqual(signed, ['01213', '01213', '04567'])
+            self.assertEqual(
+                open('%s.asc' % third).read(),
+                'signature 01213\nsignature 04567\n')
+            self.assertFalse(mock_signer.called)
+        finally:
+            shutil.rmtree(tmpdir)
+
     @mock.patch('sachannelupdate.base.deploy_file')
     @mock.patch('sachannelupdate.base.os.path.exists')
     def test_process_does_not_exist(self, mock_exists, mock_deploy_file):
-        rulefiles = Queue()
         dest = '/srv/www/saupdate'
-        rulefiles.put('/var/lib/saupdate/rule.cf')
+        rulefile = '/var/lib/saupdate/rule.cf'
+        destfile = '/srv/www/saupdate/rule.cf'
+        rulefiles = [rulefile]
+        manifest = mock.Mock(seen=set([rulefile]))
+        manifest.check.return_value = False
+        manifest.removed.return_value = []
         mock_exists.return_value = False
-        deploy = process(dest, rulefiles)
-        mock_exists.assert_called_once_with('/srv/www/saupdate/rule.cf')
+        deploy = process(dest, rulefiles, manifest)
+        manifest.check.assert_called_once_with(rulefile)
+        mock_exists.assert_called_once_with(destfile)
+        mock_deploy_file.assert_called_once_with(rulefile, destfile)
         self.assertEqual(deploy, True)
 
-    @mock.patch('sachannelupdate.base.os.stat')
     @mock.patch('sachannelupdate.base.deploy_file')
     @mock.patch('sachannelupdate.base.os.path.exists')
-    def test_process_exists(self, mock_exists, mock_deploy_file, mock_stat):
-        rulefiles = Queue()
+    def test_process_exists(self, mock_exists, mock_deploy_file):
         dest = '/srv/www/saupdate'
         rulefile = '/var/lib/saupdate/rule.cf'
         destfile = '/srv/www/saupdate/rule.cf'
-        rulefiles.put(rulefile)
-        mock_stat.side_effect = stat_side_effects
+        rulefiles = [rulefile]
+        manifest = mock.Mock(seen=set([rulefile]))
+        manifest.check.return_value = False
+        manifest.removed.return_value = []
         mock_exists.return_value = True
-        deploy = process(dest, rulefiles)
+        stats = {}
+        deploy = process(dest, rulefiles, manifest, stats=stats)
+        manifest.check.assert_called_once_with(rulefile)
         mock_exists.assert_called_once_with(destfile)
-        expected_calls = [mock.call(rulefile), mock.call(destfile)]
+        self.assertFalse(mock_deploy_file.called)
+        self.assertEqual(deploy, False)
+        self.assertEqual(stats, dict(bytes=0))
+
+    @mock.patch('sachannelupdate.base.deploy_file')
+    @mock.patch('sachannelupdate.base.os.path.exists')
+    def test_process_changed(self, mock_exists, mock_deploy_file):
+        dest = '/srv/www/saupdate'
+        rulefile = '/var/lib/saupdate/rule.cf'
+        destfile = '/srv/www/saupdate/rule.cf'
+        rulefiles = [rulefile]
+        manifest = mock.Mock(seen=set([rulefile]))
+        manifest.check.return_value = True
+        manifest.removed.return_value = []
+        mock_exists.return_value = True
+        mock_deploy_file.return_value = 15
+        stats = dict(bytes=0)
+        deploy = process(dest, rulefiles, manifest, stats=stats)
+        mock_deploy_file.assert_called_once_with(rulefile, destfile)
+        self.assertEqual(deploy, True)
+        self.assertEqual(stats, dict(bytes=15))
+
+    @mock.patch('sachannelupdate.base.os.unlink')
+    @mock.patch('sachannelupdate.base.deploy_file')
+    @mock.patch('sachannelupdate.base.os.path.exists')
+    def test_process_removed(
+            self, mock_exists, mock_deploy_file, mock_unlink):
+        rulefiles = []
+        dest = '/srv/www/saupdate'
+        rulefile = '/var/lib/saupdate/rule.cf'
+        manifest = mock.Mock(seen=set())
+        manifest.removed.return_value = [rulefile]
+        mock_exists.return_value = True
+        deploy = process(dest, rulefiles, manifest)
+        manifest.forget.assert_called_once_with(rulefile)
+        mock_unlink.assert_called_once_with('/srv/www/saupdate/rule.cf')
+        self.assertFalse(mock_deploy_file.called)
         self.assertEqual(deploy, True)
-        self.assertEqual(expected_calls, mock_stat.call_args_list)
+
+    @mock.patch('sachannelupdate.base.deploy_file')
+    @mock.patch('sachannelupdate.base.os.path.exists')
+    def test_process_workers(self, mock_exists, mock_deploy_file):
+        dest = '/srv/www/saupdate'
+        names = ['rule%d.cf' % num for num in range(8)]
+        rulefiles = (os.path.join('/var/lib/saupdate', name)
+                     for name in names)
+        manifest = mock.Mock(seen=set())
+        manifest.check.side_effect = lambda path: path.endswith('3.cf')
+        manifest.removed.return_value = []
+        mock_exists.return_value = True
+        deploy = process(dest, rulefiles, manifest, 4)
+        self.assertEqual(deploy, True)
+        self.assertEqual(manifest.check.call_count, len(names))
+        mock_deploy_file.assert_called_once_with(
+            '/var/lib/saupdate/rule3.cf', '/srv/www/saupdate/rule3.cf')
+
+    @mock.patch('sachannelupdate.base.deploy_file')
+    @mock.patch('sachannelupdate.base.os.path.exists')
+    def test_process_errors(self, mock_exists, mock_deploy_file):
+        dest = '/srv/www/saupdate'
+        rulefiles = [os.path.join('/var/lib/saupdate', name)
+                     for name in ('rule1.cf', 'rule2.cf', 'rule3.cf')]
+        manifest = mock.Mock(seen=set())
+        manifest.check.return_value = True
+        mock_exists.return_value = True
+        mock_deploy_file.side_effect = [
+            IOError('disk full'), 15, OSError('permission denied')]
+        with self.assertRaises(SaChannelUpdateDeployError) as cma:
+            process(dest, rulefiles, manifest)
+        self.assertEqual(cma.exception.errors, [
+            '/var/lib/saupdate/rule1.cf: disk full',
+            '/var/lib/saupdate/rule3.cf: permission denied'])
+        self.assertTrue(cma.exception.changed)
+        self.assertEqual(mock_deploy_file.call_count, 3)
+        self.assertEqual(manifest.invalidate.call_args_list, [
+            mock.call('/var/lib/saupdate/rule1.cf'),
+            mock.call('/var/lib/saupdate/rule3.cf')])
+
+    @mock.patch('sachannelupdate.base.deploy_file')
+    @mock.patch('sachannelupdate.base.os.path.exists')
+    def test_deploy_rule(self, mock_exists, mock_deploy_file):
+        manifest = mock.Mock()
+        manifest.check.return_value = False
+        mock_exists.return_value = True
+        self.assertEqual(
+            deploy_rule('/srv', manifest, '/var/lib/saupdate/rule.cf'),
+            (False, 0, None))
+        manifest.check.return_value = True
+        mock_deploy_file.return_value = 15
+        self.assertEqual(
+            deploy_rule('/srv', manifest, '/var/lib/saupdate/rule.cf'),
+            (True, 15, None))
+        mock_deploy_file.reset_mock()
+        manifest.check.side_effect = OSError('No such file')
+        self.assertEqual(
+            deploy_rule('/srv', manifest, '/var/lib/saupdate/rule.cf'),
+            (False, 0, '/var/lib/saupdate/rule.cf: No such file'))
+        self.assertFalse(mock_deploy_file.called)
+        manifest.invalidate.assert_called_once_with(
+            '/var/lib/saupdate/rule.cf')
 
     @mock.patch('sachannelupdate.base.create_file')
     @mock.patch('sachannelupdate.base.open')
@@ -147,9 +537,25 @@ class BaseTestCase(unittest2.TestCase):
             'file or directory %s not found' % counterfile)
         version = get_counter(counterfile)
         mock_open.assert_called_once_with(counterfile)
-        mock_create_file.assert_called_once_with(counterfile, '1')
+        self.assertFalse(mock_create_file.called)
         self.assertEqual(version, 1)
 
+    def test_replace_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            counterfile = os.path.join(tmpdir, 'counters')
+            create_file(counterfile, '1')
+            with mock.patch('sachannelupdate.base.os.rename') as mock_rename:
+                mock_rename.side_effect = OSError('crash')
+                with self.assertRaises(OSError):
+                    replace_file(counterfile, '2')
+            self.assertEqual(open(counterfile).read(), '1')
+            replace_file(counterfile, '2')
+            self.assertEqual(open(counterfile).read(), '2')
+            self.assertEqual(os.listdir(tmpdir), ['counters'])
+        finally:
+            shutil.rmtree(tmpdir)
+
     @mock.patch('sachannelupdate.base.create_file')
     @mock.patch('sachannelupdate.base.open')
     def test_get_counter_permission_oserror(self, mock_open, mock_create_file):
@@ -174,8 +580,115 @@ class BaseTestCase(unittest2.TestCase):
         record = 'update'
         sa_version = '3.4.1'
         config = dict(dns_key='6e2347bc-278e-42f6-a84b-fa1766140cbd')
+        mock_query.tcp.return_value.rcode.return_value = rcode.NOERROR
         result = update_dns(config, record, sa_version)
-        self.assertEqual(result, True)
+        self.assertEqual(result, {'3.4.1.sa.baruwa.com.': True})
+
+    @mock.patch('sachannelupdate.base.query')
+    def test_update_dns_batch(self, mock_query):
+        config = dict(
+            domain_name='sa.example.com.',
+            domain_key='c2VjcmV0IGtleSBmb3IgdGVzdHM=')
+        mock_query.tcp.return_value.rcode.return_value = rcode.NOERROR
+        result = update_dns(config, '5', ['3.3.2', '3.4.1', '4.0.0'])
+        self.assertEqual(result, {
+            '3.3.2.sa.example.com.': True,
+            '3.4.1.sa.example.com.': True,
+            '4.0.0.sa.example.com.': True})
+        self.assertEqual(mock_query.tcp.call_count, 1)
+        transaction = mock_query.tcp.call_args[0][0]
+        # replace deletes and adds each rrset
+        self.assertEqual(
+            set([rrset.name.to_text() for rrset in transaction.authority]),
+            set(['3.3.2.sa.example.com.', '3.4.1.sa.example.com.',
+                 '4.0.0.sa.example.com.']))
+        self.assertEqual(
+            set([item.to_text() for rrset in transaction.authority
+                 for item in rrset.items]), set(['"5"']))
+        self.assertEqual(transaction.keyname.to_text(), 'sa.example.com.')
+
+    @mock.patch('sachannelupdate.base.error')
+    @mock.patch('sachannelupdate.base.query')
+    @mock.patch('sachannelupdate.base.update')
+    @mock.patch('sachannelupdate.base.tsigkeyring')
+    def test_update_dns_refused(
+            self, mock_tsigkeyring, mock_update, mock_query, mock_error):
+        config = dict(domain_name='sa.example.com.')
+        mock_query.tcp.return_value.rcode.return_value = rcode.REFUSED
+        result = update_dns(config, '5', ['3.3.2', '3.4.1'])
+        self.assertEqual(result, {
+            '3.3.2.sa.example.com.': False,
+            '3.4.1.sa.example.com.': False})
+        mock_error.assert_called_once_with(
+            'DNS update of 3.3.2.sa.example.com., 3.4.1.sa.example.com. '
+            'on 127.0.0.1 failed: REFUSED')
+
+    @mock.patch('sachannelupdate.base.info')
+    @mock.patch('sachannelupdate.base.error')
+    @mock.patch('sachannelupdate.base.query')
+    @mock.patch('sachannelupdate.base.update')
+    @mock.patch('sachannelupdate.base.tsigkeyring')
+    def test_update_dns_servers(
+            self, mock_tsigkeyring, mock_update, mock_query, mock_error,
+            mock_info):
+        config = dict(
+            domain_name='sa.example.com.',
+            domain_ip='10.0.0.1, 192.168.1.1',
+            dns_timeout='3',
+            dns_port='5353')
+        # the servers are updated on pool threads and mock call counts
+        # are not thread safe, record the queries under a lock
+        lock = threading.Lock()
+        calls = []
+
+        def tcp(transaction, server, timeout, port):
+            with lock:
+                calls.append((server, timeout, port))
+            if server == '192.168.1.1':
+                raise DNSTimeout()
+            response = mock.Mock()
+            response.rcode.return_value = rcode.NOERROR
+            return response
+        mock_query.tcp.side_effect = tcp
+        result = update_dns(config, '5', '3.4.1')
+        self.assertEqual(result, {'3.4.1.sa.example.com.': False})
+        self.assertEqual(
+            sorted(calls),
+            [('10.0.0.1', 3, 5353), ('192.168.1.1', 3, 5353)])
+        self.assertEqual(mock_info.call_count, 2)
+        self.assertTrue(
+            mock_info.call_args_list[0][0][0].startswith(
+                'DNS update via 10.0.0.1: NOERROR in '))
+        self.assertEqual(mock_error.call_count, 1)
+        self.assertTrue(
+            mock_error.call_args[0][0].startswith(
+                'DNS update of 3.4.1.sa.example.com. on 192.168.1.1 failed: '))
+        mock_query.tcp.side_effect = None
+        mock_query.tcp.return_value.rcode.return_value = rcode.NOERROR
+        result = update_dns(config, '5', '3.4.1')
+        self.assertEqual(result, {'3.4.1.sa.example.com.': True})
+
+    @mock.patch.dict('sachannelupdate.base.KEYRINGS', clear=True)
+    @mock.patch('sachannelupdate.base.tsigkeyring')
+    def test_get_keyring(self, mock_tsigkeyring):
+        self.assertEqual(
+            get_keyring('sa.example.com.', 'a2V5'),
+            mock_tsigkeyring.from_text.return_value)
+        get_keyring('sa.example.com.', 'a2V5')
+        mock_tsigkeyring.from_text.assert_called_once_with(
+            {'sa.example.com.': 'a2V5'})
+
+    def test_get_dns_servers(self):
+        self.assertEqual(get_dns_servers({}), ['127.0.0.1'])
+        self.assertEqual(
+            get_dns_servers({'domain_ip': '10.0.0.1,192.168.1.1 ::1'}),
+            ['10.0.0.1', '192.168.1.1', '::1'])
+
+    def test_get_sa_versions(self):
+        self.assertEqual(get_sa_versions({}), ['1.4.3'])
+        self.assertEqual(
+            get_sa_versions({'spamassassin_version': '3.3.2, 3.4.1 3.3.2'}),
+            ['3.3.2', '3.4.1'])
 
     @mock.patch('sachannelupdate.base.query')
     @mock.patch('sachannelupdate.base.update')
@@ -189,33 +702,13 @@ class BaseTestCase(unittest2.TestCase):
             update_dns(config, record, sa_version)
         # self.assertEqual(result, True)
 
-    @mock.patch('sachannelupdate.base.open')
-    @mock.patch('sachannelupdate.base.GPG')
-    def test_sign(self, mock_gpg, mock_open):
-        gpg_pass = 'xxxxxx'
-        gpg_keyid = '01213'
-        filename = '40.tar.gz'
-        plaintext = 'testing rule'
-        gpg_home = '/var/lib/sachannelupdate/gnupg'
-        config = dict(gpg_passphrase=gpg_pass, gpg_keyid=gpg_keyid)
-        mock_open.return_value.read.return_value = plaintext
-        sign(config, filename)
-        expected_calls = [
-            mock.call(filename, 'rb'),
-            mock.call('%s.asc' % filename, 'wb')
-        ]
-        mock_gpg.assert_called_once_with(gnupghome=gpg_home)
-        mock_gpg.return_value.sign_file.assert_called_once_with(
-            mock_open.return_value,
-            keyid=gpg_keyid,
-            passphrase=gpg_pass,
-            detach=True)
-        file_handle = mock_open.return_value.__enter__.return_value
-        file_handle.write.assert_called_with(
-            str(mock_gpg.return_value.sign_file.return_value)
-        )
-        mock_open.return_value.close.assert_called_once_with()
-        self.assertEqual(expected_calls, mock_open.call_args_list)
+    @mock.patch('sachannelupdate.base.get_signer')
+    def test_sign(self, mock_get_signer):
+        config = dict(gpg_passphrase='xxxxxx', gpg_keyid='01213')
+        sign(config, '40.tar.gz')
+        mock_get_signer.assert_called_once_with(config)
+        mock_get_signer.return_value.sign_file.assert_called_once_with(
+            '40.tar.gz')
 
     @mock.patch('sachannelupdate.base.create_file')
     @mock.patch('sachannelupdate.base.os')
@@ -254,101 +747,204 @@ score           RCVD_IN_BARUWAWL                        -5.0
             )
             self.assertTrue(mock_create_file.called)
 
-    @mock.patch('sachannelupdate.base.os')
-    @mock.patch('sachannelupdate.base.get_remote_path')
-    @mock.patch('sachannelupdate.base.get_sftp_conn')
-    def test_upload(self, mock_sftp_conn, mock_remote_path, mock_os):
-        mock_sftp = mock.Mock()
-        mock_transport = mock.Mock()
-        mock_sftp_conn.return_value = [mock_sftp, mock_transport]
+    @mock.patch('sachannelupdate.base.create_file')
+    def test_write_hash(self, mock_create_file):
+        write_hash('/srv/40.tar.gz', 'xxxxxxssasa')
+        mock_create_file.assert_called_once_with(
+            '/srv/40.tar.gz.sha1', HASHTMPL % ('xxxxxxssasa', '40.tar.gz'))
+
+    @mock.patch('sachannelupdate.transports.put_file')
+    @mock.patch('sachannelupdate.transports.same_file')
+    @mock.patch('sachannelupdate.transports.same_size')
+    @mock.patch('sachannelupdate.base.read_hash')
+    @mock.patch('sachannelupdate.transports.sftp_session')
+    def test_upload(
+            self, mock_sftp_session, mock_read_hash, mock_same_size,
+            mock_same_file, mock_put_file):
+        remote_loc = 'sftp://127.0.0.1/srv/www/saupdate'
+        mock_sftp = mock_sftp_session.return_value.__enter__.return_value
+        mock_read_hash.return_value = 'xxxx'
+        mock_same_size.return_value = False
+        mock_same_file.return_value = False
+        self.assertTrue(upload({}, remote_loc, '/srv/archives/10.tar.gz'))
+        mock_sftp_session.assert_called_once_with({}, remote_loc)
+        self.assertEqual(
+            mock_sftp_session.return_value.__exit__.call_args,
+            mock.call(None, None, None))
+        mock_read_hash.assert_called_once_with('/srv/archives/10.tar.gz')
+        self.assertEqual(mock_put_file.call_args_list, [
+            mock.call(
+                mock_sftp, '/srv/archives/10.tar.gz',
+                '/srv/www/saupdate/10.tar.gz',
+                '/srv/www/saupdate/10.tar.gz.xxxx.part', resume=True,
+                blocksize=262144),
+            mock.call(
+                mock_sftp, '/srv/archives/10.tar.gz.asc',
+                '/srv/www/saupdate/10.tar.gz.asc',
+                '/srv/www/saupdate/10.tar.gz.asc.part'),
+            mock.call(
+                mock_sftp, '/srv/archives/10.tar.gz.sha1',
+                '/srv/www/saupdate/10.tar.gz.sha1',
+                '/srv/www/saupdate/10.tar.gz.sha1.part'),
+        ])
+
+    @mock.patch('sachannelupdate.transports.put_file')
+    @mock.patch('sachannelupdate.transports.same_file')
+    @mock.patch('sachannelupdate.transports.same_size')
+    @mock.patch('sachannelupdate.base.read_hash')
+    @mock.patch('sachannelupdate.transports.sftp_session')
+    def test_upload_present(
+            self, mock_sftp_session, mock_read_hash, mock_same_size,
+            mock_same_file, mock_put_file):
+        mock_same_size.return_value = True
+        mock_same_file.return_value = True
         self.assertTrue(upload(
-            mock.sentinel.config,
-            mock.sentinel.remote_loc,
-            mock.sentinel.u_filename
-        ))
-        mock_sftp_conn.assert_called_once_with(mock.sentinel.config)
-        mock_remote_path.assert_called_once_with(mock.sentinel.remote_loc)
-        mock_transport.close.assert_called_once_with()
-        self.assertEqual(mock_os.path.join.call_count, 3)
+            {}, 'sftp://127.0.0.1/srv/www/saupdate',
+            '/srv/archives/10.tar.gz'))
+        self.assertFalse(mock_put_file.called)
+        self.assertEqual(mock_same_file.call_count, 3)
 
-    @mock.patch('sachannelupdate.base.os')
-    @mock.patch('sachannelupdate.base.get_remote_path')
-    @mock.patch('sachannelupdate.base.get_sftp_conn')
-    def test_upload_excp(self, mock_sftp_conn, mock_remote_path, mock_os):
-        mock_sftp = mock.Mock()
-        mock_transport = mock.Mock()
-        mock_sftp.put.side_effect = ValueError()
-        mock_sftp_conn.return_value = [mock_sftp, mock_transport]
+    @mock.patch('sachannelupdate.base.info')
+    @mock.patch('sachannelupdate.transports.put_file')
+    @mock.patch('sachannelupdate.transports.same_file')
+    @mock.patch('sachannelupdate.transports.same_size')
+    @mock.patch('sachannelupdate.base.read_hash')
+    @mock.patch('sachannelupdate.transports.sftp_session')
+    def test_upload_archive_only(
+            self, mock_sftp_session, mock_read_hash, mock_same_size,
+            mock_same_file, mock_put_file, mock_info):
+        mock_same_size.return_value = True
+        mock_same_file.side_effect = [False, True, True]
+        mock_put_file.return_value = 'transfer stats'
+        self.assertTrue(upload(
+            dict(sftp_block_size='65536'),
+            'sftp://127.0.0.1/srv/www/saupdate', '/srv/archives/10.tar.gz'))
+        self.assertEqual(mock_put_file.call_count, 1)
+        self.assertEqual(mock_put_file.call_args[1], dict(
+            resume=True, blocksize=65536))
+        mock_info.assert_called_once_with('Sent transfer stats')
+
+    @mock.patch('sachannelupdate.base.error')
+    @mock.patch('sachannelupdate.transports.put_file')
+    @mock.patch('sachannelupdate.transports.same_size')
+    @mock.patch('sachannelupdate.base.read_hash')
+    @mock.patch('sachannelupdate.transports.sftp_session')
+    def test_upload_excp(
+            self, mock_sftp_session, mock_read_hash, mock_same_size,
+            mock_put_file, mock_error):
+        mock_sftp_session.return_value.__exit__.return_value = False
+        mock_same_size.return_value = False
+        mock_put_file.side_effect = IOError('Permission denied')
         self.assertFalse(upload(
-            mock.sentinel.config,
-            mock.sentinel.remote_loc,
-            mock.sentinel.u_filename
-        ))
-        mock_sftp_conn.assert_called_once_with(mock.sentinel.config)
-        mock_remote_path.assert_called_once_with(mock.sentinel.remote_loc)
-        mock_transport.close.assert_called_once_with()
-
-    @mock.patch('sachannelupdate.base.os.walk')
-    def test_queue_files(self, mock_walk):
-        mock_queue = mock.Mock(spec=Queue)
-        mock_walk.return_value = [
-            (A_PATH, (), A_FILES)
-        ]
-        expected_calls = [
-            mock.call('%s/%s' % (A_PATH, filename)) for filename in A_FILES
-        ]
-        queue_files(A_PATH, mock_queue)
-        mock_walk.assert_called_once_with(A_PATH)
-        self.assertTrue(mock_queue.put.called)
-        self.assertEqual(expected_calls, mock_queue.put.call_args_list)
-
-    @mock.patch('sachannelupdate.base.os.walk')
-    def test_queue_files_none(self, mock_walk):
-        mock_queue = mock.Mock(spec=Queue)
-        mock_walk.return_value = [
-            (A_PATH, (), ())
-        ]
-        queue_files(A_PATH, mock_queue)
-        mock_walk.assert_called_once_with(A_PATH)
+            {}, 'sftp://127.0.0.1/srv/www/saupdate',
+            '/srv/archives/10.tar.gz'))
+        self.assertTrue(mock_sftp_session.return_value.__exit__.called)
+        mock_error.assert_called_once_with(
+            'Upload to sftp://127.0.0.1/srv/www/saupdate failed: '
+            'Permission denied')
 
-    @mock.patch('sachannelupdate.base.os.path.isfile')
-    @mock.patch('sachannelupdate.base.os.walk')
-    def test_get_cf_files(self, mock_walk, mock_isfile):
-        mock_queue = mock.Mock(spec=Queue)
-        mock_walk.return_value = [
-            (R_PATH, (), CF_FILES)
-        ]
-        mock_isfile.return_value = True
-        expected_calls = [
-            mock.call('%s/%s' % (R_PATH, filename))
-            for filename in CF_FILES
-            if (filename.endswith('.cf') or filename.endswith('.post'))
-        ]
-        get_cf_files(R_PATH, mock_queue)
-        mock_walk.assert_called_once_with(R_PATH)
-        self.assertTrue(mock_queue.put.called)
-        self.assertEqual(expected_calls, mock_queue.put.call_args_list)
+    @mock.patch('sachannelupdate.base.info')
+    @mock.patch('sachannelupdate.base.upload')
+    def test_upload_mirrors(self, mock_upload, mock_info):
+        config = dict(
+            remote_location='sftp://mirror1/srv/sa, sftp://mirror2/srv/sa')
+        mock_upload.side_effect = lambda cfg, remote, name: \
+            remote == 'sftp://mirror1/srv/sa'
+        results = upload_mirrors(config, '/srv/archives/10.tar.gz')
+        self.assertEqual(results, {
+            'sftp://mirror1/srv/sa': True,
+            'sftp://mirror2/srv/sa': False})
+        self.assertEqual(mock_upload.call_count, 2)
+        mock_info.assert_called_once_with(
+            'Uploaded /srv/archives/10.tar.gz to sftp://mirror1/srv/sa')
 
-    @mock.patch('sachannelupdate.base.os.path.isfile')
-    @mock.patch('sachannelupdate.base.os.walk')
-    def test_get_cf_files_none(self, mock_walk, mock_isfile):
-        mock_queue = mock.Mock(spec=Queue)
-        mock_walk.return_value = [
-            (R_PATH, (), ())
-        ]
-        mock_isfile.return_value = True
-        get_cf_files(R_PATH, mock_queue)
-        mock_walk.assert_called_once_with(R_PATH)
+    def test_get_remote_locations(self):
+        self.assertEqual(get_remote_locations({}), [])
+        self.assertEqual(
+            get_remote_locations(dict(remote_location='sftp://a/x')),
+            ['sftp://a/x'])
+        self.assertEqual(
+            get_remote_locations(
+                dict(remote_location='sftp://a/x,sftp://b/x\n sftp://c/x')),
+            ['sftp://a/x', 'sftp://b/x', 'sftp://c/x'])
+
+    def test_get_quorum(self):
+        config = dict(remote_location='sftp://a/x sftp://b/x sftp://c/x')
+        self.assertEqual(get_quorum(config), 3)
+        config['upload_quorum'] = '2'
+        self.assertEqual(get_quorum(config), 2)
+        config['upload_quorum'] = '4'
+        with self.assertRaises(CfgError):
+            get_quorum(config)
+        config['upload_quorum'] = '0'
+        with self.assertRaises(CfgError):
+            get_quorum(config)
+
+    @mock.patch('sachannelupdate.base.iter_files')
+    def test_get_cf_files(self, mock_iter_files):
+        self.assertEqual(
+            get_cf_files(R_PATH), mock_iter_files.return_value)
+        path, rule_filter = mock_iter_files.call_args[0]
+        self.assertEqual(path, R_PATH)
+        self.assertEqual(rule_filter.include, ('*.cf', '*.post'))
+        self.assertEqual(rule_filter.exclude, ('.*',))
+        rule_filter = RuleFilter(('*.cf',), ())
+        get_cf_files(R_PATH, rule_filter)
+        mock_iter_files.assert_called_with(R_PATH, rule_filter)
+
+    def test_get_cf_files_tree(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'sub', '70_dir.post'))
+            os.makedirs(os.path.join(tmpdir, '.git'))
+            for name in CF_FILES + ('.git/HEAD.cf', 'sub/72_sub.cf'):
+                open(os.path.join(tmpdir, name), 'w').close()
+            self.assertEqual(
+                sorted(get_cf_files(tmpdir)),
+                [os.path.join(tmpdir, '70_baruwa.cf'),
+                 os.path.join(tmpdir, '70_baruwa.post'),
+                 os.path.join(tmpdir, 'sub', '72_sub.cf')])
+        finally:
+            shutil.rmtree(tmpdir)
 
     @mock.patch('sachannelupdate.base.os.unlink')
-    @mock.patch('sachannelupdate.base.os.walk')
+    @mock.patch('sachannelupdate.base.iter_files')
     @mock.patch('sachannelupdate.base.os.path.exists')
-    def test_cleanup(self, mock_os_path_exists, mock_os_walk, mock_os_unlink):
+    def test_cleanup(self, mock_os_path_exists, mock_iter_files,
+                     mock_os_unlink):
         mock_os_path_exists.return_value = True
-        mock_os_walk.side_effect = queue_files_side_effects
+        mock_iter_files.side_effect = iter_files_side_effects
         counterfile = '/var/lib/sarulesupdate/db/counters'
         cleanup(R_PATH, A_PATH, counterfile)
         self.assertEqual(mock_os_unlink.call_count, 6)
+        mock_os_unlink.assert_any_call('%s/%s' % (A_PATH, A_FILES[0]))
+
+    @mock.patch('sachannelupdate.base.os.unlink')
+    @mock.patch('sachannelupdate.base.iter_files')
+    @mock.patch('sachannelupdate.base.os.path.exists')
+    def test_cleanup_manifest(
+            self, mock_os_path_exists, mock_iter_files, mock_os_unlink):
+        mock_os_path_exists.return_value = True
+        mock_iter_files.side_effect = iter_files_side_effects
+        counterfile = '/var/lib/sarulesupdate/db/counters'
+        manifestfile = '/var/lib/sarulesupdate/db/manifest'
+        cleanup(R_PATH, A_PATH, counterfile, manifestfile)
+        self.assertEqual(mock_os_unlink.call_count, 7)
+        mock_os_unlink.assert_called_with(manifestfile)
+
+    @mock.patch('sachannelupdate.base.os.unlink')
+    @mock.patch('sachannelupdate.base.iter_files')
+    @mock.patch('sachannelupdate.base.os.path.exists')
+    def test_cleanup_snapshot(
+            self, mock_os_path_exists, mock_iter_files, mock_os_unlink):
+        mock_os_path_exists.return_value = True
+        mock_iter_files.side_effect = iter_files_side_effects
+        cleanup(R_PATH, A_PATH, '/var/lib/sarulesupdate/db/counters',
+                '/var/lib/sarulesupdate/db/manifest',
+                '/var/lib/sarulesupdate/db/snapshot')
+        self.assertEqual(mock_os_unlink.call_count, 8)
+        mock_os_unlink.assert_called_with(
+            '/var/lib/sarulesupdate/db/snapshot')
 
     def test_check_required(self):
         config = {}
@@ -366,68 +962,432 @@ score           RCVD_IN_BARUWAWL                        -5.0
                 'The remote_location option is required'
             )
         with self.assertRaises(CfgError) as cma:
-            config['remote_loc'] = mock.sentinel.remote_loc
+            config['remote_location'] = 'sftp://127.0.0.1/srv/www/saupdate'
             check_required(config)
             self.assertEqual(
                 cma.exception.message,
                 'The gpg_keyid option is required'
             )
 
-    @mock.patch('sachannelupdate.base.create_file')
+    @mock.patch('sachannelupdate.base.Manifest')
+    @mock.patch('sachannelupdate.base.replace_file')
     @mock.patch('sachannelupdate.base.update_dns')
-    @mock.patch('sachannelupdate.base.upload')
-    @mock.patch('sachannelupdate.base.hash_file')
-    @mock.patch('sachannelupdate.base.sign')
-    @mock.patch('sachannelupdate.base.package')
+    @mock.patch('sachannelupdate.base.upload_mirrors')
+    @mock.patch('sachannelupdate.base.build_archive')
     @mock.patch('sachannelupdate.base.get_counter')
     @mock.patch('sachannelupdate.base.process')
-    @mock.patch('sachannelupdate.base.os.path.isfile')
-    @mock.patch('sachannelupdate.base.os.walk')
+    @mock.patch('sachannelupdate.base.os.path.getsize')
+    @mock.patch('sachannelupdate.base.get_cf_files')
     def test_entry(
         self,
-        mock_walk,
-        mock_isfile,
+        mock_get_cf_files,
+        mock_getsize,
         mock_process,
         mock_get_counter,
-        mock_package,
-        mock_sign,
-        mock_hash_file,
-        mock_upload,
+        mock_build_archive,
+        mock_upload_mirrors,
         mock_update_dns,
-            mock_create_file):
+        mock_replace_file,
+            mock_manifest):
         config = dict(
             domain_key=mock.sentinel.domain_key,
-            remote_loc=mock.sentinel.remote_loc,
+            remote_location='sftp://127.0.0.1/srv/www/saupdate',
             gpg_keyid=mock.sentinel.gpg_keyid,
         )
-        mock_walk.return_value = [
-            (R_PATH, (), CF_FILES)
-        ]
-        mock_isfile.return_value = True
+        mock_get_cf_files.return_value = iter(
+            ['%s/%s' % (R_PATH, CF_FILES[0])])
         mock_process.return_value = True
         mock_get_counter.return_value = 1
-        entry(config)
-        self.assertTrue(mock_walk.called)
-        self.assertTrue(mock_isfile.called)
-        self.assertTrue(mock_process.called)
+        mock_upload_mirrors.return_value = {
+            'sftp://127.0.0.1/srv/www/saupdate': True}
+        mock_update_dns.return_value = {'1.4.3.sa.baruwa.com.': True}
+        self.assertEqual(
+            entry(config), dict(status='published', version=1))
+        self.assertEqual(
+            mock_get_cf_files.call_args[0][0],
+            '/var/lib/sachannelupdate/rules')
+        self.assertEqual(
+            mock_process.call_args[0][1], mock_get_cf_files.return_value)
         self.assertTrue(mock_get_counter.called)
-        self.assertTrue(mock_package.called)
-        self.assertTrue(mock_sign.called)
-        self.assertTrue(mock_hash_file.called)
-        self.assertTrue(mock_upload.called)
+        mock_build_archive.assert_called_once_with(
+            config,
+            '/var/lib/sachannelupdate/deploy',
+            '/var/lib/sachannelupdate/archives',
+            1)
+        mock_upload_mirrors.assert_called_once_with(
+            config, mock_build_archive.return_value)
         self.assertTrue(mock_update_dns.called)
-        self.assertTrue(mock_create_file.called)
+        self.assertTrue(mock_replace_file.called)
+        mock_manifest.return_value.save.assert_called_once_with()
+
+    @mock.patch('sachannelupdate.base.error')
+    @mock.patch('sachannelupdate.base.Manifest')
+    @mock.patch('sachannelupdate.base.replace_file')
+    @mock.patch('sachannelupdate.base.update_dns')
+    @mock.patch('sachannelupdate.base.upload_mirrors')
+    @mock.patch('sachannelupdate.base.build_archive')
+    @mock.patch('sachannelupdate.base.get_counter')
+    @mock.patch('sachannelupdate.base.process')
+    @mock.patch('sachannelupdate.base.os.path.getsize')
+    @mock.patch('sachannelupdate.base.get_cf_files')
+    def test_entry_no_quorum(
+        self,
+        mock_get_cf_files,
+        mock_getsize,
+        mock_process,
+        mock_get_counter,
+        mock_build_archive,
+        mock_upload_mirrors,
+        mock_update_dns,
+        mock_replace_file,
+        mock_manifest,
+            mock_error):
+        config = dict(
+            domain_key=mock.sentinel.domain_key,
+            remote_location='sftp://a/x sftp://b/x sftp://c/x',
+            upload_quorum='2',
+            gpg_keyid=mock.sentinel.gpg_keyid,
+        )
+        mock_get_cf_files.return_value = []
+        mock_process.return_value = True
+        mock_get_counter.return_value = 1
+        mock_upload_mirrors.return_value = {
+            'sftp://a/x': True, 'sftp://b/x': False, 'sftp://c/x': False}
+        self.assertEqual(entry(config), dict(status='failed', version=1))
+        mock_error.assert_called_once_with(
+            'Uploaded to 1 of 3 mirrors, a quorum of 2 is needed')
+        self.assertFalse(mock_update_dns.called)
+        self.assertFalse(mock_replace_file.called)
+        # deploy changed, the manifest follows it while the new content
+        # stays pending until it is published
+        mock_manifest.return_value.save.assert_called_once_with()
+        self.mock_mark_pending.assert_called_once_with(
+            '/var/lib/sachannelupdate/db/pending')
+        mock_upload_mirrors.return_value['sftp://b/x'] = True
+        mock_update_dns.return_value = {
+            '3.3.2.sa.baruwa.com.': False, '3.4.1.sa.baruwa.com.': False}
+        config['spamassassin_version'] = '3.3.2 3.4.1'
+        entry(config)
+        mock_update_dns.assert_called_once_with(
+            config, '1', ['3.3.2', '3.4.1'])
+        self.assertFalse(mock_replace_file.called)
+        mock_update_dns.return_value = {
+            '3.3.2.sa.baruwa.com.': True, '3.4.1.sa.baruwa.com.': True}
+        entry(config)
+        self.assertTrue(mock_replace_file.called)
+
+    @mock.patch('sachannelupdate.base.Manifest')
+    @mock.patch('sachannelupdate.base.get_counter')
+    @mock.patch('sachannelupdate.base.process')
+    @mock.patch('sachannelupdate.base.get_cf_files')
+    def test_entry_no_change(
+            self, mock_get_cf_files, mock_process, mock_get_counter,
+            mock_manifest):
+        config = dict(
+            domain_key=mock.sentinel.domain_key,
+            remote_location='sftp://127.0.0.1/srv/www/saupdate',
+            gpg_keyid=mock.sentinel.gpg_keyid,
+        )
+        mock_get_cf_files.return_value = []
+        mock_process.return_value = False
+        self.assertEqual(
+            entry(config), dict(status='unchanged', version=None))
+        self.assertFalse(mock_get_counter.called)
+        mock_manifest.return_value.save.assert_called_once_with()
+
+    @mock.patch('sachannelupdate.base.Manifest')
+    @mock.patch('sachannelupdate.base.process')
+    @mock.patch('sachannelupdate.base.get_cf_files')
+    def test_entry_rulefiles(
+            self, mock_get_cf_files, mock_process, mock_manifest):
+        config = dict(
+            domain_key=mock.sentinel.domain_key,
+            remote_location='sftp://127.0.0.1/srv/www/saupdate',
+            gpg_keyid=mock.sentinel.gpg_keyid,
+        )
+        mock_process.return_value = False
+        entry(config, rulefiles=['/rules/a.cf', '/rules/b.cf'])
+        self.assertFalse(mock_get_cf_files.called)
+        self.assertEqual(
+            mock_process.call_args[0][1], ['/rules/a.cf', '/rules/b.cf'])
+
+    @mock.patch('sachannelupdate.base.Manifest')
+    @mock.patch('sachannelupdate.base.process')
+    @mock.patch('sachannelupdate.base.Snapshot')
+    def test_entry_snapshot(
+            self, mock_snapshot, mock_process, mock_manifest):
+        config = dict(
+            domain_key=mock.sentinel.domain_key,
+            remote_location='sftp://127.0.0.1/srv/www/saupdate',
+            gpg_keyid=mock.sentinel.gpg_keyid,
+            rules_snapshot='yes',
+        )
+        snapshot = mock_snapshot.return_value
+        snapshot.unchanged.return_value = True
+        self.assertEqual(
+            entry(config), dict(status='unchanged', version=None))
+        self.assertEqual(
+            mock_snapshot.call_args[0][0],
+            '/var/lib/sachannelupdate/db/snapshot')
+        snapshot.unchanged.assert_called_once_with(
+            '/var/lib/sachannelupdate/deploy')
+        self.assertFalse(mock_process.called)
+        self.assertFalse(mock_manifest.called)
+        snapshot.unchanged.return_value = False
+        mock_process.return_value = False
+        self.assertEqual(
+            entry(config), dict(status='unchanged', version=None))
+        self.assertEqual(
+            mock_process.call_args[0][1], snapshot.iter_files.return_value)
+        mock_manifest.return_value.save.assert_called_once_with()
+        snapshot.save.assert_called_once_with(
+            '/var/lib/sachannelupdate/deploy')
+
+    @mock.patch('sachannelupdate.base.Snapshot')
+    @mock.patch('sachannelupdate.base.Manifest')
+    @mock.patch('sachannelupdate.base.process')
+    @mock.patch('sachannelupdate.base.get_cf_files')
+    def test_entry_snapshot_disabled(
+            self, mock_get_cf_files, mock_process, mock_manifest,
+            mock_snapshot):
+        config = dict(
+            domain_key=mock.sentinel.domain_key,
+            remote_location='sftp://127.0.0.1/srv/www/saupdate',
+            gpg_keyid=mock.sentinel.gpg_keyid,
+        )
+        mock_process.return_value = False
+        entry(config)
+        self.assertTrue(mock_get_cf_files.called)
+        self.assertFalse(mock_snapshot.called)
+
+    @mock.patch('sachannelupdate.base.export_metrics')
+    @mock.patch('sachannelupdate.base.Manifest')
+    @mock.patch('sachannelupdate.base.replace_file')
+    @mock.patch('sachannelupdate.base.update_dns')
+    @mock.patch('sachannelupdate.base.upload_mirrors')
+    @mock.patch('sachannelupdate.base.build_archive')
+    @mock.patch('sachannelupdate.base.get_counter')
+    @mock.patch('sachannelupdate.base.process')
+    @mock.patch('sachannelupdate.base.os.path.getsize')
+    def test_entry_metrics(
+            self, mock_getsize, mock_process, mock_get_counter,
+            mock_build_archive, mock_upload_mirrors, mock_update_dns,
+            mock_replace_file, mock_manifest, mock_export_metrics):
+        config = dict(
+            domain_key=mock.sentinel.domain_key,
+            remote_location='sftp://a/x sftp://b/x',
+            gpg_keyid=mock.sentinel.gpg_keyid,
+            channel='bw',
+        )
+        mock_getsize.return_value = 1000
+
+        def process(dest, rulefiles, manifest, workers, stats):
+            "Deploy 300 bytes"
+            stats['bytes'] += 300
+            return True
+        mock_process.side_effect = process
+        mock_get_counter.return_value = 4
+        mock_manifest.return_value.seen = set(['/rules/a.cf', '/rules/b.cf'])
+        mock_upload_mirrors.return_value = {
+            'sftp://a/x': True, 'sftp://b/x': True}
+        mock_update_dns.return_value = {'1.4.3.sa.baruwa.com.': False}
+        entry(config, rulefiles=['/rules/a.cf', '/rules/b.cf'])
+        metrics = mock_export_metrics.call_args[0][1]
+        self.assertEqual(metrics.channel, 'bw')
+        self.assertEqual(metrics.status, 'failed')
+        self.assertEqual(metrics.version, 4)
+        self.assertEqual(
+            [(stage['name'], stage['bytes'], stage['files'], stage['ok'])
+             for stage in metrics.stages],
+            [('process', 300, 2, True),
+             ('build', 1000, 2, True), ('upload', 2000, 2, True),
+             ('dns', 0, 1, False)])
+        mock_build_archive.side_effect = SaChannelUpdateError('gpg failed')
+        with self.assertRaises(SaChannelUpdateError):
+            entry(config)
+        metrics = mock_export_metrics.call_args[0][1]
+        self.assertEqual(metrics.status, 'failed')
+        self.assertIsNone(metrics.version)
+        self.assertFalse(metrics.stages[-1]['ok'])
+
+    @mock.patch('sachannelupdate.base.publish')
+    def test_entry_locked(self, mock_publish):
+        config = dict(home_dir='/srv/saupdate')
+        self.mock_run_lock.side_effect = SaChannelUpdateLockError(
+            'Another run holds the lock /srv/saupdate/db/lock')
+        self.assertEqual(
+            entry(config), dict(status='locked', version=None))
+        self.mock_run_lock.assert_called_once_with(
+            '/srv/saupdate/db/lock', False)
+        self.assertFalse(mock_publish.called)
+        config['lock_wait'] = 'yes'
+        entry(config)
+        self.mock_run_lock.assert_called_with('/srv/saupdate/db/lock', True)
+        entry(config, lock_wait=False)
+        self.mock_run_lock.assert_called_with('/srv/saupdate/db/lock', False)
 
     @mock.patch('sachannelupdate.base.cleanup')
     def test_entry_cleanup(self, mock_cleanup):
         config = dict(
             domain_key=mock.sentinel.domain_key,
-            remote_loc=mock.sentinel.remote_loc,
+            remote_location='sftp://127.0.0.1/srv/www/saupdate',
             gpg_keyid=mock.sentinel.gpg_keyid,
         )
-        entry(config, True)
+        self.assertEqual(
+            entry(config, True), dict(status='deleted', version=None))
         self.assertTrue(mock_cleanup.called)
 
 
+
+class PublishStateTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.home_dir = tempfile.mkdtemp()
+        self.rules = os.path.join(self.home_dir, 'rules')
+        os.mkdir(self.rules)
+        os.mkdir(os.path.join(self.home_dir, 'deploy'))
+        os.mkdir(os.path.join(self.home_dir, 'archives'))
+        self.config = dict(
+            home_dir=self.home_dir,
+            domain_key=mock.sentinel.domain_key,
+            remote_location='sftp://127.0.0.1/srv/www/saupdate',
+            gpg_keyid=mock.sentinel.gpg_keyid,
+        )
+        self.published = {}
+        self.mirror_up = True
+        for name, func in (('build_archive', self.build_archive),
+                           ('upload_mirrors', self.upload_mirrors),
+                           ('update_dns', self.update_dns)):
+            patcher = mock.patch('sachannelupdate.base.%s' % name)
+            patcher.start().side_effect = func
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('sachannelupdate.base.error')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.home_dir)
+
+    def build_archive(self, config, dest, tardir, version):
+        "Record the content of deploy as the archive"
+        path = os.path.join(tardir, '%d.tar.gz' % version)
+        create_file(path, 'archive')
+        self.published[version] = dict([
+            (name, open(os.path.join(dest, name)).read())
+            for name in os.listdir(dest)])
+        return path
+
+    def upload_mirrors(self, config, path):
+        "Upload stand-in"
+        return {config['remote_location']: self.mirror_up}
+
+    def update_dns(self, config, version, dns_vers):
+        "DNS stand-in"
+        return {'1.4.3.sa.baruwa.com.': True}
+
+    def write_rule(self, name, content):
+        create_file(os.path.join(self.rules, name), content)
+
+    def deployed(self, name):
+        return open(os.path.join(self.home_dir, 'deploy', name)).read()
+
+    def test_failed_publish_revert(self):
+        self.write_rule('a.cf', 'score GOOD 1\n')
+        self.write_rule('b.cf', 'score OTHER 1\n')
+        self.assertEqual(
+            entry(self.config), dict(status='published', version=1))
+        # the mirror is down, deploy holds BAD that was never published
+        self.write_rule('a.cf', 'score BAD 100\n')
+        self.mirror_up = False
+        self.assertEqual(
+            entry(self.config), dict(status='failed', version=2))
+        self.assertEqual(self.deployed('a.cf'), 'score BAD 100\n')
+        # reverting to the published content must redeploy it
+        self.write_rule('a.cf', 'score GOOD 1\n')
+        self.assertEqual(
+            entry(self.config), dict(status='failed', version=2))
+        self.assertEqual(self.deployed('a.cf'), 'score GOOD 1\n')
+        # an unrelated change publishes the reverted content
+        self.mirror_up = True
+        self.write_rule('b.cf', 'score OTHER 2\n')
+        self.assertEqual(
+            entry(self.config), dict(status='published', version=2))
+        self.assertEqual(self.published[2], {
+            'a.cf': 'score GOOD 1\n', 'b.cf': 'score OTHER 2\n'})
+        self.assertEqual(
+            entry(self.config), dict(status='unchanged', version=None))
+
+    def test_failed_publish_retried(self):
+        self.write_rule('a.cf', 'score GOOD 1\n')
+        self.mirror_up = False
+        self.assertEqual(
+            entry(self.config), dict(status='failed', version=1))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.home_dir, 'db', 'pending')))
+        # nothing changed since, the pending content is still published
+        self.mirror_up = True
+        self.assertEqual(
+            entry(self.config), dict(status='published', version=1))
+        self.assertEqual(self.published[1], {'a.cf': 'score GOOD 1\n'})
+        self.assertFalse(os.path.exists(
+            os.path.join(self.home_dir, 'db', 'pending')))
+        self.assertEqual(
+            entry(self.config), dict(status='unchanged', version=None))
+
+    def test_partial_deploy_revert(self):
+        self.write_rule('a.cf', 'score GOOD 1\n')
+        self.write_rule('b.cf', 'score OTHER 1\n')
+        self.assertEqual(
+            entry(self.config), dict(status='published', version=1))
+        self.write_rule('a.cf', 'score BAD 100\n')
+        self.write_rule('b.cf', 'score OTHER 2\n')
+
+        def deploy_file(source, dest):
+            "Fail to deploy b.cf"
+            if source.endswith('b.cf'):
+                raise IOError('disk full')
+            content = open(source).read()
+            create_file(dest, content)
+            return len(content)
+        with mock.patch('sachannelupdate.base.deploy_file') as mock_deploy:
+            mock_deploy.side_effect = deploy_file
+            with self.assertRaises(SaChannelUpdateDeployError):
+                entry(self.config)
+        self.assertEqual(self.deployed('a.cf'), 'score BAD 100\n')
+        # the deployed BAD is recorded, reverting it redeploys GOOD
+        self.write_rule('a.cf', 'score GOOD 1\n')
+        self.assertEqual(
+            entry(self.config), dict(status='published', version=2))
+        self.assertEqual(self.published[2], {
+            'a.cf': 'score GOOD 1\n', 'b.cf': 'score OTHER 2\n'})
+
+    def test_failed_deploy_pending(self):
+        self.write_rule('a.cf', 'score GOOD 1\n')
+        self.write_rule('b.cf', 'score OTHER 1\n')
+        self.assertEqual(
+            entry(self.config), dict(status='published', version=1))
+        self.write_rule('a.cf', 'score GOOD 2\n')
+        self.write_rule('b.cf', 'score OTHER 2\n')
+
+        def deploy_file(source, dest):
+            "Deploy a.cf, then fail"
+            if source.endswith('b.cf'):
+                raise IOError('disk full')
+            content = open(source).read()
+            create_file(dest, content)
+            return len(content)
+        with mock.patch('sachannelupdate.base.deploy_file') as mock_deploy:
+            mock_deploy.side_effect = deploy_file
+            with self.assertRaises(SaChannelUpdateDeployError):
+                entry(self.config)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.home_dir, 'db', 'pending')))
+        # the file that failed is dropped, its old copy must go with it
+        os.unlink(os.path.join(self.rules, 'b.cf'))
+        self.assertEqual(
+            entry(self.config), dict(status='published', version=2))
+        self.assertEqual(self.published[2], {'a.cf': 'score GOOD 2\n'})
+
+
 if __name__ == "__main__":
     unittest2.main()
@@ -0,0 +1,162 @@
+import sys
+
+from StringIO import StringIO
+from ConfigParser import ConfigParser
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.exceptions import SaChannelUpdateConfigError, \
+    SaChannelUpdateError
+from sachannelupdate.channels import get_channels, run_channels, \
+    watch_channels, get_channel_workers
+
+
+CONFIG = """[settings]
+home_dir = /srv/sa
+gpg_keyid = 0aasas1
+domain_name = sa.example.com.
+channel_workers = 2
+metrics_textfile = /var/lib/node_exporter/sachannelupdate.prom
+
+[channel:bw]
+remote_location = sftp://mirror.example.com/srv/www/bw
+
+[channel:khd]
+domain_name = khd.example.com.
+remote_location = sftp://mirror.example.com/srv/www/khd
+home_dir = /srv/khd
+metrics_textfile = /srv/khd/metrics.prom
+
+[other]
+ignored = yes
+"""
+
+
+def parse(text):
+    "Parse a config"
+    config = ConfigParser()
+    config.readfp(StringIO(text))
+    return config
+
+
+class ChannelsTestCase(unittest2.TestCase):
+
+    def test_get_channels(self):
+        config = parse(CONFIG)
+        channels = get_channels(config)
+        self.assertEqual([name for name, _ in channels], ['bw', 'khd'])
+        bw_config = channels[0][1]
+        self.assertEqual(bw_config['home_dir'], '/srv/sa/bw')
+        self.assertEqual(bw_config['domain_name'], 'sa.example.com.')
+        self.assertEqual(bw_config['gpg_keyid'], '0aasas1')
+        self.assertNotIn('__name__', bw_config)
+        self.assertEqual(bw_config['channel'], 'bw')
+        self.assertEqual(
+            bw_config['metrics_textfile'],
+            '/var/lib/node_exporter/sachannelupdate-bw.prom')
+        khd_config = channels[1][1]
+        self.assertEqual(khd_config['home_dir'], '/srv/khd')
+        self.assertEqual(
+            khd_config['metrics_textfile'], '/srv/khd/metrics.prom')
+        self.assertEqual(khd_config['domain_name'], 'khd.example.com.')
+        self.assertEqual(get_channel_workers(config, channels), 2)
+
+    def test_get_channels_conflicts(self):
+        with self.assertRaises(SaChannelUpdateConfigError) as cma:
+            get_channels(parse(
+                "[settings]\ndomain_name = sa.example.com.\n"
+                "[channel:bw]\n[channel:khd]\n"
+                "domain_name = SA.example.com\n"))
+        self.assertEqual(
+            str(cma.exception),
+            'Channels bw and khd both use the domain_name sa.example.com')
+        with self.assertRaises(SaChannelUpdateConfigError):
+            get_channels(parse("[channel:bw]\n[channel:khd]\n"))
+        with self.assertRaises(SaChannelUpdateConfigError) as cma:
+            get_channels(parse(
+                "[settings]\n"
+                "remote_location = sftp://m1/srv/sa sftp://m2/srv/sa\n"
+                "[channel:bw]\ndomain_name = bw.example.com.\n"
+                "[channel:khd]\ndomain_name = khd.example.com.\n"
+                "remote_location = sftp://M2:22/srv/sa/\n"))
+        self.assertEqual(
+            str(cma.exception),
+            'Channels bw and khd both upload to sftp://M2:22/srv/sa/')
+        channels = get_channels(parse(
+            "[settings]\nremote_location = sftp://m1/srv/sa\n"
+            "[channel:bw]\ndomain_name = bw.example.com.\n"
+            "remote_location = sftp://m1/srv/sa/bw\n"
+            "[channel:khd]\ndomain_name = khd.example.com.\n"
+            "remote_location = sftp://m1:2222/srv/sa\n"))
+        self.assertEqual(len(channels), 2)
+
+    def test_get_channels_settings(self):
+        config = parse("[settings]\nhome_dir = /srv/sa\n")
+        channels = get_channels(config)
+        self.assertEqual(channels, [(None, {'home_dir': '/srv/sa'})])
+        self.assertEqual(get_channel_workers(config, channels), 1)
+        with self.assertRaises(SaChannelUpdateConfigError):
+            get_channels(parse("[other]\n"))
+
+    def test_get_channels_no_settings(self):
+        channels = get_channels(parse("[channel:bw]\ngpg_keyid = 1\n"))
+        self.assertEqual(
+            channels,
+            [('bw', {'home_dir': '/var/lib/sachannelupdate/bw',
+                     'channel': 'bw', 'gpg_keyid': '1'})])
+
+    @mock.patch('sachannelupdate.channels.info')
+    @mock.patch('sachannelupdate.channels.error')
+    @mock.patch('sachannelupdate.channels.entry')
+    def test_run_channels(self, mock_entry, mock_error, mock_info):
+        def entry(config, delete_files):
+            "inline"
+            if config['home_dir'] == '/srv/khd':
+                raise SaChannelUpdateError('upload failed')
+            return dict(status='published', version=3)
+        mock_entry.side_effect = entry
+        channels = get_channels(parse(CONFIG))
+        results = run_channels(channels, None, 2)
+        self.assertEqual(results, {
+            'bw': dict(status='published', version=3),
+            'khd': dict(
+                status='failed', version=None, error='upload failed')})
+        mock_error.assert_called_once_with('Channel khd: upload failed')
+        self.assertEqual(
+            mock_info.call_args_list,
+            [mock.call('Channel bw: published version 3'),
+             mock.call('Channel khd: failed')])
+
+    @mock.patch('sachannelupdate.channels.error')
+    @mock.patch('sachannelupdate.channels.entry')
+    def test_run_channels_single(self, mock_entry, mock_error):
+        mock_entry.side_effect = SaChannelUpdateError('xxx')
+        results = run_channels([(None, {})], True)
+        mock_entry.assert_called_once_with({}, True)
+        self.assertEqual(results[None]['status'], 'failed')
+        self.assertEqual(str(mock_error.call_args[0][0]), 'xxx')
+
+    @mock.patch('sachannelupdate.channels.error')
+    @mock.patch('sachannelupdate.channels.watcher.watch')
+    def test_watch_channels(self, mock_watch, mock_error):
+        watch_channels([(None, {'home_dir': '/srv/sa'})])
+        mock_watch.assert_called_once_with({'home_dir': '/srv/sa'})
+        mock_watch.reset_mock()
+        def watch(config):
+            "inline"
+            if config['home_dir'] == '/srv/khd':
+                raise SaChannelUpdateError('no rules')
+        mock_watch.side_effect = watch
+        watch_channels(get_channels(parse(CONFIG)))
+        self.assertEqual(mock_watch.call_count, 2)
+        mock_error.assert_called_once_with('Channel khd: no rules')
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -1,5 +1,7 @@
 import os
 import sys
+import shutil
+import tempfile
 
 import mock
 try:
@@ -13,6 +15,19 @@ from sachannelupdate.cli import main
 from sachannelupdate.exceptions import SaChannelUpdateConfigError, \
     SaChannelUpdateError
 
+CHANNELS = """[settings]
+home_dir = /srv/sa
+domain_key = xxxx
+remote_location = sftp://127.0.0.1/srv/www/saupdate
+gpg_keyid = 0aasas1
+
+[channel:bw]
+
+[channel:khd]
+domain_name = khd.example.com.
+remote_location = sftp://127.0.0.1/srv/www/khd
+"""
+
 
 class CLITestCase(unittest2.TestCase):
 
@@ -26,15 +41,25 @@ class CLITestCase(unittest2.TestCase):
                 'The configuration file: %s does not exist' % default_cfg
             )
 
-    @mock.patch('sachannelupdate.cli.entry')
+    @mock.patch('sachannelupdate.channels.entry')
     def test_main_cf(self, mock_entry):
         config = os.path.join(os.path.dirname(__file__), 'sa.ini')
         sys.argv = ['__main__', '-c', config]
         main()
         self.assertTrue(mock_entry.called)
 
-    @mock.patch('sachannelupdate.cli.error')
-    @mock.patch('sachannelupdate.cli.entry')
+    @mock.patch('sachannelupdate.channels.watcher.watch')
+    @mock.patch('sachannelupdate.channels.entry')
+    def test_main_watch(self, mock_entry, mock_watch):
+        config = os.path.join(os.path.dirname(__file__), 'sa.ini')
+        sys.argv = ['__main__', '-c', config, '--watch']
+        main()
+        self.assertFalse(mock_entry.called)
+        self.assertEqual(
+            mock_watch.call_args[0][0]['home_dir'], '/var/lib/sachannelupdate')
+
+    @mock.patch('sachannelupdate.channels.error')
+    @mock.patch('sachannelupdate.channels.entry')
     def test_main_cf_exp(self, mock_entry, mock_error):
         config = os.path.join(
             os.path.dirname(__file__),
@@ -46,6 +71,57 @@ class CLITestCase(unittest2.TestCase):
         self.assertTrue(mock_entry.called)
         self.assertTrue(mock_error.called)
 
+    @mock.patch('sachannelupdate.cli.run_profiled')
+    @mock.patch('sachannelupdate.channels.entry')
+    def test_main_profile(self, mock_entry, mock_run_profiled):
+        config = os.path.join(os.path.dirname(__file__), 'sa.ini')
+        sys.argv = ['__main__', '-c', config]
+        main()
+        self.assertFalse(mock_run_profiled.called)
+        sys.argv = ['__main__', '-c', config, '--profile', '--trace-memory']
+        main()
+        func, args, dbdir, profile, trace_memory = \
+            mock_run_profiled.call_args[0]
+        self.assertEqual(dbdir, '/var/lib/sachannelupdate/db')
+        self.assertTrue(profile)
+        self.assertTrue(trace_memory)
+        self.assertEqual(mock_entry.call_count, 1)
+        func(*args)
+        self.assertEqual(mock_entry.call_count, 2)
+
+    @mock.patch('sachannelupdate.cli.run_profiled')
+    def test_main_profile_channels(self, mock_run_profiled):
+        tmpdir = tempfile.mkdtemp()
+        config = os.path.join(tmpdir, 'channels.ini')
+        with open(config, 'w') as handle:
+            handle.write(CHANNELS)
+        try:
+            sys.argv = ['__main__', '-c', config, '--trace-memory']
+            main()
+            self.assertEqual(mock_run_profiled.call_args[0][1][2], 2)
+            sys.argv = ['__main__', '-c', config, '--profile']
+            main()
+            self.assertEqual(mock_run_profiled.call_args[0][1][2], 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch('sachannelupdate.channels.entry')
+    def test_main_channels(self, mock_entry):
+        tmpdir = tempfile.mkdtemp()
+        config = os.path.join(tmpdir, 'channels.ini')
+        with open(config, 'w') as handle:
+            handle.write(CHANNELS)
+        mock_entry.return_value = dict(status='unchanged', version=None)
+        sys.argv = ['__main__', '-c', config]
+        try:
+            main()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(
+            sorted([call[0][0]['home_dir']
+                    for call in mock_entry.call_args_list]),
+            ['/srv/sa/bw', '/srv/sa/khd'])
+
 
 if __name__ == "__main__":
     unittest2.main()
@@ -0,0 +1,105 @@
+import sys
+import zlib
+import gzip
+import struct
+import threading
+
+from StringIO import StringIO
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.compress import GzipWriter, compress_block, gzip_header
+
+
+DATA = ''.join([
+    'body     BW_RULE_%d    /example%d\\.com/i\n' % (num, num)
+    for num in range(5000)])
+
+
+def gzip_data(data, **kwargs):
+    "Compress data with a GzipWriter"
+    out = StringIO()
+    gzfile = GzipWriter(out, **kwargs)
+    for offset in range(0, len(data), 1000):
+        gzfile.write(data[offset:offset + 1000])
+    gzfile.close()
+    return out.getvalue()
+
+
+class CompressTestCase(unittest2.TestCase):
+
+    def test_compress_block(self):
+        first = compress_block(DATA[:1000], 6, False)
+        last = compress_block(DATA[1000:], 6, True)
+        self.assertEqual(
+            zlib.decompress(first + last, -zlib.MAX_WBITS), DATA)
+
+    def test_gzip_header(self):
+        header = gzip_header(9, 1000)
+        self.assertEqual(header[:3], '\037\213\010')
+        self.assertEqual(struct.unpack('<I', header[4:8])[0], 1000)
+        self.assertEqual(header[8], '\002')
+        self.assertEqual(gzip_header(1, 0)[8], '\004')
+        self.assertEqual(gzip_header(6, 0)[8], '\000')
+
+    def test_serial(self):
+        data = gzip_data(DATA, level=6, workers=1)
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS), DATA)
+
+    def test_parallel(self):
+        data = gzip_data(DATA, level=6, workers=4, blocksize=4096)
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS), DATA)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(data)).read(), DATA)
+
+    def test_parallel_block_multiple(self):
+        data = gzip_data(DATA[:8192], level=9, workers=2, blocksize=4096)
+        self.assertEqual(
+            zlib.decompress(data, 16 + zlib.MAX_WBITS), DATA[:8192])
+
+    def test_empty(self):
+        for workers in (1, 4):
+            data = gzip_data('', workers=workers)
+            self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS), '')
+
+    def test_mtime(self):
+        data = gzip_data(DATA, mtime=0)
+        self.assertEqual(data, gzip_data(DATA, mtime=0))
+        self.assertEqual(struct.unpack('<I', data[4:8])[0], 0)
+
+    def test_close(self):
+        out = mock.Mock()
+        gzfile = GzipWriter(out, workers=2)
+        gzfile.write(DATA)
+        self.assertEqual(gzfile.tell(), len(DATA))
+        gzfile.close()
+        gzfile.close()
+        self.assertFalse(out.close.called)
+
+    def test_abort(self):
+        before = threading.active_count()
+        out = mock.Mock()
+        gzfile = GzipWriter(out, workers=4)
+        gzfile.write(DATA)
+        gzfile.abort()
+        self.assertEqual(threading.active_count(), before)
+        gzfile.abort()
+        gzfile.close()
+        self.assertFalse(out.close.called)
+
+    def test_header_error(self):
+        before = threading.active_count()
+        out = mock.Mock()
+        out.write.side_effect = IOError('No space left on device')
+        with self.assertRaises(IOError):
+            GzipWriter(out, workers=4)
+        self.assertEqual(threading.active_count(), before)
+
+
+if __name__ == "__main__":
+    unittest2.main()
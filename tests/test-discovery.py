@@ -0,0 +1,126 @@
+import os
+import sys
+import shutil
+import tempfile
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.discovery import RuleFilter, ALL_FILES, iter_files, \
+    list_dir, get_patterns, get_rule_filter
+
+
+class FakeEntry(object):
+    "DirEntry stand-in for systems without scandir"
+    def __init__(self, path, name):
+        self.name = name
+        self.path = os.path.join(path, name)
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+
+def fake_scandir(path):
+    "scandir built on listdir"
+    return iter([FakeEntry(path, name) for name in os.listdir(path)])
+
+
+class DiscoveryTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for dirname in ('sub/deeper', '.git/objects', 'local', 'dir.post'):
+            os.makedirs(self.path(dirname))
+        for name in ('70_a.cf', '70_a.post', '70_a.cf.orig', 'sub/71_b.cf',
+                     'sub/deeper/72_c.cf', '.git/objects/x.cf',
+                     'local/73_d.cf', '.hidden.cf'):
+            open(self.path(name), 'w').close()
+        os.symlink(self.path('70_a.cf'), self.path('link.cf'))
+        os.symlink(self.path('sub'), self.path('linked'))
+        os.symlink(self.path('missing.cf'), self.path('broken.cf'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        "full path"
+        return os.path.join(self.tmpdir, name)
+
+    def rules(self, rule_filter=None):
+        "sorted rule files"
+        return sorted(iter_files(self.tmpdir, rule_filter or RuleFilter()))
+
+    def check_default(self):
+        self.assertEqual(self.rules(), [
+            self.path('70_a.cf'), self.path('70_a.post'),
+            self.path('link.cf'), self.path('local/73_d.cf'),
+            self.path('sub/71_b.cf'), self.path('sub/deeper/72_c.cf')])
+
+    @mock.patch('sachannelupdate.discovery.scandir', None)
+    def test_iter_files_listdir(self):
+        self.check_default()
+
+    @mock.patch('sachannelupdate.discovery.scandir', fake_scandir)
+    def test_iter_files_scandir(self):
+        self.check_default()
+
+    def test_iter_files_filters(self):
+        self.assertEqual(
+            self.rules(RuleFilter(('*.cf',), ('.*', 'local', 'sub/*/*'))),
+            [self.path('70_a.cf'), self.path('link.cf'),
+             self.path('sub/71_b.cf')])
+        self.assertIn(
+            self.path('.git/objects/x.cf'), self.rules(ALL_FILES))
+        self.assertIn(self.path('70_a.cf.orig'), self.rules(ALL_FILES))
+
+    def test_iter_files_lazy(self):
+        with mock.patch('sachannelupdate.discovery.list_dir') as mock_list:
+            mock_list.return_value = iter([('70_a.cf', False, True)])
+            files = iter_files(self.tmpdir)
+            self.assertFalse(mock_list.called)
+            self.assertEqual(list(files), [self.path('70_a.cf')])
+
+    def test_iter_files_missing(self):
+        self.assertEqual(list(iter_files(self.path('missing'))), [])
+
+    @mock.patch('sachannelupdate.discovery.scandir', None)
+    def test_list_dir(self):
+        entries = dict([(name, (is_dir, is_file))
+                        for name, is_dir, is_file in list_dir(self.tmpdir)])
+        self.assertEqual(entries['sub'], (True, False))
+        self.assertEqual(entries['70_a.cf'], (False, True))
+        self.assertEqual(entries['link.cf'], (False, True))
+        self.assertEqual(entries['linked'], (False, False))
+        self.assertNotIn('broken.cf', entries)
+
+    def test_rule_filter(self):
+        rule_filter = RuleFilter()
+        self.assertTrue(rule_filter.include_file('70_a.post', '70_a.post'))
+        self.assertFalse(rule_filter.include_file('a.cf.swp', 'a.cf.swp'))
+        self.assertFalse(rule_filter.include_file('.a.cf', 'x/.a.cf'))
+        self.assertFalse(rule_filter.include_dir('.git', '.git'))
+        self.assertTrue(rule_filter.include_dir('sub', 'sub'))
+
+    def test_get_rule_filter(self):
+        rule_filter = get_rule_filter({})
+        self.assertEqual(rule_filter.include, ('*.cf', '*.post'))
+        self.assertEqual(rule_filter.exclude, ('.*',))
+        rule_filter = get_rule_filter(
+            dict(rules_include='*.cf, *.pre', rules_exclude=''))
+        self.assertEqual(rule_filter.include, ('*.cf', '*.pre'))
+        self.assertEqual(rule_filter.exclude, ())
+        self.assertEqual(get_patterns({}, 'x', ('a',)), ('a',))
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.exceptions import SaChannelUpdateLockError
+from sachannelupdate.locking import run_lock
+
+
+class LockingTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lockfile = os.path.join(self.tmpdir, 'db', 'lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_lock(self):
+        with run_lock(self.lockfile):
+            self.assertTrue(os.path.exists(self.lockfile))
+        with run_lock(self.lockfile):
+            pass
+
+    def test_run_lock_held(self):
+        with run_lock(self.lockfile):
+            with self.assertRaises(SaChannelUpdateLockError):
+                with run_lock(self.lockfile):
+                    pass
+
+    def test_run_lock_released_on_error(self):
+        with self.assertRaises(ValueError):
+            with run_lock(self.lockfile):
+                raise ValueError('failed')
+        with run_lock(self.lockfile):
+            pass
+
+    def test_run_lock_wait(self):
+        order = []
+        held = threading.Event()
+        release = threading.Event()
+
+        def first():
+            with run_lock(self.lockfile):
+                held.set()
+                release.wait(5)
+                order.append('first')
+
+        thread = threading.Thread(target=first)
+        thread.start()
+        held.wait(5)
+        release.set()
+        with run_lock(self.lockfile, wait=True):
+            order.append('second')
+        thread.join()
+        self.assertEqual(order, ['first', 'second'])
+
+
+if __name__ == "__main__":
+    unittest2.main()
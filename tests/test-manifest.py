@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+from hashlib import sha1
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.manifest import Manifest, file_digest
+
+
+RULE = """score           RCVD_IN_BW_HKW                          -8.0
+"""
+
+
+class ManifestTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rulefile = os.path.join(self.tmpdir, 'rule.cf')
+        self.dbfile = os.path.join(self.tmpdir, 'db', 'manifest')
+        with open(self.rulefile, 'w') as handle:
+            handle.write(RULE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_digest(self):
+        self.assertEqual(
+            file_digest(self.rulefile), sha1(RULE).hexdigest())
+
+    def test_load_missing(self):
+        manifest = Manifest(self.dbfile)
+        self.assertEqual(manifest.entries, {})
+
+    def test_load_corrupt(self):
+        os.mkdir(os.path.dirname(self.dbfile))
+        with open(self.dbfile, 'w') as handle:
+            handle.write('{not json')
+        manifest = Manifest(self.dbfile)
+        self.assertEqual(manifest.entries, {})
+
+    def test_check_new(self):
+        manifest = Manifest(self.dbfile)
+        self.assertTrue(manifest.check(self.rulefile))
+        self.assertEqual(
+            manifest.entries[self.rulefile][2], sha1(RULE).hexdigest())
+        self.assertEqual(manifest.seen, set([self.rulefile]))
+
+    def test_save_and_reload(self):
+        manifest = Manifest(self.dbfile)
+        manifest.check(self.rulefile)
+        manifest.save()
+        with open(self.dbfile) as handle:
+            self.assertIn(self.rulefile, json.load(handle))
+        manifest = Manifest(self.dbfile)
+        self.assertFalse(manifest.check(self.rulefile))
+
+    def test_save_atomic(self):
+        manifest = Manifest(self.dbfile)
+        manifest.check(self.rulefile)
+        manifest.save()
+        manifest.entries['/srv/new.cf'] = [1, 1, 'xxx']
+        with mock.patch('sachannelupdate.manifest.os.rename') as mock_rename:
+            mock_rename.side_effect = OSError('crash')
+            with self.assertRaises(OSError):
+                manifest.save()
+        self.assertEqual(
+            Manifest(self.dbfile).entries.keys(), [self.rulefile])
+        manifest.save()
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(self.dbfile))), ['manifest'])
+
+    @mock.patch('sachannelupdate.manifest.file_digest')
+    def test_check_stat_unchanged(self, mock_file_digest):
+        fstat = os.stat(self.rulefile)
+        manifest = Manifest()
+        manifest.entries[self.rulefile] = [
+            fstat.st_size, fstat.st_mtime, 'xxx']
+        self.assertFalse(manifest.check(self.rulefile))
+        self.assertFalse(mock_file_digest.called)
+
+    def test_check_touched(self):
+        manifest = Manifest()
+        manifest.check(self.rulefile)
+        fstat = os.stat(self.rulefile)
+        os.utime(self.rulefile, (fstat.st_atime, fstat.st_mtime + 10))
+        self.assertFalse(manifest.check(self.rulefile))
+        self.assertEqual(
+            manifest.entries[self.rulefile][1],
+            os.stat(self.rulefile).st_mtime)
+
+    def test_check_modified(self):
+        manifest = Manifest()
+        manifest.check(self.rulefile)
+        with open(self.rulefile, 'a') as handle:
+            handle.write(RULE)
+        self.assertTrue(manifest.check(self.rulefile))
+
+    def test_removed_and_forget(self):
+        manifest = Manifest()
+        manifest.entries['/srv/old.cf'] = [1, 1, 'xxx']
+        manifest.check(self.rulefile)
+        self.assertEqual(manifest.removed(), ['/srv/old.cf'])
+        manifest.forget('/srv/old.cf')
+        self.assertEqual(manifest.removed(), [])
+
+    def test_invalidate(self):
+        manifest = Manifest()
+        manifest.check(self.rulefile)
+        manifest.invalidate(self.rulefile)
+        self.assertTrue(manifest.check(self.rulefile))
+        self.assertFalse(manifest.check(self.rulefile))
+        manifest.invalidate('/srv/gone.cf')
+        self.assertEqual(manifest.removed(), ['/srv/gone.cf'])
+
+    def test_save_in_memory(self):
+        manifest = Manifest()
+        manifest.check(self.rulefile)
+        manifest.save()
+        self.assertFalse(os.path.exists(self.dbfile))
+
+
+if __name__ == "__main__":
+    unittest2.main()
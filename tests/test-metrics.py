@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.metrics import Metrics, labels, write_log, \
+    write_textfile, export_metrics
+
+
+class MetricsTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_metrics(self):
+        metrics = Metrics('bw')
+        with metrics.stage('build') as stage:
+            stage['bytes'] = 2048
+            stage['files'] = 3
+        with metrics.stage('upload') as stage:
+            stage['ok'] = False
+        metrics.finish('failed', 7)
+        return metrics
+
+    def test_stage(self):
+        metrics = self.make_metrics()
+        self.assertEqual(
+            [(record['name'], record['bytes'], record['files'],
+              record['ok']) for record in metrics.stages],
+            [('build', 2048, 3, True), ('upload', 0, 0, False)])
+        self.assertTrue(metrics.stages[0]['seconds'] >= 0)
+        self.assertEqual(metrics.status, 'failed')
+        self.assertEqual(metrics.version, 7)
+
+    def test_stage_raises(self):
+        metrics = Metrics()
+        with self.assertRaises(ValueError):
+            with metrics.stage('process'):
+                raise ValueError('bad rule')
+        self.assertFalse(metrics.stages[0]['ok'])
+
+    def test_labels(self):
+        self.assertEqual(labels(channel=None), '')
+        self.assertEqual(
+            labels(stage='build', channel='a"b'),
+            '{channel="a\\"b",stage="build"}')
+
+    def test_to_prometheus(self):
+        text = self.make_metrics().to_prometheus()
+        self.assertIn(
+            '# TYPE sachannelupdate_stage_bytes gauge\n'
+            'sachannelupdate_stage_bytes{channel="bw",stage="build"} 2048\n',
+            text)
+        self.assertIn(
+            'sachannelupdate_stage_ok{channel="bw",stage="upload"} 0\n', text)
+        self.assertIn(
+            'sachannelupdate_run_status{channel="bw",status="failed"} 1\n',
+            text)
+        self.assertIn(
+            'sachannelupdate_run_status{channel="bw",status="published"} 0\n',
+            text)
+        self.assertIn('sachannelupdate_version{channel="bw"} 7\n', text)
+        metrics = Metrics()
+        metrics.finish('unchanged')
+        text = metrics.to_prometheus()
+        self.assertNotIn('stage_bytes', text)
+        self.assertNotIn('sachannelupdate_version', text)
+        self.assertIn('sachannelupdate_run_status{status="unchanged"} 1\n',
+                      text)
+
+    def test_write_log(self):
+        filename = os.path.join(self.tmpdir, 'metrics.log')
+        write_log(filename, self.make_metrics())
+        write_log(filename, self.make_metrics())
+        with open(filename) as handle:
+            lines = [json.loads(line) for line in handle]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['channel'], 'bw')
+        self.assertEqual(lines[0]['stages'][0]['bytes'], 2048)
+
+    def test_write_textfile(self):
+        filename = os.path.join(self.tmpdir, 'sa.prom')
+        metrics = self.make_metrics()
+        write_textfile(filename, metrics)
+        with open(filename) as handle:
+            self.assertEqual(handle.read(), metrics.to_prometheus())
+        self.assertEqual(os.listdir(self.tmpdir), ['sa.prom'])
+
+    @mock.patch('sachannelupdate.metrics.error')
+    def test_export_metrics(self, mock_error):
+        filename = os.path.join(self.tmpdir, 'sa.prom')
+        missing = os.path.join(self.tmpdir, 'missing', 'metrics.log')
+        export_metrics(
+            dict(metrics_textfile=filename, metrics_log=missing),
+            self.make_metrics())
+        self.assertTrue(os.path.exists(filename))
+        self.assertEqual(mock_error.call_count, 1)
+        self.assertTrue(mock_error.call_args[0][0].startswith(
+            'Writing metrics to %s failed: ' % missing))
+        export_metrics({}, self.make_metrics())
+        self.assertEqual(mock_error.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,108 @@
+import os
+import sys
+import shutil
+import pstats
+import tempfile
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.profiling import run_profiled, report_memory
+
+
+def work(count):
+    "Something to profile"
+    return sum([len(str(num)) for num in range(count)])
+
+
+class ProfilingTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbdir = os.path.join(self.tmpdir, 'db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def reports(self, prefix):
+        return [os.path.join(self.dbdir, name)
+                for name in os.listdir(self.dbdir) if name.startswith(prefix)]
+
+    @mock.patch('sachannelupdate.profiling.error')
+    def test_profile(self, mock_error):
+        self.assertEqual(
+            run_profiled(work, (100,), self.dbdir, profile=True), 190)
+        paths = self.reports('profile-')
+        self.assertEqual(len(paths), 1)
+        self.assertTrue(paths[0].endswith('.pstats'))
+        stats = pstats.Stats(paths[0])
+        self.assertIn('work', [func[2] for func in stats.stats])
+        self.assertTrue(mock_error.call_args_list[0][0][0].startswith(
+            'Profile written to %s' % paths[0]))
+        self.assertEqual(self.reports('memory-'), [])
+
+    @mock.patch('sachannelupdate.profiling.error')
+    def test_profile_raises(self, mock_error):
+        with self.assertRaises(ZeroDivisionError):
+            run_profiled(lambda: 1 / 0, (), self.dbdir, True, True)
+        self.assertEqual(len(self.reports('profile-')), 1)
+        self.assertEqual(len(self.reports('memory-')), 1)
+
+    @mock.patch('sachannelupdate.profiling.tracemalloc', None)
+    @mock.patch('sachannelupdate.profiling.error')
+    def test_trace_memory_fallback(self, mock_error):
+        run_profiled(work, (100,), self.dbdir, trace_memory=True)
+        paths = self.reports('memory-')
+        self.assertEqual(len(paths), 1)
+        with open(paths[0]) as handle:
+            lines = handle.read().splitlines()
+        self.assertEqual(
+            lines[0],
+            'tracemalloc is not available, allocation sites are not traced')
+        self.assertTrue(lines[1].startswith('max rss: '))
+
+    @mock.patch('sachannelupdate.profiling.tracemalloc')
+    @mock.patch('sachannelupdate.profiling.error')
+    def test_trace_memory(self, mock_error, mock_tracemalloc):
+        mock_tracemalloc.is_tracing.return_value = True
+        mock_tracemalloc.get_traced_memory.return_value = (1024, 4096)
+        snapshot = mock_tracemalloc.take_snapshot.return_value
+        snapshot.statistics.return_value = [
+            'base.py:90: size=2048 B, count=2, average=1024 B',
+            'base.py:99: size=1024 B, count=1, average=1024 B']
+        run_profiled(work, (100,), self.dbdir, trace_memory=True, limit=1)
+        mock_tracemalloc.start.assert_called_once_with()
+        mock_tracemalloc.stop.assert_called_once_with()
+        snapshot.statistics.assert_called_once_with('lineno')
+        with open(self.reports('memory-')[0]) as handle:
+            lines = handle.read().splitlines()
+        self.assertEqual(lines[:2], [
+            'traced memory: 1024 bytes, peak 4096 bytes',
+            'base.py:90: size=2048 B, count=2, average=1024 B'])
+
+    @mock.patch('sachannelupdate.profiling.error')
+    def test_report_failure(self, mock_error):
+        filename = os.path.join(self.tmpdir, 'file')
+        open(filename, 'w').close()
+        self.assertEqual(
+            run_profiled(work, (10,), filename, profile=True), 10)
+        self.assertTrue(mock_error.call_args[0][0].startswith(
+            'Writing the profiling reports failed: '))
+
+    @mock.patch('sachannelupdate.profiling.resource', None)
+    @mock.patch('sachannelupdate.profiling.tracemalloc', None)
+    @mock.patch('sachannelupdate.profiling.error')
+    def test_report_memory_no_resource(self, mock_error):
+        os.mkdir(self.dbdir)
+        report_memory(self.dbdir, 5, None)
+        with open(self.reports('memory-')[0]) as handle:
+            self.assertEqual(len(handle.read().splitlines()), 1)
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,156 @@
+import os
+import sys
+import shutil
+import tempfile
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.exceptions import SaChannelUpdateError
+from sachannelupdate.signing import Signer, SignStream, get_signer, \
+    get_keyids, SignatureCache, get_signature_cache, sign_digest
+
+
+class SigningTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, '40.tar.gz')
+        with open(self.filename, 'w') as handle:
+            handle.write('testing rule')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch.dict('sachannelupdate.signing.SIGNERS', clear=True)
+    @mock.patch('sachannelupdate.signing.gnupg.GPG')
+    def test_get_signer(self, mock_gpg):
+        config = dict(gpg_passphrase='xxxxxx', gpg_keyid='01213')
+        signer = get_signer(config)
+        self.assertTrue(signer is get_signer(dict(config)))
+        mock_gpg.assert_called_once_with(
+            gnupghome='/var/lib/sachannelupdate/gnupg')
+        self.assertEqual(
+            (signer.keyid, signer.passphrase), ('01213', 'xxxxxx'))
+        config['gpg_keyid'] = '01214'
+        self.assertFalse(signer is get_signer(config))
+        self.assertEqual(mock_gpg.call_count, 2)
+
+    @mock.patch.dict('sachannelupdate.signing.SIGNERS', clear=True)
+    @mock.patch('sachannelupdate.signing.gnupg.GPG')
+    def test_get_signer_keyid(self, mock_gpg):
+        config = dict(gpg_keyid='01213 04567')
+        self.assertEqual(get_signer(config).keyid, '01213')
+        self.assertEqual(get_signer(config, '04567').keyid, '04567')
+
+    def test_get_keyids(self):
+        self.assertEqual(get_keyids({}), [])
+        self.assertEqual(
+            get_keyids({'gpg_keyid': '01213, 04567 01213'}),
+            ['01213', '04567'])
+
+    def test_signature_cache(self):
+        cache = get_signature_cache({'home_dir': self.tmpdir})
+        self.assertEqual(
+            cache.dirname, os.path.join(self.tmpdir, 'db', 'signatures'))
+        self.assertEqual(cache.get('abcd', '01213'), None)
+        cache.put('abcd', '01213', 'signature')
+        self.assertEqual(cache.get('abcd', '01213'), 'signature')
+        self.assertEqual(cache.get('abcd', '04567'), None)
+        self.assertEqual(cache.get('abce', '01213'), None)
+        cache.put('abcd', '../../01213', 'other')
+        self.assertEqual(
+            os.listdir(cache.dirname), ['abcd.01213.asc'])
+
+    @mock.patch('sachannelupdate.signing.get_signer')
+    def test_sign_digest(self, mock_get_signer):
+        def get_signer(config, keyid):
+            "inline"
+            signer = mock.Mock()
+            signer.sign.side_effect = lambda handle: '%s %s\n' % (
+                keyid, handle.read())
+            return signer
+        mock_get_signer.side_effect = get_signer
+        cache = SignatureCache(os.path.join(self.tmpdir, 'signatures'))
+        cache.put('abcd', '01213', 'cached\n')
+        config = dict(gpg_keyid='01213 04567 08910')
+        self.assertEqual(sign_digest(config, self.filename, 'abcd', cache), 1)
+        with open('%s.asc' % self.filename) as handle:
+            self.assertEqual(
+                handle.read(),
+                'cached\n04567 testing rule\n08910 testing rule\n')
+        self.assertEqual(mock_get_signer.call_count, 2)
+        self.assertEqual(cache.get('abcd', '08910'), '08910 testing rule\n')
+        self.assertEqual(sign_digest(config, self.filename, 'abcd', cache), 3)
+        self.assertEqual(mock_get_signer.call_count, 2)
+        mock_get_signer.side_effect = IOError('gpg missing')
+        with self.assertRaises(SaChannelUpdateError):
+            sign_digest(config, self.filename, 'abce', cache)
+
+    @mock.patch('sachannelupdate.signing.gnupg.GPG')
+    def test_sign_file(self, mock_gpg):
+        received = []
+
+        def sign_file(handle, **kwargs):
+            "inline"
+            received.append((handle.read(), kwargs))
+            return 'signature'
+        mock_gpg.return_value.sign_file.side_effect = sign_file
+        signer = Signer('/gpg', '01213', 'xxxxxx')
+        signer.sign_file(self.filename)
+        with open('%s.asc' % self.filename) as handle:
+            self.assertEqual(handle.read(), 'signature')
+        self.assertEqual(received, [(
+            'testing rule',
+            dict(keyid='01213', passphrase='xxxxxx', detach=True))])
+
+    @mock.patch('sachannelupdate.signing.gnupg.GPG')
+    def test_sign_file_error(self, mock_gpg):
+        signer = Signer('/gpg', '01213')
+        mock_gpg.return_value.sign_file.return_value = ''
+        with self.assertRaises(SaChannelUpdateError):
+            signer.sign_file(self.filename)
+        self.assertFalse(os.path.exists('%s.asc' % self.filename))
+        mock_gpg.return_value.sign_file.side_effect = ValueError(
+            'Invalid passphrase')
+        with self.assertRaises(SaChannelUpdateError):
+            signer.sign_file(self.filename)
+        with self.assertRaises(SaChannelUpdateError):
+            signer.sign_file(os.path.join(self.tmpdir, 'missing'))
+
+    @mock.patch('sachannelupdate.signing.gnupg.GPG')
+    def test_sign_stream(self, mock_gpg):
+        received = []
+
+        def sign_file(stream, **kwargs):
+            "inline"
+            received.append(stream.read())
+            return 'signature'
+        mock_gpg.return_value.sign_file.side_effect = sign_file
+        signer = Signer('/gpg', '01213', 'xxxxxx')
+        stream = SignStream(signer, self.filename)
+        stream.write('testing ')
+        stream.write('rule')
+        self.assertEqual(stream.close(), 'signature')
+        self.assertEqual(received, ['testing rule'])
+        self.assertFalse(os.path.exists('%s.asc' % self.filename))
+
+    @mock.patch('sachannelupdate.signing.gnupg.GPG')
+    def test_sign_stream_error(self, mock_gpg):
+        mock_gpg.return_value.sign_file.side_effect = ValueError(
+            'Invalid passphrase')
+        stream = SignStream(Signer('/gpg', '01213'), self.filename)
+        with self.assertRaises(SaChannelUpdateError):
+            stream.close()
+        stream = SignStream(Signer('/gpg', '01213'), self.filename)
+        stream.abort()
+        self.assertFalse(os.path.exists('%s.asc' % self.filename))
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.discovery import RuleFilter
+from sachannelupdate.snapshot import Snapshot, snapshot_key
+
+
+class SnapshotTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rules = os.path.join(self.tmpdir, 'rules')
+        self.dest = os.path.join(self.tmpdir, 'deploy')
+        self.dbfile = os.path.join(self.tmpdir, 'db', 'snapshot')
+        os.makedirs(os.path.join(self.rules, 'sub'))
+        os.makedirs(os.path.join(self.rules, '.git'))
+        os.mkdir(self.dest)
+        for name in ('a.cf', 'sub/b.cf', 'sub/c.txt', '.git/d.cf'):
+            open(os.path.join(self.rules, name), 'w').close()
+        self.age()
+        self.rule_filter = RuleFilter()
+        self.key = snapshot_key(self.rules, self.rule_filter)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def age(self):
+        "Move the directory mtimes out of the racy window"
+        past = time.time() - 100
+        for path in (self.rules, os.path.join(self.rules, 'sub'),
+                     self.dest):
+            os.utime(path, (past, past))
+
+    def take(self):
+        snapshot = Snapshot(self.dbfile, self.key)
+        files = list(snapshot.iter_files(self.rules, self.rule_filter))
+        snapshot.save(self.dest)
+        return files
+
+    def test_iter_files(self):
+        self.assertEqual(
+            self.take(),
+            [os.path.join(self.rules, 'a.cf'),
+             os.path.join(self.rules, 'sub', 'b.cf')])
+        with open(self.dbfile) as handle:
+            data = json.load(handle)
+        self.assertEqual(data['key'], self.key)
+        self.assertEqual(
+            sorted(data['dirs']),
+            [self.rules, os.path.join(self.rules, 'sub')])
+
+    def test_load_missing(self):
+        snapshot = Snapshot(self.dbfile, self.key)
+        self.assertEqual(snapshot.dirs, {})
+        self.assertFalse(snapshot.unchanged(self.dest))
+
+    def test_load_corrupt(self):
+        os.mkdir(os.path.dirname(self.dbfile))
+        with open(self.dbfile, 'w') as handle:
+            handle.write('{not json')
+        self.assertEqual(Snapshot(self.dbfile, self.key).dirs, {})
+
+    def test_key_changed(self):
+        self.take()
+        snapshot = Snapshot(self.dbfile, snapshot_key(
+            self.rules, RuleFilter(('*.cf', '*.txt'))))
+        self.assertEqual(snapshot.dirs, {})
+
+    def test_unchanged(self):
+        self.take()
+        self.assertTrue(Snapshot(self.dbfile, self.key).unchanged(self.dest))
+
+    def test_file_added(self):
+        self.take()
+        open(os.path.join(self.rules, 'sub', 'e.cf'), 'w').close()
+        snapshot = Snapshot(self.dbfile, self.key)
+        self.assertFalse(snapshot.unchanged(self.dest))
+        self.assertEqual(
+            list(snapshot.iter_files(self.rules, self.rule_filter)),
+            [os.path.join(self.rules, 'a.cf'),
+             os.path.join(self.rules, 'sub', 'b.cf'),
+             os.path.join(self.rules, 'sub', 'e.cf')])
+
+    def test_dir_removed(self):
+        self.take()
+        shutil.rmtree(os.path.join(self.rules, 'sub'))
+        self.assertFalse(
+            Snapshot(self.dbfile, self.key).unchanged(self.dest))
+
+    def test_deploy_changed(self):
+        self.take()
+        open(os.path.join(self.dest, 'a.cf'), 'w').close()
+        self.assertFalse(
+            Snapshot(self.dbfile, self.key).unchanged(self.dest))
+
+    @mock.patch('sachannelupdate.snapshot.read_dir')
+    def test_unchanged_dirs_not_listed(self, mock_read_dir):
+        mock_read_dir.side_effect = [(['sub'], ['a.cf']), ([], ['b.cf'])]
+        self.take()
+        os.utime(os.path.join(self.rules, 'sub'), None)
+        mock_read_dir.side_effect = [([], ['b.cf'])]
+        self.assertEqual(
+            self.take(),
+            [os.path.join(self.rules, 'a.cf'),
+             os.path.join(self.rules, 'sub', 'b.cf')])
+        mock_read_dir.assert_called_with(
+            os.path.join(self.rules, 'sub'), 'sub', self.rule_filter)
+
+    def test_racy_dir(self):
+        os.utime(os.path.join(self.rules, 'sub'), None)
+        self.take()
+        snapshot = Snapshot(self.dbfile, self.key)
+        self.assertIsNone(
+            snapshot.dirs[os.path.join(self.rules, 'sub')][0])
+        self.assertFalse(snapshot.unchanged(self.dest))
+
+
+if __name__ == "__main__":
+    unittest2.main()
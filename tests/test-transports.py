@@ -1,7 +1,10 @@
 import os
 import sys
+import shutil
+import tempfile
 
 from Queue import Queue
+from StringIO import StringIO
 from pwd import getpwuid
 
 import mock
@@ -12,12 +15,17 @@ except ImportError:
         raise
     import unittest as unittest2
 
-from paramiko import SSHException
+from paramiko import SSHException, AuthenticationException, RSAKey
+from paramiko.hostkeys import HostKeys
 
 from sachannelupdate.exceptions import SaChannelUpdateTransportError
 from sachannelupdate.transports import get_key_files, get_ssh_keys, \
     get_remote_path, get_ssh_dir, get_local_user, get_host_keys, \
-    get_sftp_conn
+    get_sftp_conn, parse_remote, SFTPPool, is_healthy, close_conn, \
+    remote_stat, same_size, same_file, rename_into_place, put_file, \
+    Transfer, key_rank, load_private_key, get_agent_keys, KeyCache, \
+    get_key_cache, get_auth_keys, authenticate, check_host_key, \
+    prefer_host_keys, get_known_hosts
 
 
 class TransportsTestCase(unittest2.TestCase):
@@ -33,33 +41,198 @@ class TransportsTestCase(unittest2.TestCase):
         mock_isfile.assert_called_once_with(lfilename)
         self.assertEqual(lfilename, keys.get())
 
-    @mock.patch('sachannelupdate.transports.Queue')
-    @mock.patch('sachannelupdate.transports.os.path.isfile')
-    @mock.patch('sachannelupdate.transports.os.walk')
-    def test_get_ssh_keys(self, mock_walk, mock_isfile, mock_queue):
-        path = '/home/andrew/.ssh'
-        mock_isfile.return_value = True
-        mock_walk.return_value = [
-            (path, (), ('id_rsa', 'id_rsa.pub'))
-        ]
-        get_ssh_keys(path)
-        self.assertTrue(mock_walk.called)
-        self.assertTrue(mock_isfile.called)
-        self.assertTrue(mock_queue.return_value.put.called)
-
-    @mock.patch('sachannelupdate.transports.Queue')
-    @mock.patch('sachannelupdate.transports.os.path.isfile')
-    @mock.patch('sachannelupdate.transports.os.walk')
-    def test_get_ssh_keys_none(self, mock_walk, mock_isfile, mock_queue):
-        path = '/home/andrew/.ssh'
-        mock_isfile.return_value = True
-        mock_walk.return_value = [
-            (path, (), ())
-        ]
-        get_ssh_keys(path)
-        self.assertTrue(mock_walk.called)
-        self.assertFalse(mock_isfile.called)
-        self.assertFalse(mock_queue.return_value.put.called)
+    def test_get_ssh_keys(self):
+        sshdir = tempfile.mkdtemp()
+        try:
+            for name in ('id_rsa', 'id_rsa.pub', 'id_ed25519', 'id_dsa',
+                         'known_hosts', 'id_ecdsa'):
+                open(os.path.join(sshdir, name), 'w').close()
+            os.mkdir(os.path.join(sshdir, 'old_rsa'))
+            self.assertEqual(
+                get_ssh_keys(sshdir),
+                [os.path.join(sshdir, name) for name in (
+                    'id_ed25519', 'id_ecdsa', 'id_rsa', 'id_dsa')])
+        finally:
+            shutil.rmtree(sshdir)
+
+    def test_get_ssh_keys_none(self):
+        self.assertEqual(get_ssh_keys('/nonexistent/.ssh'), [])
+
+    def test_key_rank(self):
+        self.assertEqual(key_rank('id_ed25519'), 0)
+        self.assertEqual(key_rank('id_dsa'), 3)
+        self.assertEqual(key_rank('id_rsa.pub'), None)
+
+    def test_load_private_key(self):
+        sshdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(sshdir, 'id_dsa')
+            key = RSAKey.generate(1024)
+            key.write_private_key_file(filename)
+            self.assertEqual(
+                str(load_private_key(filename)), str(key))
+            key.write_private_key_file(filename, password='secret')
+            self.assertEqual(load_private_key(filename), None)
+            with open(filename, 'w') as handle:
+                handle.write('garbage')
+            self.assertEqual(load_private_key(filename), None)
+        finally:
+            shutil.rmtree(sshdir)
+
+    @mock.patch('sachannelupdate.transports.Agent')
+    def test_get_agent_keys(self, mock_agent):
+        mock_agent.return_value.get_keys.return_value = (
+            mock.sentinel.key,)
+        self.assertEqual(
+            get_agent_keys({}),
+            (mock_agent.return_value, (mock.sentinel.key,)))
+        self.assertEqual(get_agent_keys({'ssh_agent': 'no'}), (None, ()))
+        mock_agent.side_effect = SSHException
+        self.assertEqual(get_agent_keys({}), (None, ()))
+
+    def test_key_cache(self):
+        home_dir = tempfile.mkdtemp()
+        try:
+            cache = get_key_cache({'home_dir': home_dir})
+            self.assertTrue(cache is get_key_cache({'home_dir': home_dir}))
+            self.assertEqual(cache.get('tony@mirror1:22'), None)
+            cache.set('tony@mirror1:22', '/root/.ssh/id_rsa')
+            cache.set('tony@mirror2:22', 'agent:abcd')
+            self.assertTrue(
+                os.path.isfile(os.path.join(home_dir, 'db', 'sshkeys')))
+            cache = KeyCache(os.path.join(home_dir, 'db', 'sshkeys'))
+            self.assertEqual(
+                cache.get('tony@mirror1:22'), '/root/.ssh/id_rsa')
+            self.assertEqual(cache.get('tony@mirror2:22'), 'agent:abcd')
+        finally:
+            shutil.rmtree(home_dir)
+
+    @mock.patch('sachannelupdate.transports.load_private_key')
+    @mock.patch('sachannelupdate.transports.get_ssh_keys')
+    @mock.patch('sachannelupdate.transports.get_agent_keys')
+    def test_get_auth_keys(
+            self, mock_get_agent_keys, mock_get_ssh_keys,
+            mock_load_private_key):
+        agent_key = mock.Mock()
+        agent_key.get_fingerprint.return_value = '\xab\xcd'
+        mock_get_agent_keys.return_value = (mock.sentinel.agent, [agent_key])
+        mock_get_ssh_keys.return_value = ['/ssh/id_ed25519', '/ssh/id_rsa']
+        agent, candidates = get_auth_keys({}, '/ssh')
+        self.assertEqual(agent, mock.sentinel.agent)
+        self.assertEqual(
+            [ident for ident, _ in candidates],
+            ['agent:abcd', '/ssh/id_ed25519', '/ssh/id_rsa'])
+        self.assertEqual(candidates[0][1](), agent_key)
+        self.assertFalse(mock_load_private_key.called)
+        _, candidates = get_auth_keys({}, '/ssh', '/ssh/id_rsa')
+        self.assertEqual(
+            [ident for ident, _ in candidates],
+            ['/ssh/id_rsa', 'agent:abcd', '/ssh/id_ed25519'])
+        self.assertEqual(
+            candidates[0][1](), mock_load_private_key.return_value)
+        mock_load_private_key.assert_called_once_with('/ssh/id_rsa')
+        _, candidates = get_auth_keys({}, None)
+        self.assertEqual(
+            [ident for ident, _ in candidates], ['agent:abcd'])
+
+    def test_authenticate(self):
+        transport = mock.Mock()
+        transport.auth_publickey.side_effect = [
+            AuthenticationException, None]
+        transport.is_authenticated.return_value = True
+        candidates = [
+            ('passphrase', lambda: None),
+            ('wrong', lambda: mock.sentinel.wrong),
+            ('right', lambda: mock.sentinel.right)]
+        self.assertEqual(
+            authenticate(transport, 'tony', candidates), 'right')
+        transport.auth_publickey.assert_called_with(
+            'tony', mock.sentinel.right)
+        self.assertEqual(transport.auth_publickey.call_count, 2)
+        self.assertEqual(authenticate(transport, 'tony', []), None)
+
+    def test_authenticate_sign_error(self):
+        transport = mock.Mock()
+        transport.auth_publickey.side_effect = [
+            SSHException('key cannot be used for signing'), None]
+        transport.is_active.return_value = True
+        transport.is_authenticated.return_value = True
+        candidates = [
+            ('agent:abcd', lambda: mock.sentinel.agent),
+            ('/ssh/id_rsa', lambda: mock.sentinel.key)]
+        self.assertEqual(
+            authenticate(transport, 'tony', candidates), '/ssh/id_rsa')
+        transport.is_active.return_value = False
+        transport.auth_publickey.side_effect = SSHException('closed')
+        candidates = iter(candidates)
+        with self.assertRaises(SSHException):
+            authenticate(transport, 'tony', candidates)
+        self.assertEqual(
+            [ident for ident, _ in candidates], ['/ssh/id_rsa'])
+
+    def test_check_host_key(self):
+        transport = mock.Mock()
+        key = RSAKey.generate(1024)
+        transport.get_remote_server_key.return_value = key
+        check_host_key(transport, {'ssh-rsa': key})
+        check_host_key(transport, None, False)
+        with self.assertRaises(SSHException):
+            check_host_key(transport, None)
+        with self.assertRaises(SSHException):
+            check_host_key(transport, {'ssh-ed25519': key})
+        transport.get_remote_server_key.return_value = RSAKey.generate(1024)
+        with self.assertRaises(SSHException):
+            check_host_key(transport, {'ssh-rsa': key})
+
+    def test_prefer_host_keys(self):
+        transport = mock.Mock()
+        options = transport.get_security_options.return_value
+        options.key_types = [
+            'ssh-ed25519', 'ecdsa-sha2-nistp256', 'rsa-sha2-512', 'ssh-rsa']
+        prefer_host_keys(transport, None)
+        self.assertEqual(options.key_types[0], 'ssh-ed25519')
+        prefer_host_keys(transport, {'ssh-rsa': mock.sentinel.key})
+        self.assertEqual(
+            options.key_types,
+            ['rsa-sha2-512', 'ssh-rsa', 'ssh-ed25519', 'ecdsa-sha2-nistp256'])
+
+    def test_known_hosts(self):
+        sshdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(sshdir, 'known_hosts')
+            rsa = RSAKey.generate(1024)
+            other = RSAKey.generate(1024)
+            hostkeys = HostKeys()
+            hostkeys.add(
+                HostKeys.hash_host('mirror1.example.com'), 'ssh-rsa', rsa)
+            hostkeys.add('[mirror2.example.com]:2222', 'ssh-rsa', rsa)
+            hostkeys.save(filename)
+            known_hosts = get_known_hosts(filename)
+            self.assertTrue(known_hosts is get_known_hosts(filename))
+            self.assertEqual(
+                str(known_hosts.lookup('mirror1.example.com')['ssh-rsa']),
+                str(rsa))
+            self.assertEqual(
+                known_hosts.lookup('mirror2.example.com', 2222).keys(),
+                ['ssh-rsa'])
+            self.assertEqual(known_hosts.lookup('mirror2.example.com'), {})
+            self.assertEqual(
+                get_host_keys('mirror2.example.com', sshdir, 2222).keys(),
+                ['ssh-rsa'])
+            with mock.patch.object(known_hosts.hostkeys, 'lookup') as lookup:
+                known_hosts.lookup('mirror1.example.com')
+                self.assertFalse(lookup.called)
+            hostkeys.add('mirror3.example.com', 'ssh-rsa', other)
+            hostkeys.save(filename)
+            stat = os.stat(filename)
+            os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+            self.assertEqual(
+                str(known_hosts.lookup('mirror3.example.com')['ssh-rsa']),
+                str(other))
+            os.unlink(filename)
+            self.assertEqual(known_hosts.lookup('mirror1.example.com'), {})
+        finally:
+            shutil.rmtree(sshdir)
 
     def test_get_remote_path(self):
         for path in [
@@ -105,11 +278,12 @@ class TransportsTestCase(unittest2.TestCase):
         sshdir = os.path.dirname(os.path.dirname(__file__))
         key = get_host_keys('secure.example.com', sshdir)
         self.assertTrue(key is None)
+        self.assertTrue(get_host_keys('secure.example.com', None) is None)
 
+    @mock.patch('sachannelupdate.transports.get_key_cache')
     @mock.patch('sachannelupdate.transports.SFTPClient')
-    @mock.patch('sachannelupdate.transports.PKey')
     @mock.patch('sachannelupdate.transports.Transport')
-    @mock.patch('sachannelupdate.transports.get_ssh_keys')
+    @mock.patch('sachannelupdate.transports.get_auth_keys')
     @mock.patch('sachannelupdate.transports.get_host_keys')
     @mock.patch('sachannelupdate.transports.get_ssh_dir')
     @mock.patch('sachannelupdate.transports.get_local_user')
@@ -118,26 +292,31 @@ class TransportsTestCase(unittest2.TestCase):
         mock_get_local_user,
         mock_get_ssh_dir,
         mock_get_host_keys,
-        mock_get_ssh_keys,
+        mock_get_auth_keys,
         mock_Transport,
-        mock_PKey,
-            mock_SFTPClient):
+        mock_SFTPClient,
+            mock_get_key_cache):
         config = {
             'remote_location': 'sftp://127.0.0.1/srv/www/saupdate',
-            'remote_username': mock.sentinel.remote_username
+            'remote_username': 'tony'
         }
-        queue = mock.Mock(spec=Queue)
-        queue.get.return_value = mock.Mock()
-        # queue.empty.side_effect = [False, False]
-        queue.empty.return_value = False
-        mock_get_ssh_keys.return_value = queue
-        mock_get_local_user.return_value = mock.sentinel.remote_username
-        mock_SFTPClient.from_transport.return_value = mock.Mock()
-        mock_Transport.return_value.connect.return_value = True
-        get_sftp_conn(config)
-        mock_get_local_user.assert_called_once_with(
-            mock.sentinel.remote_username
-        )
+        agent = mock.Mock()
+        mock_get_auth_keys.return_value = (
+            agent, [('/ssh/id_rsa', lambda: mock.sentinel.key)])
+        mock_get_local_user.return_value = 'tony'
+        hostkey = mock.Mock()
+        hostkey.get_name.return_value = 'ssh-rsa'
+        mock_get_host_keys.return_value = {'ssh-rsa': hostkey}
+        mock_get_key_cache.return_value.get.return_value = '/ssh/id_rsa'
+        transport = mock_Transport.return_value
+        transport.get_remote_server_key.return_value = hostkey
+        transport.get_security_options.return_value.key_types = [
+            'ssh-ed25519', 'ssh-rsa']
+        transport.is_authenticated.return_value = True
+        result = get_sftp_conn(config)
+        self.assertEqual(
+            result, (mock_SFTPClient.from_transport.return_value, transport))
+        mock_get_local_user.assert_called_once_with('tony')
         mock_get_ssh_dir.assert_called_once_with(
             config,
             mock_get_local_user.return_value,
@@ -145,31 +324,87 @@ class TransportsTestCase(unittest2.TestCase):
         mock_get_host_keys.assert_called_once_with(
             '127.0.0.1',
             mock_get_ssh_dir.return_value,
+            22,
         )
-        mock_get_ssh_keys.assert_called_once_with(
-            mock_get_ssh_dir.return_value,
-        )
+        mock_get_key_cache.assert_called_once_with(config)
+        mock_get_key_cache.return_value.get.assert_called_once_with(
+            'tony@127.0.0.1:22')
+        mock_get_auth_keys.assert_called_once_with(
+            config, mock_get_ssh_dir.return_value, '/ssh/id_rsa')
         mock_Transport.assert_called_once_with(
             (
                 '127.0.0.1',
                 22,
-            )
-        )
-        mock_PKey.from_private_key_file.assert_called_with(
-            mock_get_ssh_keys.return_value.get(),
-        )
-        mock_Transport.return_value.connect.assert_called_once_with(
-            hostkey=mock_get_host_keys.return_value,
-            username=mock_get_local_user.return_value,
-            password=None,
-            pkey=mock_PKey.from_private_key_file.return_value,
-        )
-        mock_SFTPClient.from_transport.assert_called_with(
-            mock_Transport.return_value,
+            ),
+            default_window_size=2097152,
+            default_max_packet_size=32768,
         )
+        transport.use_compression.assert_called_once_with(False)
+        transport.start_client.assert_called_once_with()
+        self.assertEqual(
+            transport.get_security_options.return_value.key_types,
+            ['ssh-rsa', 'ssh-ed25519'])
+        transport.auth_publickey.assert_called_once_with(
+            'tony', mock.sentinel.key)
+        mock_get_key_cache.return_value.set.assert_called_once_with(
+            'tony@127.0.0.1:22', '/ssh/id_rsa')
+        mock_SFTPClient.from_transport.assert_called_with(transport)
+        agent.close.assert_called_once_with()
+        self.assertFalse(transport.close.called)
 
+    @mock.patch('sachannelupdate.transports.get_key_cache')
     @mock.patch('sachannelupdate.transports.SFTPClient')
-    @mock.patch('sachannelupdate.transports.get_ssh_keys')
+    @mock.patch('sachannelupdate.transports.Transport')
+    @mock.patch('sachannelupdate.transports.get_auth_keys')
+    @mock.patch('sachannelupdate.transports.get_host_keys')
+    @mock.patch('sachannelupdate.transports.get_ssh_dir')
+    @mock.patch('sachannelupdate.transports.get_local_user')
+    def test_get_sftp_conn_agent_key_fails(
+        self,
+        mock_get_local_user,
+        mock_get_ssh_dir,
+        mock_get_host_keys,
+        mock_get_auth_keys,
+        mock_Transport,
+        mock_SFTPClient,
+            mock_get_key_cache):
+        config = {
+            'remote_location': 'sftp://127.0.0.1/srv/www/saupdate',
+            'remote_username': 'tony',
+            'ssh_strict_host_keys': 'no',
+        }
+        agent = mock.Mock()
+        mock_get_auth_keys.return_value = (agent, [
+            ('agent:abcd', lambda: mock.sentinel.agent_key),
+            ('/ssh/id_rsa', lambda: mock.sentinel.key)])
+        mock_get_host_keys.return_value = None
+        mock_get_key_cache.return_value.get.return_value = None
+        # the agent key kills the first transport, the key file works
+        # on the second
+        broken = mock.Mock()
+        broken.auth_publickey.side_effect = SSHException(
+            'key cannot be used for signing')
+        broken.is_active.return_value = False
+        working = mock.Mock()
+        working.is_authenticated.return_value = True
+        mock_Transport.side_effect = [broken, working]
+        result = get_sftp_conn(config)
+        self.assertEqual(
+            result, (mock_SFTPClient.from_transport.return_value, working))
+        broken.auth_publickey.assert_called_once_with(
+            'tony', mock.sentinel.agent_key)
+        broken.close.assert_called_once_with()
+        working.auth_publickey.assert_called_once_with(
+            'tony', mock.sentinel.key)
+        self.assertFalse(working.close.called)
+        mock_get_key_cache.return_value.set.assert_called_once_with(
+            'tony@127.0.0.1:22', '/ssh/id_rsa')
+        agent.close.assert_called_once_with()
+
+    @mock.patch('sachannelupdate.transports.get_key_cache')
+    @mock.patch('sachannelupdate.transports.SFTPClient')
+    @mock.patch('sachannelupdate.transports.Transport')
+    @mock.patch('sachannelupdate.transports.get_auth_keys')
     @mock.patch('sachannelupdate.transports.get_host_keys')
     @mock.patch('sachannelupdate.transports.get_ssh_dir')
     @mock.patch('sachannelupdate.transports.get_local_user')
@@ -178,37 +413,28 @@ class TransportsTestCase(unittest2.TestCase):
         mock_get_local_user,
         mock_get_ssh_dir,
         mock_get_host_keys,
-        mock_get_ssh_keys,
-            mock_SFTPClient):
+        mock_get_auth_keys,
+        mock_Transport,
+        mock_SFTPClient,
+            mock_get_key_cache):
         config = {
             'remote_location': 'sftp://127.0.0.1:22/srv/www/saupdate',
-            'remote_username': mock.sentinel.remote_username
+            'remote_username': 'tony'
         }
-        queue = mock.Mock(spec=Queue)
-        queue.get.return_value = mock.Mock()
-        # queue.empty.side_effect = [False, False]
-        queue.empty.return_value = True
-        mock_get_ssh_keys.return_value = queue
-        mock_get_local_user.return_value = mock.sentinel.remote_username
-        mock_SFTPClient.from_transport.return_value = mock.Mock()
+        mock_get_auth_keys.return_value = (None, [])
+        mock_get_local_user.return_value = 'tony'
+        mock_get_host_keys.return_value = None
+        config['ssh_strict_host_keys'] = 'no'
         with self.assertRaises(SaChannelUpdateTransportError):
             get_sftp_conn(config)
-        mock_get_local_user.assert_called_once_with(
-            mock.sentinel.remote_username
-        )
-        mock_get_ssh_dir.assert_called_once_with(
-            config,
-            mock_get_local_user.return_value,
-        )
-        mock_get_host_keys.assert_called_once_with(
-            '127.0.0.1',
-            mock_get_ssh_dir.return_value,
-        )
+        self.assertFalse(mock_SFTPClient.from_transport.called)
+        self.assertFalse(mock_get_key_cache.return_value.set.called)
+        mock_Transport.return_value.close.assert_called_once_with()
 
+    @mock.patch('sachannelupdate.transports.get_key_cache')
     @mock.patch('sachannelupdate.transports.SFTPClient')
-    @mock.patch('sachannelupdate.transports.PKey')
     @mock.patch('sachannelupdate.transports.Transport')
-    @mock.patch('sachannelupdate.transports.get_ssh_keys')
+    @mock.patch('sachannelupdate.transports.get_auth_keys')
     @mock.patch('sachannelupdate.transports.get_host_keys')
     @mock.patch('sachannelupdate.transports.get_ssh_dir')
     @mock.patch('sachannelupdate.transports.get_local_user')
@@ -217,56 +443,277 @@ class TransportsTestCase(unittest2.TestCase):
         mock_get_local_user,
         mock_get_ssh_dir,
         mock_get_host_keys,
-        mock_get_ssh_keys,
+        mock_get_auth_keys,
         mock_Transport,
-        mock_PKey,
-            mock_SFTPClient):
+        mock_SFTPClient,
+            mock_get_key_cache):
         config = {
             'remote_location': 'sftp://127.0.0.1/srv/www/saupdate',
-            'remote_username': mock.sentinel.remote_username
+            'remote_username': 'tony'
         }
-        queue = mock.Mock(spec=Queue)
-        queue.get.return_value = mock.Mock()
-        queue.empty.side_effect = [False, False, True]
-        queue.empty.return_value = False
-        mock_get_ssh_keys.return_value = queue
-        mock_get_local_user.return_value = mock.sentinel.remote_username
+        agent = mock.Mock()
+        mock_get_auth_keys.return_value = (
+            agent, [('/ssh/id_rsa', lambda: mock.sentinel.key)])
+        mock_get_local_user.return_value = 'tony'
+        mock_get_host_keys.return_value = None
+        mock_Transport.return_value.is_authenticated.return_value = True
+        with self.assertRaises(SaChannelUpdateTransportError):
+            get_sftp_conn(config)
+        # unknown host key
+        self.assertFalse(mock_Transport.return_value.auth_publickey.called)
+        mock_Transport.return_value.close.assert_called_once_with()
+        agent.close.assert_called_once_with()
+        config['ssh_strict_host_keys'] = 'no'
         mock_SFTPClient.from_transport.side_effect = SSHException
-        mock_Transport.return_value.connect.return_value = True
         with self.assertRaises(SaChannelUpdateTransportError):
             get_sftp_conn(config)
-        mock_get_local_user.assert_called_once_with(
-            mock.sentinel.remote_username
-        )
-        mock_get_ssh_dir.assert_called_once_with(
-            config,
-            mock_get_local_user.return_value,
-        )
-        mock_get_host_keys.assert_called_once_with(
-            '127.0.0.1',
-            mock_get_ssh_dir.return_value,
-        )
-        mock_get_ssh_keys.assert_called_once_with(
-            mock_get_ssh_dir.return_value,
-        )
-        mock_Transport.assert_called_once_with(
-            (
-                '127.0.0.1',
-                22,
-            )
-        )
-        mock_PKey.from_private_key_file.assert_called_with(
-            mock_get_ssh_keys.return_value.get(),
-        )
-        mock_Transport.return_value.connect.assert_called_with(
-            hostkey=mock_get_host_keys.return_value,
-            username=mock_get_local_user.return_value,
-            password=None,
-            pkey=mock_PKey.from_private_key_file.return_value,
-        )
-        mock_SFTPClient.from_transport.assert_called_with(
-            mock_Transport.return_value,
-        )
+        self.assertEqual(mock_Transport.return_value.close.call_count, 2)
+
+
+REMOTE = 'sftp://mirror1:2222/srv/www/saupdate'
+
+
+def make_conn(*args):
+    "Return a mock sftp connection"
+    transport = mock.Mock()
+    transport.is_active.return_value = True
+    transport.is_authenticated.return_value = True
+    return mock.Mock(), transport
+
+
+class SFTPPoolTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.config = dict(remote_username='tony')
+
+    def test_parse_remote(self):
+        self.assertEqual(
+            parse_remote(self.config, REMOTE), ('mirror1', 2222, 'tony'))
+        self.assertEqual(
+            parse_remote(self.config, 'sftp://mirror1/srv'),
+            ('mirror1', 22, 'tony'))
+
+    @mock.patch('sachannelupdate.transports.get_sftp_conn')
+    def test_session_reuse(self, mock_get_sftp_conn):
+        mock_get_sftp_conn.side_effect = make_conn
+        pool = SFTPPool()
+        with pool.session(self.config, REMOTE) as sftp:
+            first = sftp
+        with pool.session(self.config, REMOTE) as sftp:
+            self.assertTrue(sftp is first)
+        mock_get_sftp_conn.assert_called_once_with(self.config, REMOTE)
+        self.assertEqual(len(pool.idle[('mirror1', 2222, 'tony')]), 1)
+
+    @mock.patch('sachannelupdate.transports.get_sftp_conn')
+    def test_session_keepalive(self, mock_get_sftp_conn):
+        mock_get_sftp_conn.side_effect = make_conn
+        self.config['ssh_keepalive'] = '15'
+        pool = SFTPPool()
+        with pool.session(self.config, REMOTE):
+            pass
+        _, transport, _ = pool.idle[('mirror1', 2222, 'tony')][0]
+        transport.set_keepalive.assert_called_once_with(15)
+
+    @mock.patch('sachannelupdate.transports.get_sftp_conn')
+    def test_session_error_discards(self, mock_get_sftp_conn):
+        mock_get_sftp_conn.side_effect = make_conn
+        pool = SFTPPool()
+        with self.assertRaises(IOError):
+            with pool.session(self.config, REMOTE) as sftp:
+                raise IOError('Permission denied')
+        sftp.close.assert_called_once_with()
+        self.assertEqual(pool.idle, {})
+
+    @mock.patch('sachannelupdate.transports.get_sftp_conn')
+    def test_session_unhealthy(self, mock_get_sftp_conn):
+        mock_get_sftp_conn.side_effect = make_conn
+        pool = SFTPPool()
+        with pool.session(self.config, REMOTE) as sftp:
+            first = sftp
+        _, transport, _ = pool.idle[('mirror1', 2222, 'tony')][0]
+        transport.is_active.return_value = False
+        with pool.session(self.config, REMOTE) as sftp:
+            self.assertFalse(sftp is first)
+        first.close.assert_called_once_with()
+        self.assertEqual(mock_get_sftp_conn.call_count, 2)
+
+    @mock.patch('sachannelupdate.transports.time')
+    @mock.patch('sachannelupdate.transports.get_sftp_conn')
+    def test_evict(self, mock_get_sftp_conn, mock_time):
+        mock_get_sftp_conn.side_effect = make_conn
+        mock_time.time.return_value = 1000
+        pool = SFTPPool()
+        with pool.session(self.config, REMOTE) as sftp:
+            first = sftp
+        mock_time.time.return_value = 1400
+        pool.evict(300)
+        self.assertEqual(pool.idle, {})
+        first.close.assert_called_once_with()
+
+    def test_is_healthy(self):
+        sftp, transport = make_conn()
+        self.assertTrue(is_healthy(sftp, transport))
+        self.assertFalse(sftp.normalize.called)
+        self.assertTrue(is_healthy(sftp, transport, True))
+        sftp.normalize.assert_called_once_with('.')
+        sftp.normalize.side_effect = EOFError
+        self.assertFalse(is_healthy(sftp, transport, True))
+        transport.is_authenticated.return_value = False
+        self.assertFalse(is_healthy(sftp, transport))
+
+    @mock.patch('sachannelupdate.transports.get_sftp_conn')
+    def test_closeall(self, mock_get_sftp_conn):
+        mock_get_sftp_conn.side_effect = make_conn
+        pool = SFTPPool()
+        with pool.session(self.config, REMOTE) as sftp:
+            pass
+        pool.closeall()
+        self.assertEqual(pool.idle, {})
+        sftp.close.assert_called_once_with()
+
+    def test_close_conn(self):
+        sftp, transport = make_conn()
+        sftp.close.side_effect = EOFError
+        close_conn(sftp, transport)
+        transport.close.assert_called_once_with()
+
+
+class FakeSFTPFile(StringIO):
+    "In memory remote file"
+    def __init__(self, sftp, path, data=''):
+        StringIO.__init__(self, data)
+        self.sftp = sftp
+        self.path = path
+
+    def set_pipelined(self, pipelined):
+        self.pipelined = pipelined
+
+    def close(self):
+        self.sftp.files[self.path] = self.getvalue()
+        StringIO.close(self)
+
+
+class FakeSFTP(object):
+    "In memory SFTP client"
+    def __init__(self, files=None):
+        self.files = files or {}
+
+    def stat(self, path):
+        if path not in self.files:
+            raise IOError(2, 'No such file')
+        return mock.Mock(st_size=len(self.files[path]))
+
+    def open(self, path, mode='r'):
+        if mode == 'w':
+            return FakeSFTPFile(self, path)
+        return FakeSFTPFile(self, path, self.stat(path) and self.files[path])
+
+    def rename(self, source, dest):
+        if dest in self.files:
+            raise IOError('Failure')
+        self.files[dest] = self.files.pop(source)
+
+    def remove(self, path):
+        del self.files[path]
+
+
+class SFTPTransferTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.local = os.path.join(self.tmpdir, '10.tar.gz')
+        self.data = os.urandom(100000)
+        with open(self.local, 'wb') as handle:
+            handle.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_remote_stat(self):
+        sftp = FakeSFTP({'/srv/a': 'xxx'})
+        self.assertEqual(remote_stat(sftp, '/srv/a').st_size, 3)
+        self.assertTrue(remote_stat(sftp, '/srv/b') is None)
+
+    def test_same_size_and_file(self):
+        sftp = FakeSFTP({'/srv/10.tar.gz': self.data})
+        self.assertTrue(same_size(sftp, self.local, '/srv/10.tar.gz'))
+        self.assertTrue(same_file(sftp, self.local, '/srv/10.tar.gz'))
+        self.assertFalse(same_file(sftp, self.local, '/srv/11.tar.gz'))
+        changed = chr(ord(self.data[0]) ^ 1) + self.data[1:]
+        sftp.files['/srv/10.tar.gz'] = changed
+        self.assertTrue(same_size(sftp, self.local, '/srv/10.tar.gz'))
+        self.assertFalse(same_file(sftp, self.local, '/srv/10.tar.gz'))
+
+    def test_rename_into_place(self):
+        sftp = FakeSFTP({'/srv/a.part': 'new', '/srv/a': 'old'})
+        rename_into_place(sftp, '/srv/a.part', '/srv/a')
+        self.assertEqual(sftp.files, {'/srv/a': 'new'})
+        sftp = mock.Mock()
+        rename_into_place(sftp, '/srv/a.part', '/srv/a')
+        sftp.posix_rename.assert_called_once_with('/srv/a.part', '/srv/a')
+        self.assertFalse(sftp.rename.called)
+
+    def test_put_file(self):
+        sftp = FakeSFTP()
+        transfer = put_file(
+            sftp, self.local, '/srv/10.tar.gz', '/srv/10.tar.gz.part',
+            blocksize=4096)
+        self.assertEqual(transfer.offset, 0)
+        self.assertEqual(transfer.sent, len(self.data))
+        self.assertEqual(sftp.files, {'/srv/10.tar.gz': self.data})
+
+    def test_put_file_resume(self):
+        sftp = FakeSFTP({'/srv/10.tar.gz.part': self.data[:40000]})
+        handle = {}
+        real_open = sftp.open
+
+        def tracking_open(path, mode='r'):
+            "inline"
+            handle['mode'] = mode
+            return real_open(path, mode)
+        sftp.open = tracking_open
+        transfer = put_file(
+            sftp, self.local, '/srv/10.tar.gz', '/srv/10.tar.gz.part',
+            resume=True)
+        self.assertEqual(transfer.offset, 40000)
+        self.assertEqual(transfer.sent, len(self.data) - 40000)
+        self.assertEqual(handle['mode'], 'r+')
+        self.assertEqual(sftp.files, {'/srv/10.tar.gz': self.data})
+
+    def test_put_file_stale_partial(self):
+        sftp = FakeSFTP({'/srv/10.tar.gz.part': self.data + 'xxx'})
+        transfer = put_file(
+            sftp, self.local, '/srv/10.tar.gz', '/srv/10.tar.gz.part',
+            resume=True)
+        self.assertEqual(transfer.offset, 0)
+        self.assertEqual(sftp.files, {'/srv/10.tar.gz': self.data})
+
+    def test_put_file_no_resume(self):
+        sftp = FakeSFTP({'/srv/10.tar.gz.part': self.data[:40000]})
+        transfer = put_file(
+            sftp, self.local, '/srv/10.tar.gz', '/srv/10.tar.gz.part')
+        self.assertEqual(transfer.offset, 0)
+        self.assertEqual(sftp.files, {'/srv/10.tar.gz': self.data})
+
+    def test_transfer(self):
+        transfer = Transfer('/srv/10.tar.gz', 2000, 1000)
+        self.assertEqual(transfer.rate, 0.0)
+        transfer.sent = 1000
+        transfer.elapsed = 0.5
+        self.assertEqual(transfer.rate, 2000.0)
+        self.assertEqual(
+            str(transfer),
+            '/srv/10.tar.gz: 1000 bytes in 0.50s (2000 bytes/sec), '
+            'resumed at 1000')
+
+    def test_put_file_incomplete(self):
+        sftp = FakeSFTP()
+        with mock.patch.object(sftp, 'stat') as mock_stat:
+            mock_stat.return_value = mock.Mock(st_size=10)
+            with self.assertRaises(SaChannelUpdateTransportError):
+                put_file(
+                    sftp, self.local, '/srv/10.tar.gz',
+                    '/srv/10.tar.gz.part')
 
 
 if __name__ == "__main__":
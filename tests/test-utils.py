@@ -1,5 +1,8 @@
 from __future__ import print_function
+import os
 import sys
+import threading
+import subprocess
 
 import mock
 try:
@@ -9,7 +12,9 @@ except ImportError:
         raise
     import unittest as unittest2
 
-from sachannelupdate.utils import error, info
+from sachannelupdate.utils import error, info, get_int, get_bool, \
+    parallel_map, parallel_imap, LazyModule
+from sachannelupdate.exceptions import SaChannelUpdateConfigError
 
 
 class UtilsTestCase(unittest2.TestCase):
@@ -26,6 +31,101 @@ class UtilsTestCase(unittest2.TestCase):
         info(msg)
         mock_print.assert_called_once_with(msg, file=sys.stdout)
 
+    def test_lazy_module(self):
+        module = LazyModule('colorsys')
+        sys.modules.pop('colorsys', None)
+        self.assertEqual(module.rgb_to_hsv(0, 0, 0), (0, 0, 0.0))
+        self.assertIn('colorsys', sys.modules)
+        with self.assertRaises(AttributeError):
+            module.missing
+        with self.assertRaises(ImportError):
+            LazyModule('sachannelupdate.missing').attr
+
+    def test_lazy_imports(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys, sachannelupdate.cli; print(" ".join(sys.modules))'],
+            cwd=root, stdout=subprocess.PIPE).communicate()[0]
+        loaded = set([name.split('.')[0] for name in output.split()])
+        self.assertIn('sachannelupdate', loaded)
+        for heavy in ('paramiko', 'dns', 'gnupg', 'ctypes'):
+            self.assertNotIn(heavy, loaded)
+
+    def test_get_int(self):
+        config = dict(workers='4', empty='', bad='four')
+        self.assertEqual(get_int(config, 'workers', 1), 4)
+        self.assertEqual(get_int(config, 'empty', 1), 1)
+        self.assertEqual(get_int(config, 'missing', 2), 2)
+        with self.assertRaises(SaChannelUpdateConfigError):
+            get_int(config, 'bad', 1)
+
+    def test_get_bool(self):
+        config = dict(on='Yes', off='0', empty='', bad='maybe', real=True)
+        self.assertTrue(get_bool(config, 'on', False))
+        self.assertFalse(get_bool(config, 'off', True))
+        self.assertTrue(get_bool(config, 'empty', True))
+        self.assertFalse(get_bool(config, 'missing', False))
+        self.assertTrue(get_bool(config, 'real', False))
+        with self.assertRaises(SaChannelUpdateConfigError):
+            get_bool(config, 'bad', False)
+
+    @mock.patch('sachannelupdate.utils.ThreadPool')
+    def test_parallel_map_serial(self, mock_pool):
+        self.assertEqual(parallel_map(abs, [-1, -2], 1), [1, 2])
+        self.assertEqual(parallel_map(abs, [-1], 8), [1])
+        self.assertFalse(mock_pool.called)
+
+    def test_parallel_map_pool(self):
+        items = range(-20, 0)
+        self.assertEqual(
+            parallel_map(abs, items, 4), [abs(item) for item in items])
+
+
+    def test_parallel_imap(self):
+        seen = []
+
+        def double(num):
+            "inline"
+            seen.append(num)
+            return num * 2
+        results = parallel_imap(double, iter(range(5)), 1)
+        self.assertEqual(seen, [])
+        self.assertEqual(next(results), 0)
+        self.assertEqual(seen, [0])
+        self.assertEqual(list(results), [2, 4, 6, 8])
+        self.assertEqual(
+            list(parallel_imap(double, iter(range(20)), 4)),
+            [num * 2 for num in range(20)])
+
+    def test_parallel_imap_bounded(self):
+        read = []
+
+        def items():
+            "inline"
+            for num in range(1000):
+                read.append(num)
+                yield num
+        results = parallel_imap(lambda num: num, items(), 4)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(read), 9)
+        self.assertEqual(list(results), range(1, 1000))
+
+    def test_parallel_imap_error(self):
+        lock = threading.Lock()
+        called = []
+
+        def fail(num):
+            "inline"
+            with lock:
+                called.append(num)
+            if num == 3:
+                raise ValueError('bad rule')
+            return num
+        with self.assertRaises(ValueError):
+            list(parallel_imap(fail, iter(range(1000)), 2))
+        self.assertLess(len(called), 20)
+
 
 if __name__ == "__main__":
     unittest2.main()
@@ -0,0 +1,187 @@
+import os
+import sys
+import shutil
+import tempfile
+
+import mock
+try:
+    import unittest2
+except ImportError:
+    if sys.version_info < (2, 7):
+        raise
+    import unittest as unittest2
+
+from sachannelupdate.exceptions import SaChannelUpdateError
+from sachannelupdate.discovery import RuleFilter
+from sachannelupdate.watch import LIBC, RuleWatcher, Inotify, watch, \
+    IN_Q_OVERFLOW
+
+
+@unittest2.skipIf(LIBC is None, 'inotify is not available')
+class RuleWatcherTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rule_dir = os.path.join(self.tmpdir, 'rules')
+        os.makedirs(os.path.join(self.rule_dir, 'sub'))
+        self.write('sub/existing.cf')
+        self.write('notes.txt')
+        self.watcher = RuleWatcher(self.rule_dir)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name):
+        "write a rule file"
+        with open(os.path.join(self.rule_dir, name), 'w') as handle:
+            handle.write('score RULE 1.0\n')
+
+    def path(self, name):
+        "full path"
+        return os.path.join(self.rule_dir, name)
+
+    def test_is_rule_file(self):
+        self.assertTrue(self.watcher.is_rule_file(self.path('rule.cf')))
+        self.assertTrue(self.watcher.is_rule_file(self.path('a/rule.post')))
+        self.assertFalse(self.watcher.is_rule_file(self.path('rule.cf.swp')))
+        self.assertFalse(self.watcher.is_rule_file(self.path('.rule.cf')))
+
+    def test_rule_filter(self):
+        self.watcher.close()
+        os.makedirs(self.path('.git'))
+        os.makedirs(self.path('local'))
+        self.write('.git/HEAD.cf')
+        self.write('local/skip.cf')
+        self.write('notes.txt')
+        self.watcher = RuleWatcher(
+            self.rule_dir,
+            rule_filter=RuleFilter(('*.cf', '*.txt'), ('.*', 'local/*')))
+        self.assertEqual(self.watcher.files, set([
+            self.path('sub/existing.cf'), self.path('notes.txt')]))
+        self.assertNotIn(self.path('.git'), self.watcher.dirs.values())
+        self.write('local/other.cf')
+        self.assertFalse(self.watcher.wait(0.1))
+        os.makedirs(self.path('.hg'))
+        self.assertFalse(self.watcher.wait(0.1))
+        self.assertNotIn(self.path('.hg'), self.watcher.dirs.values())
+
+    def test_initial_index(self):
+        self.assertEqual(
+            self.watcher.files, set([self.path('sub/existing.cf')]))
+        self.assertEqual(len(self.watcher.dirs), 2)
+
+    def test_changes(self):
+        self.assertFalse(self.watcher.wait(0.05))
+        self.write('new.cf')
+        self.assertTrue(self.watcher.wait(1))
+        self.assertIn(self.path('new.cf'), self.watcher.files)
+        self.write('other.txt')
+        self.assertFalse(self.watcher.wait(0.1))
+        os.rename(self.path('new.cf'), self.path('renamed.post'))
+        self.assertTrue(self.watcher.wait(1))
+        self.assertNotIn(self.path('new.cf'), self.watcher.files)
+        self.assertIn(self.path('renamed.post'), self.watcher.files)
+        os.unlink(self.path('renamed.post'))
+        self.assertTrue(self.watcher.wait(1))
+        self.assertNotIn(self.path('renamed.post'), self.watcher.files)
+
+    def test_directories(self):
+        os.makedirs(self.path('a/b'))
+        self.assertFalse(self.watcher.wait(0.1))
+        self.write('a/b/deep.cf')
+        self.assertTrue(self.watcher.wait(1))
+        self.assertIn(self.path('a/b/deep.cf'), self.watcher.files)
+        shutil.move(self.path('sub'), os.path.join(self.tmpdir, 'gone'))
+        self.assertTrue(self.watcher.wait(1))
+        self.assertEqual(
+            self.watcher.files, set([self.path('a/b/deep.cf')]))
+        shutil.move(os.path.join(self.tmpdir, 'gone'), self.path('back'))
+        self.assertTrue(self.watcher.wait(1))
+        self.assertIn(self.path('back/existing.cf'), self.watcher.files)
+        shutil.rmtree(self.path('a'))
+        self.assertTrue(self.watcher.wait(1))
+        self.assertEqual(
+            self.watcher.files, set([self.path('back/existing.cf')]))
+        self.assertEqual(
+            sorted(self.watcher.dirs.values()),
+            [self.rule_dir, self.path('back')])
+
+    def test_overflow(self):
+        self.watcher.files.add('/stale.cf')
+        self.assertTrue(self.watcher.handle((-1, IN_Q_OVERFLOW, 0, '')))
+        self.assertEqual(
+            self.watcher.files, set([self.path('sub/existing.cf')]))
+
+
+class WatchTestCase(unittest2.TestCase):
+
+    @mock.patch('sachannelupdate.watch.LIBC', None)
+    def test_no_inotify(self):
+        with self.assertRaises(SaChannelUpdateError):
+            Inotify()
+
+    @mock.patch('sachannelupdate.watch.info')
+    @mock.patch('sachannelupdate.watch.error')
+    @mock.patch('sachannelupdate.watch.entry')
+    @mock.patch('sachannelupdate.watch.RuleWatcher')
+    def test_watch(self, mock_watcher, mock_entry, mock_error, mock_info):
+        watcher = mock_watcher.return_value
+        watcher.files = set(['/rules/b.cf', '/rules/a.cf'])
+        # a change, a burst of two more within the debounce window, then
+        # a change that fails to publish
+        watcher.wait.side_effect = [
+            True, True, True, False, True, False, KeyboardInterrupt]
+        mock_entry.side_effect = [
+            dict(status='published', version=1),
+            dict(status='published', version=2),
+            SaChannelUpdateError('down')]
+        config = dict(home_dir='/srv', watch_debounce='5')
+        with self.assertRaises(KeyboardInterrupt):
+            watch(config)
+        self.assertEqual(mock_watcher.call_args[0], ('/srv/rules',))
+        self.assertEqual(
+            mock_watcher.call_args[1]['rule_filter'].include,
+            ('*.cf', '*.post'))
+        self.assertEqual(
+            watcher.wait.call_args_list,
+            [mock.call(None), mock.call(5), mock.call(5), mock.call(5),
+             mock.call(None), mock.call(5), mock.call(30)])
+        self.assertEqual(mock_entry.call_count, 3)
+        mock_entry.assert_called_with(
+            config, rulefiles=['/rules/a.cf', '/rules/b.cf'], lock_wait=True)
+        self.assertEqual(mock_error.call_count, 1)
+        watcher.close.assert_called_once_with()
+
+    @mock.patch('sachannelupdate.watch.info')
+    @mock.patch('sachannelupdate.watch.entry')
+    @mock.patch('sachannelupdate.watch.RuleWatcher')
+    def test_watch_retry(self, mock_watcher, mock_entry, mock_info):
+        watcher = mock_watcher.return_value
+        watcher.files = set(['/rules/a.cf'])
+        watcher.rule_dir = '/srv/rules'
+        # two retries time out, the third publishes, then a change in
+        # the rules is retried after the first delay again
+        watcher.wait.side_effect = [
+            False, False, False, True, False, False, KeyboardInterrupt]
+        mock_entry.side_effect = [
+            dict(status='failed', version=1),
+            dict(status='locked', version=None),
+            dict(status='failed', version=1),
+            dict(status='published', version=1),
+            dict(status='failed', version=2),
+            dict(status='unchanged', version=None)]
+        config = dict(
+            home_dir='/srv', watch_debounce='5', watch_retry='10',
+            watch_retry_max='25')
+        with self.assertRaises(KeyboardInterrupt):
+            watch(config)
+        self.assertEqual(
+            watcher.wait.call_args_list,
+            [mock.call(10), mock.call(20), mock.call(25), mock.call(None),
+             mock.call(5), mock.call(10), mock.call(None)])
+        self.assertEqual(mock_entry.call_count, 6)
+        mock_info.assert_any_call('Retrying /srv/rules in 25 seconds')
+
+if __name__ == "__main__":
+    unittest2.main()